@@ -0,0 +1,262 @@
+"""
+Pending-aware asynchronous batch acquisition for bayesian_optimize.
+
+Workers finish at different times, so the next point is chosen while other
+points are still being simulated. PendingAwareSuggester fits the GP on the
+registered results plus a constant-liar fantasy for every pending point:
+each in-flight point is assumed to score the lie (by default the worst
+target seen so far), which flattens the acquisition around it and pushes the
+next suggestion elsewhere. Before any result is known, the first points come
+from a Latin hypercube design instead of the empty GP.
+
+Suggestions are made by a feeder thread that keeps n_in_flight points queued
+or running. The GP fit and acquisition run on a private copy of the data, so
+registering results never waits for them. The GP is one of the surrogates of
+the surrogate module; the time every suggestion took is recorded, so it can
+be compared with the rate at which the workers return results.
+
+With a checkpoint file the pending points are saved whenever they change, so
+an interrupted run can evaluate them first when it is resumed (see
+load_pending).
+"""
+
+import csv
+import json
+import os
+import threading
+import time
+import numpy as np
+from util import round_dic_data, params_to_tuple
+from surrogate import GlobalGP, TrustRegionGP
+
+LIARS = {
+    "min": np.min,
+    "mean": np.mean,
+    "max": np.max,
+}
+
+
+def latin_hypercube(n, bounds, random_state):
+    """n points of a Latin hypercube design within bounds (d x 2)."""
+    d = len(bounds)
+    cells = np.argsort(random_state.uniform(size=(n, d)), axis=0)
+    unit = (cells + random_state.uniform(size=(n, d))) / n
+    return bounds[:, 0] + unit * (bounds[:, 1] - bounds[:, 0])
+
+
+def load_pending(checkpoint):
+    """Parameter dicts that were in flight when the checkpoint was written."""
+    if not os.path.isfile(checkpoint):
+        return []
+    with open(checkpoint) as f:
+        return json.load(f)
+
+
+class PendingAwareSuggester:
+    """
+    Distinct suggestions for asynchronous workers.
+
+    Args:
+        optimizer (BayesianOptimization): Optimizer the results are
+            registered with; only read here
+        util (UtilityFunction): Acquisition function
+        lock (threading.Lock): Lock held while the optimizer is modified;
+            also guards the pending points
+        issued_params_set (set): Rounded parameter tuples issued so far
+        n_initial (int): Latin hypercube points issued before the GP is used
+        liar (str): Target assumed for pending points, 'min', 'mean' or
+            'max' of the registered targets
+        random_state (int): Seed of the design and the acquisition search
+        max_retries (int): Random points tried when a suggestion rounds to an
+            already issued one
+        surrogate (str | object): 'exact' (GlobalGP), 'turbo'
+            (TrustRegionGP) or an instance with observe(), region() and
+            propose()
+        latency_log (str): CSV file that receives one row per suggestion
+        checkpoint (str): JSON file that always holds the pending points
+        initial (list): Parameter dicts issued before anything else, e.g.
+            the pending points of a resumed run
+
+    Results already registered with the optimizer are passed to the
+    surrogate, so a warm-started optimizer continues from them.
+    """
+
+    def __init__(
+        self,
+        optimizer,
+        util,
+        lock,
+        issued_params_set,
+        n_initial=8,
+        liar="min",
+        random_state=1,
+        max_retries=100,
+        surrogate="exact",
+        latency_log=None,
+        checkpoint=None,
+        initial=(),
+    ):
+        if liar not in LIARS:
+            raise ValueError(f"unknown liar: {liar}")
+        if surrogate == "exact":
+            surrogate = GlobalGP(optimizer)
+        elif surrogate == "turbo":
+            surrogate = TrustRegionGP()
+        elif isinstance(surrogate, str):
+            raise ValueError(f"unknown surrogate: {surrogate}")
+        self.optimizer = optimizer
+        self.util = util
+        self.lock = lock
+        self.changed = threading.Condition(lock)
+        self.issued_params_set = issued_params_set
+        self.liar = liar
+        self.max_retries = max_retries
+        self.random_state = np.random.RandomState(random_state)
+        self.pending = {}
+        self.surrogate = surrogate
+        self.latency_log = latency_log
+        self.latencies = []
+        self.checkpoint = checkpoint
+        self.initial = list(initial)
+        self.error = None
+        self.design = list(
+            latin_hypercube(n_initial, optimizer.space.bounds, self.random_state)
+        )
+        for x, target in zip(optimizer.space.params, optimizer.space.target):
+            surrogate.observe(x, target)
+
+    def snapshot(self):
+        with self.lock:
+            space = self.optimizer.space
+            return (
+                space.params.copy(),
+                space.target.copy(),
+                np.array(
+                    [space.params_to_array(p) for p in self.pending.values()]
+                ).reshape(-1, space.dim),
+                self.surrogate.region(space),
+            )
+
+    def acquire(self):
+        """Unrounded next point as an array, in the key order of the space."""
+        space = self.optimizer.space
+        if self.design:
+            return self.design.pop(0)
+        params, target, pending, region = self.snapshot()
+        if not len(target):
+            return space.random_sample()
+        return self.surrogate.propose(
+            space,
+            params,
+            target,
+            pending,
+            LIARS[self.liar](target),
+            self.util,
+            self.random_state,
+            region,
+        )
+
+    def suggest(self):
+        """Return a new rounded parameter dict and mark it pending."""
+        space = self.optimizer.space
+        while self.initial:
+            params = self.initial.pop(0)
+            key = params_to_tuple(params)
+            with self.lock:
+                if key not in self.issued_params_set:
+                    self.issued_params_set.add(key)
+                    self.pending[key] = params
+                    self.save_checkpoint()
+                    return params
+        start = time.perf_counter()
+        x = self.acquire()
+        for _ in range(self.max_retries):
+            params = round_dic_data(space.array_to_params(x))
+            key = params_to_tuple(params)
+            with self.lock:
+                if key not in self.issued_params_set:
+                    self.issued_params_set.add(key)
+                    self.pending[key] = params
+                    self.record_latency(time.perf_counter() - start)
+                    self.save_checkpoint()
+                    return params
+            print(f"Duplicate params detected: {params}. Sampling at random.")
+            x = space.random_sample()
+        raise RuntimeError("no new parameters found")
+
+    def save_checkpoint(self):
+        """Write the pending points to the checkpoint file; needs lock."""
+        if self.checkpoint is None:
+            return
+        scratch = f"{self.checkpoint}.tmp"
+        with open(scratch, "w") as f:
+            json.dump(list(self.pending.values()), f)
+        os.replace(scratch, self.checkpoint)
+
+    def record_latency(self, seconds):
+        """Store the time of a suggestion; needs lock."""
+        row = (
+            len(self.latencies) + 1,
+            len(self.optimizer.space),
+            len(self.pending),
+            seconds,
+        )
+        self.latencies.append(row)
+        if self.latency_log is not None:
+            new_file = not os.path.isfile(self.latency_log)
+            with open(self.latency_log, "a", newline="") as f:
+                writer = csv.writer(f)
+                if new_file:
+                    writer.writerow(["iteration", "observations", "pending", "seconds"])
+                writer.writerow(row)
+
+    def latency_stats(self):
+        """Summary of the suggestion times in seconds."""
+        seconds = np.array([row[3] for row in self.latencies])
+        if not len(seconds):
+            return {}
+        return {
+            "suggestions": len(seconds),
+            "mean": float(seconds.mean()),
+            "p50": float(np.percentile(seconds, 50)),
+            "p95": float(np.percentile(seconds, 95)),
+            "max": float(seconds.max()),
+            "last": float(seconds[-1]),
+        }
+
+    def complete(self, params, target=None):
+        """
+        Drop a finished or failed point from the pending set and pass its
+        target to the surrogate; needs lock.
+        """
+        self.pending.pop(params_to_tuple(params), None)
+        if target is not None:
+            self.surrogate.observe(
+                self.optimizer.space.params_to_array(params), target
+            )
+        self.save_checkpoint()
+        self.changed.notify_all()
+
+    def feed(self, submit, task_count, total_task_num, n_in_flight, done_event):
+        """
+        Keep n_in_flight points queued or running until total_task_num points
+        were issued; the body of the feeder thread. submit queues a task dict,
+        e.g. Campaign.submit. An exception ends the feeder: it is stored in
+        error and done_event is set, so the thread collecting the results can
+        raise it instead of waiting for points that never come.
+        """
+        try:
+            while not done_event.is_set() and task_count.value < total_task_num:
+                with self.changed:
+                    while (
+                        len(self.pending) >= n_in_flight and not done_event.is_set()
+                    ):
+                        self.changed.wait(timeout=1)
+                if done_event.is_set():
+                    break
+                submit({"params": self.suggest()})
+                with task_count.get_lock():
+                    task_count.value += 1
+        except Exception as e:
+            self.error = e
+            done_event.set()
@@ -1,84 +1,144 @@
+import json
 import multiprocessing
 from bayes_opt import BayesianOptimization
 from bayes_opt import UtilityFunction
+import os
 import time
 import threading
 from bayes_opt.logger import JSONLogger
 from bayes_opt.event import Events
 from util import (
-    round_dic_data,
     handle_exception,
+    round_dic_data,
     params_to_tuple,
+    LOG_DIR,
 )
-from task import SUMO_task, pbounds
+from task import evaluate_params, pbounds, SIM_STEP
+from eval_cache import EvaluationCache
+from batch_acquisition import PendingAwareSuggester, load_pending
+from scheduler import TaskScheduler
+from result_store import ResultStore, ResultLogger
 import numpy as np
 
 
-def task_function(env, **params):
+def task_function(
+    env,
+    backend="traci",
+    cache=None,
+    reuse_sumo=True,
+    streaming=False,
+    fidelity=None,
+    early_abort=None,
+    horizon=None,
+    **params,
+):
     try:
-        task = SUMO_task(params, env=env)
-        res = task.run_task(sim_step=750 * 30, save=False, gui=False)
+        res = evaluate_params(
+            params,
+            env=env,
+            sim_step=SIM_STEP,
+            cache=cache,
+            save=False,
+            gui=False,
+            backend=backend,
+            reuse_sumo=reuse_sumo,
+            streaming=streaming,
+            fidelity=fidelity,
+            early_abort=early_abort,
+            horizon=horizon,
+        )
         return res
     except Exception as e:
         handle_exception(e)
         return None
 
 
-def execute_task(task_queue, result_queue, task_done_event, env):
-    while not task_done_event.is_set():
-        task = task_queue.get()
-        if task is None:
-            break
-        params = task["params"]
-        try:
-            target = task_function(**params, env=env)
-            if target is not None:
-                res = -np.sum(target) / len(target)
-                result_queue.put({"params": params, "target": res})
-        except Exception as e:
-            handle_exception(e)
-        finally:
-            task_queue.task_done()
-
-
-def result_handler(
-    result_queue,
-    optimizer,
-    util,
-    task_queue,
-    task_count,
-    total_task_num,
-    task_done_event,
-    lock,
-    issued_params_set,
+def execute_task(task, env, **options):
+    """
+    Evaluate one scheduler task; options are the evaluation keywords of
+    task_function. Returns None on failure, else a dict with the target
+    (negative mean KL), the steps the run simulated and whether it was
+    censored by early_abort; the target of a censored run is the negative
+    lower bound of its mean KL.
+    """
+    res = task_function(**task["params"], env=env, **options)
+    if res is None:
+        return None
+    censored = getattr(res, "censored", False)
+    if censored:
+        target = -res.lower_bound
+    else:
+        target = -np.sum(res) / len(res)
+    return {
+        "target": target,
+        "steps_run": getattr(res, "steps_run", None),
+        "censored": censored,
+    }
+
+
+def register_result(
+    optimizer, suggester, params, target, failure_penalty=None, targets=()
 ):
-    while not task_done_event.is_set():
-        result = result_queue.get()
-        if result is None:
-            break
-        params = result["params"]
-        target = result["target"]
-
-        with lock:
-            optimizer.register(params=params, target=target)
-            with task_count.get_lock():
-                while task_count.value < total_task_num:
-                    new_params = optimizer.suggest(util)
-                    round_new_params = round_dic_data(new_params)
-                    # Check for duplicates
-                    if params_to_tuple(round_new_params) not in issued_params_set:
-                        task_queue.put({"params": round_new_params})
-                        issued_params_set.add(
-                            params_to_tuple(round_new_params))
-                        task_count.value += 1
-                        break
-                    else:
-                        print(
-                            f"Duplicate params detected: {round_new_params}. Skipping new task."
-                        )
-                else:
-                    task_done_event.set()
-        result_queue.task_done()
+    """
+    Register a finished evaluation and release its pending point; needs the
+    optimizer lock. A failed (None) or non-finite target is replaced by the
+    failure penalty, so the surrogate learns to avoid the region; without
+    one, by the worst of targets, the results of this run so far. Warm-start
+    results are not among them, they only inform the surrogate.
+    """
+    if target is None or not np.isfinite(target):
+        if failure_penalty is not None:
+            target = -failure_penalty
+        elif len(targets):
+            target = float(np.min(targets))
+        else:
+            target = None
+    if target is not None:
+        optimizer.register(params=params, target=target)
+    suggester.complete(params, target)
+
+
+def log_path_of(log):
+    """A log file path, or the name of a log in LOG_DIR like get_best_param."""
+    if os.path.isfile(log):
+        return log
+    return os.path.join(LOG_DIR, log + ".log")
+
+
+def replay_logs(optimizer, logs, issued_params_set):
+    """
+    Register the results of JSONLogger files with the optimizer.
+
+    Parameters are rounded like new suggestions and registered once; entries
+    that lack a parameter of the optimizer, lie outside its bounds or whose
+    target is not finite are skipped. Returns the registered targets.
+    """
+    keys = set(optimizer.space.keys)
+    bounds = dict(zip(optimizer.space.keys, optimizer.space.bounds))
+    replayed = []
+    for log in logs:
+        with open(log_path_of(log)) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if not keys <= set(entry["params"]) or not np.isfinite(
+                    entry["target"]
+                ):
+                    continue
+                params = round_dic_data({k: entry["params"][k] for k in keys})
+                if any(
+                    not bounds[k][0] <= value <= bounds[k][1]
+                    for k, value in params.items()
+                ):
+                    continue
+                key = params_to_tuple(params)
+                if key in issued_params_set:
+                    continue
+                issued_params_set.add(key)
+                optimizer.register(params=params, target=entry["target"])
+                replayed.append(entry["target"])
+    return replayed
 
 
 def bayesian_optimize(
@@ -89,17 +149,116 @@ def bayesian_optimize(
     env="merge",
     log_name=None,
     cpu_count=int(multiprocessing.cpu_count()) - 4,
+    backend="traci",
+    cache=True,
+    reuse_sumo=True,
+    streaming=False,
+    fidelity=None,
+    early_abort=None,
+    horizon=None,
+    prefetch=2,
+    liar="min",
+    surrogate="exact",
+    warm_start=(),
+    resume=None,
+    task_timeout=1800,
+    retries=2,
+    failure_penalty=None,
+    pool=None,
+    weight=1.0,
+    priority=0,
+    store=True,
 ):
+    """
+    Args:
+        max_iteration (int): Number of evaluations
+        cpu_count (int): Number of worker processes, or of evaluations kept
+            in flight when running on a shared pool
+        cache (bool | EvaluationCache): Evaluation store checked before every
+            simulation, True for the default store under output/, False to
+            always simulate. Pools of remote workers (distributed.WorkBroker)
+            cannot share it; True then means no cache and a store raises
+            ValueError.
+        reuse_sumo (bool): Keep one SUMO instance per worker process and load
+            every candidate into it instead of starting SUMO per evaluation
+        streaming (bool): Accumulate the distributions online while the
+            simulation runs instead of keeping the recorded rows, see
+            online_stats
+        fidelity (SuccessiveHalving): Score candidates at shorter horizons
+            first and only simulate the promising ones to the end; the
+            optimizer then sees the KL of the rung a candidate reached. Its
+            rung scores are recorded under the name of the log, a resumed
+            run continues them. Not available on a pool of remote workers.
+        early_abort (EarlyAbort): Stop runs that are clearly worse than the
+            best mean KL found so far; its threshold is replaced by a value
+            shared with the workers and updated after every result. A
+            stopped run is registered with the lower bound of its mean KL
+            and marked censored in the result store.
+        horizon (AdaptiveHorizon): End runs once their distributions have
+            converged, SIM_STEP is then the upper limit
+        prefetch (int): Points queued beyond one per worker, so a worker
+            that finishes gets its next point without waiting for the
+            acquisition
+        liar (str): Target assumed for pending points while choosing new
+            ones, see batch_acquisition.PendingAwareSuggester
+        surrogate (str): 'exact' for the global GP of bayes_opt, 'turbo' for
+            trust-region local GPs whose cost does not grow with the run (see
+            surrogate.TrustRegionGP); the time of every suggestion is written
+            to a _latency.csv next to the log
+        warm_start (list): Logs (paths or names in LOG_DIR) of earlier runs,
+            e.g. of the unmodified scenario; their results are registered
+            before the first suggestion and do not count towards
+            max_iteration
+        resume (str): Log of an interrupted run to continue. Its results
+            count towards max_iteration, new results are appended to it, and
+            the points that were in flight (saved in its _pending.json) are
+            evaluated first.
+        task_timeout (float): Wall-clock seconds after which an evaluation
+            is killed together with its SUMO process; its worker is replaced
+        retries (int): Additional attempts of a failed or timed-out
+            evaluation
+        failure_penalty (float): Mean KL registered for candidates that
+            failed on every attempt or scored a non-finite KL; None uses the
+            worst mean KL of this run so far (including a resumed log, but
+            not the warm_start logs)
+        pool (TaskScheduler): Started worker pool shared with other
+            campaigns; a private pool of cpu_count workers if None
+        weight (float): Share of a shared pool, see TaskScheduler.campaign
+        priority (int): Priority on a shared pool
+        store (bool | ResultStore): Result store every registered result is
+            added to, besides the JSON log; True for the default store under
+            output/, False for none. The run is named like the log.
+    """
     if not log_name:
         log_name = env
+    remote = pool is not None and not pool.local
+    if remote and (fidelity is not None or isinstance(cache, EvaluationCache)):
+        raise ValueError(
+            "fidelity and an explicit cache need the SQLite stores of this "
+            "host, which the agents of a distributed pool cannot share"
+        )
+    if cache is True and not remote:
+        cache = EvaluationCache()
+    elif cache is True or cache is False:
+        cache = None
     lock = threading.Lock()
     issued_params_set = set()
-    date_time = str(time.strftime("%Y-%m-%d_%H:%M"))
-    logger = JSONLogger(path=f"../log/{log_name}_{date_time}.log")
-    task_queue = multiprocessing.JoinableQueue()
-    result_queue = multiprocessing.JoinableQueue()
-    task_done_event = multiprocessing.Event()
+    if resume:
+        log_path = log_path_of(resume)
+    else:
+        date_time = str(time.strftime("%Y-%m-%d_%H:%M"))
+        log_path = os.path.join(LOG_DIR, f"{log_name}_{date_time}.log")
+    run_name = os.path.splitext(os.path.basename(log_path))[0]
+    checkpoint = os.path.splitext(log_path)[0] + "_pending.json"
+    task_done_event = threading.Event()
     task_count = multiprocessing.Value("i", 0)
+    incumbent = None
+    if fidelity is not None:
+        fidelity = fidelity.for_study(run_name, reset=not resume)
+        fidelity.prune()
+    if early_abort is not None:
+        incumbent = multiprocessing.Value("d", float("inf"))
+        early_abort.threshold = incumbent
 
     optimizer = BayesianOptimization(
         f=None,
@@ -108,54 +267,125 @@ def bayesian_optimize(
         random_state=1,
     )
 
+    # the incumbent and the default failure penalty come from the results of
+    # this run only; warm-start results only inform the surrogate
+    targets = replay_logs(optimizer, [log_path], issued_params_set) if resume else []
+    replay_logs(optimizer, warm_start, issued_params_set)
+    remaining = max_iteration - len(targets)
+    if len(optimizer.space):
+        print(f"Replayed {len(optimizer.space)} results, {len(targets)} of this run.")
+    if incumbent is not None and targets:
+        incumbent.value = -max(targets)
+    # replayed results are already in their logs
+    logger = JSONLogger(path=log_path, reset=not resume)
     optimizer.subscribe(Events.OPTIMIZATION_STEP, logger)
+    if store is True:
+        store = ResultStore()
+    if store:
+        # a resumed run from before the store starts with its log
+        run_id = store.open_run(
+            run_name,
+            env,
+            log=log_path if resume else None,
+            reset=not resume,
+        )
+        result_logger = ResultLogger(store, run_id, env)
+        optimizer.subscribe(Events.OPTIMIZATION_STEP, result_logger)
     util = UtilityFunction(kind="ucb", kappa=kp, xi=xi)
+    n_in_flight = cpu_count + prefetch
+    suggester = PendingAwareSuggester(
+        optimizer,
+        util,
+        lock,
+        issued_params_set,
+        n_initial=0 if len(optimizer.space) else min(n_in_flight, remaining),
+        liar=liar,
+        surrogate=surrogate,
+        latency_log=os.path.splitext(log_path)[0] + "_latency.csv",
+        checkpoint=checkpoint,
+        initial=load_pending(checkpoint) if resume else (),
+    )
 
-    for _ in range(cpu_count):
-        with lock:
-            initial_params = optimizer.suggest(util)
-        task_queue.put({"params": initial_params})
-
-    init_process = []
-    for _ in range(cpu_count):
-        p = multiprocessing.Process(
-            target=execute_task, args=(
-                task_queue, result_queue, task_done_event, env)
-        )
-        init_process.append(p)
-        p.start()
-
-    result_thread = threading.Thread(
-        target=result_handler,
-        args=(
-            result_queue,
-            optimizer,
-            util,
-            task_queue,
-            task_count,
-            max_iteration,
-            task_done_event,
-            lock,
-            issued_params_set,
-        ),
+    own_pool = pool is None
+    if own_pool:
+        pool = TaskScheduler(cpu_count)
+        pool.start()
+    campaign = pool.campaign(
+        f"bo-{os.path.basename(log_name)}",
+        execute_task,
+        kwargs={
+            "env": env,
+            "backend": backend,
+            "cache": cache,
+            "reuse_sumo": reuse_sumo,
+            "streaming": streaming,
+            "fidelity": fidelity,
+            "early_abort": early_abort,
+            "horizon": horizon,
+        },
+        weight=weight,
+        priority=priority,
+        timeout=task_timeout,
+        retries=retries,
     )
-    result_thread.daemon = True
-    result_thread.start()
+    feeder_thread = threading.Thread(
+        target=suggester.feed,
+        args=(campaign.submit, task_count, remaining, n_in_flight, task_done_event),
+        daemon=True,
+    )
+    feeder_thread.start()
 
     print(
         f"Starting Bayesian Optimization with {cpu_count} parallel processes.")
 
+    # results are registered here, new points are issued by the feeder thread
+    finished = 0
     try:
-        while task_count.value < max_iteration and not task_done_event.is_set():
-            time.sleep(1)
+        while finished < remaining:
+            if suggester.error is not None:
+                raise suggester.error
+            for task, outcome in campaign.results(timeout=1):
+                outcome = outcome or {
+                    "target": None,
+                    "steps_run": None,
+                    "censored": False,
+                }
+                with lock:
+                    if store:
+                        result_logger.annotate(
+                            steps_run=outcome["steps_run"],
+                            censored=outcome["censored"],
+                        )
+                    register_result(
+                        optimizer,
+                        suggester,
+                        task["params"],
+                        outcome["target"],
+                        failure_penalty,
+                        targets,
+                    )
+                    target = outcome["target"]
+                    if target is not None and np.isfinite(target):
+                        targets.append(target)
+                        if incumbent is not None:
+                            incumbent.value = -max(targets)
+                finished += 1
     except KeyboardInterrupt:
+        pass
+    finally:
         task_done_event.set()
+        feeder_thread.join()
+        print(f"Campaign {campaign.name}: {campaign.stats()}")
+        campaign.close()
+        if own_pool:
+            pool.shutdown()
 
-    result_thread.join()
     print("All result handling finished.")
-    for p in init_process:
-        if p.is_alive():
-            p.terminate()
+    print(f"Suggestion latency: {suggester.latency_stats()}")
+    if cache is not None:
+        print(f"Evaluation cache: {cache.stats()}")
+    if fidelity is not None:
+        print(f"Candidates per rung: {fidelity.stats(env)}")
     return
 
 
@@ -0,0 +1,174 @@
+"""
+Throughput benchmarks for the simulation and evaluation hot paths.
+
+Each benchmark runs the same workload through the alternative code paths and
+prints the timings side by side. The simulation benchmarks use a finished
+workspace under output/data_raw, so demand generation is not part of the
+measurement.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from highway_env import run_calibrate_sim, SimulationServer
+from util import OUTPUT_DIR
+import glob
+import pickle
+from process_data import (
+    fft_kde,
+    kde_on_grid,
+    cal_kl_divergence,
+    batch_kl_divergence,
+)
+
+
+def scratch_copy(env):
+    """Copy a finished workspace so benchmark runs never touch output/."""
+    scratch_dir = tempfile.mkdtemp(prefix=f"bench_{env}_")
+    shutil.copytree(
+        os.path.join(OUTPUT_DIR, "data_raw", env), scratch_dir, dirs_exist_ok=True
+    )
+    return scratch_dir
+
+
+def bench_record_modes(env="merge", sim_step=3000, hot_time=0):
+    """Compare steps/sec of subscription based and per-vehicle recording."""
+    config_path = scratch_copy(env)
+    results = {}
+    try:
+        for record_mode in ["poll", "subscription"]:
+            start = time.perf_counter()
+            run_calibrate_sim(
+                config_path=config_path,
+                sim_step=sim_step,
+                record_mode=record_mode,
+                hot_time=hot_time,
+            )
+            elapsed = time.perf_counter() - start
+            results[record_mode] = sim_step / elapsed
+            print(
+                f"{record_mode:>12}: {sim_step / elapsed:8.1f} steps/s ({elapsed:.1f} s)"
+            )
+    finally:
+        shutil.rmtree(config_path)
+    print(f"{'speedup':>12}: {results['subscription'] / results['poll']:8.2f}x")
+    return results
+
+
+def bench_backends(env="merge", sim_step=3000, hot_time=0):
+    """Compare steps/sec of the TraCI socket and the in-process libsumo backend."""
+    config_path = scratch_copy(env)
+    results = {}
+    try:
+        for backend in ["traci", "libsumo"]:
+            start = time.perf_counter()
+            run_calibrate_sim(
+                config_path=config_path,
+                sim_step=sim_step,
+                hot_time=hot_time,
+                backend=backend,
+            )
+            elapsed = time.perf_counter() - start
+            results[backend] = sim_step / elapsed
+            print(f"{backend:>12}: {sim_step / elapsed:8.1f} steps/s ({elapsed:.1f} s)")
+    finally:
+        shutil.rmtree(config_path)
+    print(f"{'speedup':>12}: {results['libsumo'] / results['traci']:8.2f}x")
+    return results
+
+
+def bench_server_reuse(env="merge", sim_step=300, runs=5, hot_time=0):
+    """Compare seconds per short run with a fresh SUMO and a reused one."""
+    config_path = scratch_copy(env)
+    results = {}
+    server = SimulationServer()
+    try:
+        for mode in ["start", "load"]:
+            start = time.perf_counter()
+            for _ in range(runs):
+                run_calibrate_sim(
+                    config_path=config_path,
+                    sim_step=sim_step,
+                    hot_time=hot_time,
+                    sinks=(),
+                    server=server if mode == "load" else None,
+                )
+            elapsed = (time.perf_counter() - start) / runs
+            results[mode] = elapsed
+            print(f"{mode:>12}: {elapsed:8.2f} s/run")
+    finally:
+        server.close()
+        shutil.rmtree(config_path)
+    print(f"{'speedup':>12}: {results['start'] / results['load']:8.2f}x")
+    return results
+
+
+def bench_kde(
+    sizes=(10, 20, 30, 50, 100, 200, 500, 1000, 2000, 5000, 20000, 100000, 500000),
+    seed=0,
+    repeat=5,
+):
+    """
+    Compare gaussian_kde with fft_kde on a 1000-point grid across sample
+    sizes; the error is the largest deviation relative to the peak density.
+    Times are the best of repeat calls, the small sizes take well below a
+    millisecond.
+    """
+    rng = np.random.default_rng(seed)
+    results = {}
+    print(f"{'samples':>9} {'exact s':>9} {'fft s':>9} {'speedup':>8} {'max err':>9}")
+    for n in sizes:
+        # bimodal, skewed sample like the acceleration distributions
+        data = np.concatenate(
+            [rng.normal(0, 0.3, n - n // 4), rng.gamma(2.0, 0.5, n // 4) - 2]
+        )
+        kde_x = np.linspace(data.min(), data.max(), 1000)
+        exact_time = fft_time = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            exact = kde_on_grid(data, kde_x, kde="exact")
+            exact_time = min(exact_time, time.perf_counter() - start)
+            start = time.perf_counter()
+            binned = fft_kde(data, kde_x)
+            fft_time = min(fft_time, time.perf_counter() - start)
+        error = np.abs(binned - exact).max() / exact.max()
+        results[n] = (exact_time, fft_time, error)
+        print(
+            f"{n:>9} {exact_time:>9.4f} {fft_time:>9.4f} "
+            f"{exact_time / fft_time:>7.1f}x {error:>9.1e}"
+        )
+    return results
+
+
+def bench_kl(candidates=3000):
+    """Score many cached distributions one by one and in one batch."""
+    paths = sorted(glob.glob(f"{OUTPUT_DIR}/data_raw/*/_cache.pkl"))
+    caches = []
+    for path in paths:
+        with open(path, "rb") as f:
+            caches.append(pickle.load(f))
+    with open(f"{OUTPUT_DIR}/data_cache/merge_cache.pkl", "rb") as f:
+        reference = pickle.load(f)
+    stack = [caches[i % len(caches)] for i in range(candidates)]
+    variables, vehicle_types = ["xAcceleration", "dhw", "xVelocity"], ["car", "bus"]
+    start = time.perf_counter()
+    for cache in stack:
+        cal_kl_divergence(reference, cache, variables, vehicle_types)
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    batch_kl_divergence(reference, stack, variables, vehicle_types)
+    batch_time = time.perf_counter() - start
+    print(f"{'loop':>12}: {loop_time:8.2f} s for {candidates} candidates")
+    print(f"{'batch':>12}: {batch_time:8.2f} s")
+    print(f"{'speedup':>12}: {loop_time / batch_time:8.2f}x")
+    return loop_time, batch_time
+
+
+if __name__ == "__main__":
+    bench_record_modes(env="merge")
+    bench_backends(env="merge")
+    bench_server_reuse(env="merge")
+    bench_kde()
+    bench_kl()
@@ -0,0 +1,376 @@
+"""
+Multi-node evaluation: a work broker in the coordinator and worker agents.
+
+The coordinator keeps the optimizer state (BO or pymoo) and runs a WorkBroker
+instead of a local TaskScheduler. It has the same campaign interface, so
+bayesian_optimize(pool=broker) and CampaignRunner(broker, ...) work unchanged,
+but its slots are the worker processes of agents on any number of hosts. An
+agent connects over TCP (multiprocessing.managers), registers its slots and
+starts one process per slot that pulls tasks from the broker, evaluates them
+locally (SUMO_task and the KL step) and reports the result back.
+
+Failures are handled like in the local scheduler, with heartbeats standing in
+for process liveness:
+
+- an agent that misses its heartbeats for heartbeat_timeout seconds is
+  dropped and the tasks of its slots are retried elsewhere; if it comes back
+  it registers again with fresh slots;
+- a task that exceeds the timeout of its campaign is retried, and its slot is
+  cancelled with the next heartbeat, which kills the process and its SUMO
+  children;
+- a slot process that dies is replaced by its agent, and the attempt it was
+  running is retried when the replacement asks for work.
+
+Every agent host needs the same code and a copy of the reference data the
+evaluations read (output/data_cache). The SQLite stores of the coordinator
+(evaluation cache, rung scores of SuccessiveHalving) are not available to the
+agents, and SQLite in WAL mode must not be shared over a network filesystem,
+so campaigns on a WorkBroker run without the evaluation cache and refuse
+fidelity; the result store is only written by the coordinator and works as
+usual.
+
+Tasks and results are pickles, and unpickling runs code, so anyone who can
+connect with the authkey can run code on the coordinator and the agents. The
+broker listens on localhost unless another host is given, e.g. 0.0.0.0 for
+all interfaces; only do that on a network of trusted hosts. Without --authkey
+the coordinator generates a random key and prints it; agents must pass it.
+The data is not encrypted.
+
+Usage, all from src/:
+
+    python distributed.py coordinator --host 0.0.0.0 --port 50000
+    python distributed.py agent --address coordinator-host:50000 --slots 32 \\
+        --authkey <key printed by the coordinator>
+"""
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import secrets
+import socket
+import threading
+import time
+from multiprocessing.managers import BaseManager
+from util import handle_exception
+from scheduler import TaskScheduler
+
+AGENT_METHODS = ("register_agent", "heartbeat", "fetch", "report")
+
+
+class BrokerManager(BaseManager):
+    pass
+
+
+BrokerManager.register("broker", exposed=AGENT_METHODS)
+
+
+class WorkBroker(TaskScheduler):
+    """
+    TaskScheduler whose slots are the processes of remote agents.
+
+    Slots are (agent id, slot) pairs; tasks are pulled by the agents instead
+    of being pushed to an inbox, and among the campaigns they are handed out
+    by the same priority and weight rule.
+
+    Args:
+        address (tuple): (host, port) to listen on; port 0 picks a free port,
+            see address after start()
+        authkey (bytes): Shared secret of coordinator and agents, a random
+            one (see authkey after start()) if None
+        heartbeat_timeout (float): Seconds without a heartbeat after which an
+            agent is considered dead
+    """
+
+    # the agents do not share the SQLite stores of the coordinator
+    local = False
+
+    def __init__(
+        self, address=("localhost", 50000), authkey=None, heartbeat_timeout=30
+    ):
+        super().__init__(n_workers=0)
+        self.address = address
+        self.generated_authkey = authkey is None
+        self.authkey = authkey or secrets.token_hex(16).encode()
+        self.heartbeat_timeout = heartbeat_timeout
+        self.agents = {}
+        self.agent_ids = itertools.count()
+        self.available = threading.Condition(self.lock)
+        self.manager_server = None
+        self.slot_seconds = 0.0
+        self.accounted = None
+        self.counts = {"timeouts": 0, "lost_agents": 0}
+
+    def start(self):
+        """Listen for agents and start the thread that watches them."""
+        self.started = self.accounted = time.time()
+        # a subclass per broker, so every broker serves its own object
+        manager = type("BrokerServer", (BrokerManager,), {})
+        manager.register("broker", callable=lambda: self, exposed=AGENT_METHODS)
+        self.manager_server = manager(
+            address=self.address, authkey=self.authkey
+        ).get_server()
+        self.address = self.manager_server.address
+        threading.Thread(target=self.manager_server.serve_forever, daemon=True).start()
+        self.server = threading.Thread(target=self.serve, daemon=True)
+        self.server.start()
+        print(f"Work broker listening on {self.address[0]}:{self.address[1]}.")
+        if self.generated_authkey:
+            print(f"Agents connect with --authkey {self.authkey.decode()}")
+
+    def resize(self, delta):
+        """Add delta slots, accounting the slot time so far; needs lock."""
+        now = time.time()
+        self.slot_seconds += self.n_workers * (now - self.accounted)
+        self.accounted = now
+        self.n_workers += delta
+
+    def capacity(self):
+        """Slot seconds of all agents since start(); needs lock."""
+        self.resize(0)
+        return self.slot_seconds
+
+    def register_agent(self, host, n_slots):
+        """Called by an agent; returns the id it identifies itself with."""
+        with self.lock:
+            agent_id = next(self.agent_ids)
+            self.agents[agent_id] = {
+                "host": host,
+                "slots": n_slots,
+                "seen": time.time(),
+                "cancel": set(),
+            }
+            self.resize(n_slots)
+            print(f"Agent {agent_id} on {host} joined with {n_slots} slots.")
+            return agent_id
+
+    def heartbeat(self, agent_id):
+        """
+        Called by an agent every few seconds. The reply tells it whether it
+        is still registered, whether to stop and which slots to kill.
+        """
+        with self.lock:
+            reply = {"registered": False, "stop": self.stopped.is_set(), "cancel": []}
+            agent = self.agents.get(agent_id)
+            if agent is not None:
+                agent["seen"] = time.time()
+                reply.update(registered=True, cancel=sorted(agent["cancel"]))
+                agent["cancel"].clear()
+            return reply
+
+    def fetch(self, agent_id, slot, timeout=1):
+        """
+        Called by a slot process for its next (function, kwargs, task);
+        None if there was no work within timeout seconds.
+        """
+        with self.available:
+            key = (agent_id, slot)
+            # a slot asking for work lost whatever it was running before
+            if key in self.running:
+                self.abandon(key)
+            campaign = None
+            if agent_id in self.agents:
+                campaign = self.next_campaign()
+            if campaign is None:
+                self.available.wait(timeout)
+                if agent_id in self.agents:
+                    campaign = self.next_campaign()
+            if campaign is None:
+                return None
+            task = campaign.backlog.popleft()
+            campaign.running += 1
+            self.running[key] = (task["id"], task["attempt"], time.time())
+            return campaign.function, campaign.kwargs, task
+
+    def report(self, agent_id, slot, task_id, attempt, result):
+        """Called by a slot process with the result of a task."""
+        with self.lock:
+            self.deliver((agent_id, slot), task_id, attempt, result)
+            self.dispatch()
+
+    def dispatch(self):
+        """Wake the slots waiting for work; needs lock."""
+        self.available.notify_all()
+
+    def poll(self, timeout=1):
+        self.stopped.wait(timeout)
+        with self.lock:
+            self.recover()
+            self.dispatch()
+
+    def drop_agent(self, agent_id):
+        """Forget an agent and retry the tasks of its slots; needs lock."""
+        for key in [key for key in self.running if key[0] == agent_id]:
+            self.abandon(key)
+        agent = self.agents.pop(agent_id)
+        self.resize(-agent["slots"])
+        self.counts["lost_agents"] += 1
+
+    def recover(self):
+        """Drop silent agents and retry timed-out tasks; needs lock."""
+        now = time.time()
+        for agent_id, agent in list(self.agents.items()):
+            if now - agent["seen"] > self.heartbeat_timeout:
+                print(f"Agent {agent_id} on {agent['host']} stopped responding.")
+                self.drop_agent(agent_id)
+        for key, (task_id, _, started) in list(self.running.items()):
+            task = self.tasks.get(task_id)
+            campaign = task and self.campaigns.get(task["campaign"])
+            if campaign is None or campaign.timeout is None:
+                continue
+            if now - started > campaign.timeout:
+                self.counts["timeouts"] += 1
+                print(
+                    f"Task {task_id} of {campaign.name} timed out after "
+                    f"{campaign.timeout}s on agent {key[0]}."
+                )
+                self.abandon(key)
+                self.agents[key[0]]["cancel"].add(key[1])
+
+    def stats(self):
+        with self.lock:
+            stats = super().stats()
+            stats["agents"] = {
+                agent_id: {"host": agent["host"], "slots": agent["slots"]}
+                for agent_id, agent in self.agents.items()
+            }
+            return stats
+
+    def shutdown(self, timeout=10):
+        """Stop listening; agents stop once they lose the connection."""
+        self.stopped.set()
+        with self.available:
+            self.available.notify_all()
+        if self.server is not None:
+            self.server.join()
+        if self.manager_server is not None:
+            self.manager_server.stop_event.set()
+            self.manager_server.listener.close()
+
+
+def connect(address, authkey):
+    """Proxy of the WorkBroker listening on address (host, port)."""
+    manager = BrokerManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.broker()
+
+
+def agent_slot(address, authkey, agent_id, slot, parent):
+    """Body of a slot process of an agent: pull, evaluate and report tasks."""
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+    try:
+        broker = connect(address, authkey)
+        while os.getppid() == parent:
+            message = broker.fetch(agent_id, slot)
+            if message is None:
+                continue
+            function, kwargs, task = message
+            result = None
+            try:
+                result = function(task, **kwargs)
+            except Exception as e:
+                handle_exception(e)
+            broker.report(agent_id, slot, task["id"], task["attempt"], result)
+    except (EOFError, OSError):
+        # the coordinator is gone; the agent notices with its next heartbeat
+        pass
+
+
+def run_agent(address, authkey, n_slots=None, heartbeat=5):
+    """
+    Serve a coordinator until it shuts down or becomes unreachable.
+
+    Args:
+        address (tuple): (host, port) of the WorkBroker
+        authkey (bytes): Shared secret of coordinator and agents
+        n_slots (int): Evaluations run at the same time, the CPU count minus
+            4 if None
+        heartbeat (float): Seconds between heartbeats; keep it well below the
+            heartbeat_timeout of the broker
+    """
+    n_slots = n_slots or max(1, multiprocessing.cpu_count() - 4)
+    host = socket.gethostname()
+    broker = connect(address, authkey)
+    agent_id = broker.register_agent(host, n_slots)
+    children = {}
+
+    def spawn(slot):
+        children[slot] = multiprocessing.Process(
+            target=agent_slot, args=(address, authkey, agent_id, slot, os.getpid())
+        )
+        children[slot].start()
+
+    print(f"Agent {agent_id} serving {address[0]}:{address[1]} with {n_slots} slots.")
+    try:
+        for slot in range(n_slots):
+            spawn(slot)
+        while True:
+            time.sleep(heartbeat)
+            try:
+                reply = broker.heartbeat(agent_id)
+            except (EOFError, OSError):
+                print("Lost the connection to the coordinator.")
+                break
+            if reply["stop"]:
+                break
+            if not reply["registered"]:
+                # dropped after a stall; its tasks were already retried
+                for process in children.values():
+                    TaskScheduler.kill(process)
+                agent_id = broker.register_agent(host, n_slots)
+                print(f"Registered again as agent {agent_id}.")
+                for slot in range(n_slots):
+                    spawn(slot)
+                continue
+            for slot in reply["cancel"]:
+                TaskScheduler.kill(children[slot])
+            for slot, process in list(children.items()):
+                if not process.is_alive():
+                    process.join()
+                    spawn(slot)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in children.values():
+            TaskScheduler.kill(process)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("role", choices=["coordinator", "agent"])
+    parser.add_argument("--address", default="localhost:50000", help="agent: host:port")
+    parser.add_argument(
+        "--host",
+        default="localhost",
+        help="coordinator: interface to listen on, 0.0.0.0 for all",
+    )
+    parser.add_argument("--port", type=int, default=50000, help="coordinator")
+    parser.add_argument("--slots", type=int, default=None, help="agent")
+    parser.add_argument(
+        "--in-flight",
+        type=int,
+        default=None,
+        help="coordinator: evaluations each BO campaign keeps in flight",
+    )
+    parser.add_argument(
+        "--authkey",
+        default=None,
+        help="shared secret; the coordinator generates one if omitted",
+    )
+    args = parser.parse_args()
+    authkey = args.authkey and args.authkey.encode()
+    if args.role == "agent":
+        if authkey is None:
+            parser.error("agents need the --authkey of the coordinator")
+        host, port = args.address.rsplit(":", 1)
+        run_agent((host, int(port)), authkey, args.slots)
+    else:
+        from main import main
+
+        broker = WorkBroker((args.host, args.port), authkey)
+        broker.start()
+        try:
+            main(pool=broker, n_core=args.in_flight)
+        finally:
+            broker.shutdown()
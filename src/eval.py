@@ -3,7 +3,8 @@ import itertools
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-from task import SUMO_task, pbounds
+from task import evaluate_params, pbounds
+from eval_cache import EvaluationCache
 import json
 from multi_object_optimization import MooSUMOProblem, SinSUMOProblem
 from multiprocessing import Pool
@@ -36,8 +37,15 @@ def find_minimal_target_value(env, algo_list):
 def gen_eval_data(min_X, env_name):
     global pbounds
     param = {key: min_X[i] for i, key in enumerate(pbounds.keys())}
-    task = SUMO_task(param, env=env_name)
-    res = task.run_task(save=True, gui=False, sim_step=1200 * 30)
+    # save runs always simulate, the cache only records the result
+    res = evaluate_params(
+        param,
+        env=env_name,
+        sim_step=1200 * 30,
+        cache=EvaluationCache(),
+        save=True,
+        gui=False,
+    )
     print(res)
 
 
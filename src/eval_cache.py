@@ -0,0 +1,302 @@
+"""
+Persistent store of finished evaluations.
+
+Every optimizer scores a parameter vector by a full SUMO run, and the same
+vectors come back across BO runs and pymoo algorithms. EvaluationCache keeps
+the KL vector of each run in an SQLite database in WAL mode, so any number of
+worker processes and threads can read and write it concurrently. Entries are
+keyed by scenario, sim_step, seed, the parameter vector rounded like
+util.round_dic_data and the evaluation mode (see evaluation_mode); the least
+recently used ones are evicted once the store exceeds max_entries.
+
+Results come back as EvaluationResult with the steps the run simulated, those
+of runs stopped by EarlyAbort as CensoredResult with their lower bound.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from util import round_dic_data, OUTPUT_DIR
+
+CACHE_PATH = os.path.join(OUTPUT_DIR, "eval_cache.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS evaluations (
+    env TEXT NOT NULL,
+    sim_step INTEGER NOT NULL,
+    seed INTEGER NOT NULL,
+    params TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    result TEXT NOT NULL,
+    steps_run INTEGER,
+    partial INTEGER NOT NULL DEFAULT 0,
+    lower_bound REAL,
+    elapsed REAL NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (env, sim_step, seed, params, mode)
+);
+CREATE INDEX IF NOT EXISTS evaluations_last_used ON evaluations (last_used);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0);
+"""
+
+
+def params_key(params, decimal_precision=4):
+    """Canonical text of a parameter vector, rounded like round_dic_data."""
+    rounded = round_dic_data(
+        {k: float(v) for k, v in params.items()}, decimal_precision
+    )
+    return json.dumps(rounded, sort_keys=True)
+
+
+def evaluation_mode(**settings):
+    """
+    Canonical text of the run settings that change the KL vector of a
+    parameter vector, e.g. streaming, hot_time or an AdaptiveHorizon.
+
+    Settings that are None or False are left out, objects are described by
+    their fingerprint() method.
+    """
+    described = {}
+    for name, value in settings.items():
+        if value is None or value is False:
+            continue
+        if hasattr(value, "fingerprint"):
+            value = value.fingerprint()
+        described[name] = value
+    return json.dumps(described, sort_keys=True)
+
+
+class EvaluationResult(list):
+    """
+    KL vector of a run and how far the run went.
+
+    steps_run is below the sim_step of the request if an AdaptiveHorizon
+    ended the converged run or a rung of SuccessiveHalving stopped it;
+    partial is set if the run stopped before its score was final.
+    """
+
+    censored = False
+
+    def __init__(self, values, steps_run=None, partial=False):
+        super().__init__(values)
+        self.steps_run = steps_run
+        self.partial = partial
+
+
+class CensoredResult(EvaluationResult):
+    """
+    KL vector of a run stopped by EarlyAbort.
+
+    The values are the provisional KL at the stop; the score of the full run
+    is only known to be above lower_bound.
+    """
+
+    censored = True
+
+    def __init__(self, values, step, lower_bound):
+        super().__init__(values, step, partial=True)
+        self.step = step
+        self.lower_bound = lower_bound
+
+
+class SQLiteStore:
+    """
+    Base of the stores shared by all workers through one SQLite file.
+
+    Connections are opened lazily per process and thread, so instances can
+    be pickled into multiprocessing workers and pymoo runners.
+
+    Args:
+        path (str): SQLite database file
+        timeout (float): Seconds to wait for a lock held by another writer
+    """
+
+    schema = ""
+
+    def __init__(self, path=CACHE_PATH, timeout=60):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def connect(self):
+        # a forked child inherits the thread-local of its parent thread, the
+        # pid check keeps it from reusing the parent's connection
+        if getattr(self._local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.migrate(conn)
+            conn.executescript(self.schema)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def migrate(self, conn):
+        """Bring the tables of an older version up to date, before the schema."""
+
+    @staticmethod
+    def columns(conn, table):
+        return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+class EvaluationCache(SQLiteStore):
+    """
+    Process- and thread-safe evaluation store.
+
+    Args:
+        path (str): SQLite database file
+        max_entries (int): Number of evaluations kept before the least
+            recently used ones are evicted
+        decimal_precision (int): Rounding of the parameter values in the key
+        timeout (float): Seconds to wait for a lock held by another writer
+    """
+
+    schema = SCHEMA
+
+    def __init__(
+        self, path=CACHE_PATH, max_entries=200000, decimal_precision=4, timeout=60
+    ):
+        super().__init__(path, timeout)
+        self.max_entries = max_entries
+        self.decimal_precision = decimal_precision
+        self.hits = 0
+        self.misses = 0
+
+    def migrate(self, conn):
+        # entries from before the mode column cannot tell how they were run
+        columns = self.columns(conn, "evaluations")
+        if columns and "mode" not in columns:
+            with conn:
+                conn.execute("DROP TABLE evaluations")
+
+    def key(self, env, sim_step, seed, params):
+        return (
+            env,
+            int(sim_step),
+            int(seed),
+            params_key(params, self.decimal_precision),
+        )
+
+    def get(self, env, sim_step, seed, params, modes=("{}",)):
+        """
+        Return the stored KL vector or None, and count the hit or miss.
+
+        Args:
+            modes (list): Acceptable evaluation modes, the first stored one
+                is returned
+        """
+        key = self.key(env, sim_step, seed, params)
+        modes = list(modes)
+        conn = self.connect()
+        with conn:
+            rows = {
+                mode: rest
+                for mode, *rest in conn.execute(
+                    "SELECT mode, result, steps_run, partial, lower_bound "
+                    "FROM evaluations "
+                    "WHERE env=? AND sim_step=? AND seed=? AND params=? "
+                    f"AND mode IN ({', '.join('?' * len(modes))})",
+                    (*key, *modes),
+                )
+            }
+            mode = next((mode for mode in modes if mode in rows), None)
+            if mode is None:
+                self.misses += 1
+                conn.execute("UPDATE counters SET value=value+1 WHERE name='misses'")
+                return None
+            self.hits += 1
+            conn.execute(
+                "UPDATE evaluations SET hits=hits+1, last_used=? "
+                "WHERE env=? AND sim_step=? AND seed=? AND params=? AND mode=?",
+                (time.time(), *key, mode),
+            )
+            conn.execute("UPDATE counters SET value=value+1 WHERE name='hits'")
+        result, steps_run, partial, lower_bound = rows[mode]
+        if lower_bound is not None:
+            return CensoredResult(json.loads(result), steps_run, lower_bound)
+        return EvaluationResult(json.loads(result), steps_run, bool(partial))
+
+    def put(self, env, sim_step, seed, params, result, elapsed, mode="{}"):
+        """
+        Store the KL vector of a run and its wall time in seconds; steps_run,
+        partial and lower_bound are kept if result is an EvaluationResult.
+
+        Args:
+            mode (str): Evaluation mode of the run, see evaluation_mode
+        """
+        key = self.key(env, sim_step, seed, params)
+        lower_bound = None
+        if getattr(result, "censored", False):
+            lower_bound = float(result.lower_bound)
+        now = time.time()
+        conn = self.connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO evaluations "
+                "(env, sim_step, seed, params, mode, result, steps_run, partial, "
+                "lower_bound, elapsed, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    *key,
+                    mode,
+                    json.dumps([float(v) for v in result]),
+                    getattr(result, "steps_run", None),
+                    int(getattr(result, "partial", False)),
+                    lower_bound,
+                    elapsed,
+                    now,
+                    now,
+                ),
+            )
+            self.evict(conn)
+
+    def evict(self, conn):
+        (count,) = conn.execute("SELECT COUNT(*) FROM evaluations").fetchone()
+        if count > self.max_entries:
+            conn.execute(
+                "DELETE FROM evaluations WHERE rowid IN ("
+                "SELECT rowid FROM evaluations ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def stats(self):
+        """Hit/miss counts of this instance and of the store over all users."""
+        conn = self.connect()
+        counters = dict(conn.execute("SELECT name, value FROM counters"))
+        entries, saved = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(hits * elapsed), 0) FROM evaluations"
+        ).fetchone()
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "total_hits": counters["hits"],
+            "total_misses": counters["misses"],
+            "hit_rate": counters["hits"] / lookups if lookups else 0.0,
+            "entries": entries,
+            "saved_seconds": saved,
+        }
+
+    def clear(self):
+        conn = self.connect()
+        with conn:
+            conn.execute("DELETE FROM evaluations")
+            conn.execute("UPDATE counters SET value=0")
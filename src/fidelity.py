@@ -0,0 +1,231 @@
+"""
+Multi-fidelity evaluation and early stopping of simulations.
+
+SuccessiveHalving runs asynchronous successive halving over the horizon of a
+run, EarlyAbort stops runs whose provisional score is already clearly worse
+than the incumbent of the optimizer; their results are returned as
+eval_cache.CensoredResult.
+
+A candidate is scored at increasing horizons (rungs) of one and the same
+simulation. At every rung its mean KL divergence is compared with the scores
+all earlier candidates reached at that rung; only the best 1/eta of them are
+promoted and simulated further, the others stop and report the KL vector of
+the rung they reached. Promotion does not wait for a batch, so it works with
+the asynchronous BO workers as well as with element-wise pymoo problems. The
+rung scores are shared by all workers through the SQLite store of eval_cache.
+"""
+
+import copy
+import json
+import time
+import numpy as np
+from eval_cache import SQLiteStore, CACHE_PATH, params_key
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rungs (
+    study TEXT NOT NULL,
+    env TEXT NOT NULL,
+    sim_step INTEGER NOT NULL,
+    seed INTEGER NOT NULL,
+    rung_step INTEGER NOT NULL,
+    params TEXT NOT NULL,
+    score REAL NOT NULL,
+    result TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rungs_lookup
+    ON rungs (study, env, sim_step, seed, rung_step);
+"""
+
+
+def mean_score(result):
+    """Scalar objective of a KL vector, as minimized by the optimizers."""
+    return float(np.sum(result) / len(result))
+
+
+class SuccessiveHalving(SQLiteStore):
+    """
+    Rung schedule and promotion rule of a multi-fidelity study.
+
+    Args:
+        fractions (list): Increasing fractions of the recorded window (the
+            steps after the warm-up) at which candidates are scored; the
+            full horizon is always the last rung
+        eta (float): A candidate is promoted if its score is within the best
+            1/eta of the scores recorded at the rung
+        min_observations (int): Scores a rung needs before it rejects
+            anything; earlier candidates are always promoted
+        study (str): Name that separates the rung scores of unrelated runs;
+            the optimizers use the name of their run, see for_study
+        path (str): SQLite database file
+    """
+
+    schema = SCHEMA
+
+    def __init__(
+        self,
+        fractions=(0.25, 0.5),
+        eta=3,
+        min_observations=10,
+        study="default",
+        path=CACHE_PATH,
+    ):
+        super().__init__(path)
+        if list(fractions) != sorted(fractions) or not all(
+            0 < f < 1 for f in fractions
+        ):
+            raise ValueError(f"fractions must increase within (0, 1): {fractions}")
+        if eta <= 1:
+            raise ValueError(f"eta must be larger than 1: {eta}")
+        self.fractions = list(fractions)
+        self.eta = eta
+        self.min_observations = min_observations
+        self.study = study
+
+    def fingerprint(self):
+        """Settings that decide where a run stops, see eval_cache.evaluation_mode."""
+        return {
+            "fractions": self.fractions,
+            "eta": self.eta,
+            "min_observations": self.min_observations,
+        }
+
+    def for_study(self, study, reset=False):
+        """
+        Copy of this schedule that records its rung scores under study.
+
+        Args:
+            study (str): Name of the study, e.g. the name of a run
+            reset (bool): Drop the scores recorded under study before
+        """
+        schedule = copy.copy(self)
+        schedule.study = study
+        if reset:
+            conn = schedule.connect()
+            with conn:
+                conn.execute("DELETE FROM rungs WHERE study=?", (study,))
+        return schedule
+
+    def prune(self, keep=20):
+        """
+        Drop the rung scores of all but the keep most recently used studies;
+        the study of this schedule is always kept. Returns the rows deleted.
+        """
+        conn = self.connect()
+        with conn:
+            return conn.execute(
+                "DELETE FROM rungs WHERE study!=? AND study NOT IN ("
+                "SELECT study FROM rungs GROUP BY study "
+                "ORDER BY MAX(created) DESC LIMIT ?)",
+                (self.study, keep),
+            ).rowcount
+
+    def rung_steps(self, sim_step, hot_time):
+        """Simulation steps at which the intermediate rungs are scored."""
+        window = sim_step - hot_time
+        return [hot_time + int(round(f * window)) for f in self.fractions]
+
+    def promote(self, env, sim_step, seed, rung_step, params, result):
+        """Record the KL vector of a rung and return whether to continue."""
+        score = mean_score(result)
+        if not np.isfinite(score):
+            # SQLite stores NaN as NULL
+            score = float("inf")
+        key = (self.study, env, int(sim_step), int(seed), int(rung_step))
+        conn = self.connect()
+        with conn:
+            scores = np.array(
+                conn.execute(
+                    "SELECT score FROM rungs WHERE study=? AND env=? "
+                    "AND sim_step=? AND seed=? AND rung_step=?",
+                    key,
+                ).fetchall(),
+                dtype=float,
+            ).ravel()
+            conn.execute(
+                "INSERT INTO rungs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    *key,
+                    params_key(params),
+                    score,
+                    json.dumps([float(v) for v in result]),
+                    time.time(),
+                ),
+            )
+        if not np.isfinite(score):
+            return False
+        scores = np.append(scores[np.isfinite(scores)], score)
+        if len(scores) < self.min_observations:
+            return True
+        return score <= np.quantile(scores, 1 / self.eta)
+
+    def stats(self, env=None):
+        """
+        Candidates scored per rung step; the count of a rung is the number
+        promoted by the rung before it.
+        """
+        conn = self.connect()
+        query = "SELECT rung_step, COUNT(*) FROM rungs WHERE study=?"
+        args = [self.study]
+        if env is not None:
+            query += " AND env=?"
+            args.append(env)
+        return dict(conn.execute(query + " GROUP BY rung_step", args).fetchall())
+
+
+class EarlyAbort:
+    """
+    Stop runs whose provisional score is clearly worse than a threshold.
+
+    Every interval steps the KL vector of the rows recorded so far is scored.
+    The final mean KL is assumed to be at least (1 - margin) times the
+    provisional one; the run stops once that bound exceeds the threshold.
+
+    Args:
+        threshold (float | multiprocessing.Value): Mean KL the candidate must
+            be able to reach, usually the incumbent of the optimizer. A shared
+            Value lets the optimizer tighten it while workers are running;
+            None or inf never aborts.
+        interval (int): Simulation steps between checkpoints
+        min_fraction (float): Fraction of the recorded window simulated
+            before the first checkpoint
+        margin (float): Relative slack between provisional and final score
+    """
+
+    def __init__(self, threshold=None, interval=1500, min_fraction=0.25, margin=0.3):
+        self.threshold = threshold
+        self.interval = interval
+        self.min_fraction = min_fraction
+        self.margin = margin
+
+    def __getstate__(self):
+        # a shared Value cannot be pickled for a scheduler task or a remote
+        # agent; those get the threshold current when the task is handed out
+        state = self.__dict__.copy()
+        state["threshold"] = self.current_threshold()
+        return state
+
+    def fingerprint(self):
+        # the threshold moves during a run, evaluate_params checks it instead
+        return {
+            "interval": self.interval,
+            "min_fraction": self.min_fraction,
+            "margin": self.margin,
+        }
+
+    def current_threshold(self):
+        threshold = getattr(self.threshold, "value", self.threshold)
+        return None if threshold is None else float(threshold)
+
+    def checkpoints(self, sim_step, hot_time):
+        first = hot_time + int(round(self.min_fraction * (sim_step - hot_time)))
+        return list(range(first, sim_step, self.interval))
+
+    def lower_bound(self, result):
+        return mean_score(result) * (1 - self.margin)
+
+    def should_abort(self, result):
+        threshold = self.current_threshold()
+        if threshold is None or not np.isfinite(threshold):
+            return False
+        return self.lower_bound(result) > threshold
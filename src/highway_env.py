@@ -1,65 +1,276 @@
+import atexit
 import gym
-import numpy as np
 import os
 import sys
-from util import handle_exception
+import threading
+import uuid
+from util import handle_exception, OUTPUT_DIR
 from sumolib import checkBinary
 import traci
-import csv
+import traci.constants as tc
+from recorder import TrajectoryRecorder
+
+# traci.start picks a free port and registers the connection in module-level
+# state, which is not safe to do from several threads at once.
+_start_lock = threading.Lock()
+
+# Variables delivered by the edge context subscription of the record area.
+# VAR_ROAD_ID is only used to drop neighbours that fall inside the context
+# range but are not on the record edge.
+CONTEXT_VARS = [
+    tc.VAR_ROAD_ID,
+    tc.VAR_SPEED,
+    tc.VAR_SPEED_LAT,
+    tc.VAR_ACCELERATION,
+    tc.VAR_LENGTH,
+]
+
+
+def load_backend(backend="traci"):
+    """
+    Return the module used to drive SUMO.
+
+    'traci' talks to a sumo child process over a socket, 'libsumo' runs SUMO
+    inside the calling process. libsumo allows a single simulation per
+    process and has no GUI.
+    """
+    if backend == "traci":
+        return traci
+    if backend == "libsumo":
+        import libsumo
+
+        return libsumo
+    raise ValueError(f"unknown backend: {backend}")
+
+
+class SimulationServer:
+    """
+    SUMO instance kept alive across runs.
+
+    The first open() starts SUMO, later ones replace the simulation with
+    load(), which skips the process spawn and connection setup. If SUMO died
+    or the load fails, the instance is restarted.
+
+    Args:
+        backend (str): 'traci' or 'libsumo', see load_backend
+        gui (bool): Drive sumo-gui instead of sumo
+    """
+
+    def __init__(self, backend="traci", gui=False):
+        if gui and backend == "libsumo":
+            raise ValueError("libsumo cannot drive sumo-gui, use backend='traci'")
+        self.backend = backend
+        self.gui = gui
+        self.module = load_backend(backend)
+        self.sim = None
+        self.starts = 0
+        self.loads = 0
+
+    def start(self, args):
+        sumoBinary = checkBinary("sumo-gui") if self.gui else checkBinary("sumo")
+        cmd = [sumoBinary] + args
+        if self.backend == "traci":
+            # every server drives its own labelled connection instead of the
+            # module default, so simulations may run on several threads
+            label = f"sim_{uuid.uuid4().hex}"
+            with _start_lock:
+                self.module.start(cmd, label=label, doSwitch=False)
+            self.sim = self.module.getConnection(label)
+        else:
+            self.module.start(cmd)
+            self.sim = self.module
+        self.starts += 1
+
+    def open(self, args):
+        """Run the simulation given by the SUMO arguments and return its connection."""
+        if self.sim is not None:
+            try:
+                self.sim.load(args)
+                self.loads += 1
+                return self.sim
+            except Exception as e:
+                handle_exception(e)
+                self.close()
+        self.start(args)
+        return self.sim
+
+    def close(self):
+        if self.sim is None:
+            return
+        try:
+            self.sim.close()
+        except Exception:
+            # SUMO is already gone
+            pass
+        finally:
+            self.sim = None
+
+
+_servers = threading.local()
+
+
+def worker_server(backend="traci"):
+    """
+    Return the SimulationServer of the calling worker, one per process,
+    thread and backend.
+    """
+    if getattr(_servers, "pid", None) != os.getpid():
+        # a forked worker must not share the connection of its parent
+        _servers.pid = os.getpid()
+        _servers.by_backend = {}
+    server = _servers.by_backend.get(backend)
+    if server is None:
+        server = SimulationServer(backend)
+        _servers.by_backend[backend] = server
+        atexit.register(server.close)
+    return server
 
 
 class Traffic_Env(gym.Env):
 
-    def __init__(self, record_area="E3", config_path="."):
+    def __init__(
+        self,
+        record_area="E3",
+        config_path=".",
+        record_mode="subscription",
+        backend="traci",
+        stats=None,
+        server=None,
+    ):
+        """
+        Args:
+            record_area (str): Edge whose vehicles are recorded
+            config_path (str): Directory holding highway.sumocfg
+            record_mode (str): 'subscription' fetches a whole step in one
+                round-trip, 'poll' queries every vehicle separately
+            backend (str): 'traci' or 'libsumo', see load_backend
+            stats (OnlineDistributions): Optional streaming statistics fed
+                with every recorded step
+            server (SimulationServer): Long-lived SUMO instance to run in,
+                it is left open on close(). A private one is started and
+                closed with the environment if None.
+        """
+        if record_mode not in ("subscription", "poll"):
+            raise ValueError(f"unknown record_mode: {record_mode}")
         self.record_area = record_area
         self.config_path = config_path
-        self.record_path = None
-        self.record_file = None
-        self.csv_writer = None
+        self.record_mode = record_mode
+        self.backend = backend
+        self.module = load_backend(backend)
+        self.server = server
+        self.own_server = None
+        self.sim = None
+        self.recorder = None
+        self.stats = stats
+        self.followed_ids = set()
 
     def step(self):
-        traci.simulationStep()
+        self.sim.simulationStep()
 
     def start(
         self,
         gui=False,
         record=True,
+        keep_rows=True,
     ):
-        sumoBinary = checkBinary("sumo-gui") if gui else checkBinary("sumo")
-        traci.start([sumoBinary, "-c", self.config_path + "/highway.sumocfg"])
+        if self.server is None:
+            self.own_server = SimulationServer(self.backend, gui=gui)
+        elif self.server.backend != self.backend or self.server.gui != gui:
+            raise ValueError("server does not match the backend and gui of the run")
+        server = self.own_server or self.server
+        self.sim = server.open(
+            ["-c", os.path.join(self.config_path, "highway.sumocfg")]
+        )
 
         if record:
-            self.record_path = self.config_path + "/record.csv"
-            self.record_file = open(self.record_path, "w")
-            self.writer = csv.writer(self.record_file)
-            self.writer.writerow(
-                [
-                    "frame",
-                    "id",
-                    "width",
-                    "xVelocity",
-                    "yVelocity",
-                    "xAcceleration",
-                    "dhw",
-                ]
+            if keep_rows:
+                self.recorder = TrajectoryRecorder()
+            if self.record_mode == "subscription":
+                self.subscribe_record_area()
+
+    def close(self, sinks=("csv",)):
+        if self.own_server is not None:
+            self.own_server.close()
+        self.sim = None
+        if self.recorder is not None:
+            self.recorder.write(self.config_path, sinks)
+
+    def subscribe_record_area(self):
+        # The context range only has to cover the edge itself, vehicles of
+        # neighbouring edges are filtered out by their road id.
+        lane_count = self.sim.edge.getLaneNumber(self.record_area)
+        edge_width = sum(
+            self.sim.lane.getWidth(f"{self.record_area}_{i}") for i in range(lane_count)
+        )
+        self.sim.edge.subscribeContext(
+            self.record_area,
+            tc.CMD_GET_VEHICLE_VARIABLE,
+            edge_width,
+            CONTEXT_VARS,
+        )
+
+    def follower_gaps(self, v_ids):
+        if self.backend == "libsumo":
+            # in-process calls are cheap, and libsumo does not take
+            # subscription parameters
+            return {vid: self.sim.vehicle.getFollower(vid)[1] for vid in v_ids}
+
+        # SUMO does not accept the lookback parameter of VAR_FOLLOWER inside
+        # context subscriptions, so followers are subscribed per vehicle while
+        # it is inside the record area. This costs one round-trip when a
+        # vehicle enters or leaves, not one per vehicle and step.
+        for vid in v_ids - self.followed_ids:
+            self.sim.vehicle.subscribe(
+                vid, [tc.VAR_FOLLOWER], parameters={tc.VAR_FOLLOWER: ("d", 0.0)}
             )
+        for vid in self.followed_ids - v_ids:
+            try:
+                self.sim.vehicle.unsubscribe(vid)
+            except self.module.TraCIException:
+                # the vehicle already arrived, SUMO dropped the subscription
+                pass
+        self.followed_ids = v_ids
+        followers = self.sim.vehicle.getAllSubscriptionResults()
+        return {vid: followers[vid][tc.VAR_FOLLOWER][1] for vid in v_ids}
 
-    def close(self):
-        self.record_file.close()
-        traci.close()
+    def collect_subscribed(self, step):
+        context = self.sim.edge.getContextSubscriptionResults(self.record_area) or {}
+        area = {
+            vid: values
+            for vid, values in context.items()
+            if values[tc.VAR_ROAD_ID] == self.record_area
+        }
+        gaps = self.follower_gaps(set(area))
+        v_ids = list(area)
+        values = {
+            "width": [area[vid][tc.VAR_LENGTH] for vid in v_ids],
+            "xVelocity": [area[vid][tc.VAR_SPEED] for vid in v_ids],
+            "yVelocity": [area[vid][tc.VAR_SPEED_LAT] for vid in v_ids],
+            "xAcceleration": [area[vid][tc.VAR_ACCELERATION] for vid in v_ids],
+            "dhw": [gaps[vid] for vid in v_ids],
+        }
+        return v_ids, values
+
+    def collect_polled(self, step):
+        v_ids = self.sim.edge.getLastStepVehicleIDs(self.record_area)
+        values = {
+            "width": [self.sim.vehicle.getLength(vid) for vid in v_ids],
+            "xVelocity": [self.sim.vehicle.getSpeed(vid) for vid in v_ids],
+            "yVelocity": [self.sim.vehicle.getLateralSpeed(vid) for vid in v_ids],
+            "xAcceleration": [self.sim.vehicle.getAcceleration(vid) for vid in v_ids],
+            "dhw": [self.sim.vehicle.getFollower(vid)[1] for vid in v_ids],
+        }
+        return v_ids, values
 
     def record(self, step):
-        v_ids = traci.edge.getLastStepVehicleIDs(self.record_area)
-        for vid in v_ids:
-            xVelocity = round(traci.vehicle.getSpeed(vid), 3)
-            yVelocity = round(traci.vehicle.getLateralSpeed(vid), 3)
-            xAcceleration = round(traci.vehicle.getAcceleration(vid), 3)
-            v_lenghth = round(traci.vehicle.getLength(vid), 3)
-            _, dhw = traci.vehicle.getFollower(vid)
-            dhw = round(dhw, 3)
-            self.writer.writerow(
-                [step, vid, v_lenghth, xVelocity, yVelocity, xAcceleration, dhw]
-            )
+        if self.record_mode == "subscription":
+            v_ids, values = self.collect_subscribed(step)
+        else:
+            v_ids, values = self.collect_polled(step)
+        if self.recorder is not None:
+            self.recorder.append(step, v_ids, values)
+        if self.stats is not None:
+            self.stats.update(step, v_ids, values)
 
 
 def run_calibrate_sim(
@@ -67,22 +278,66 @@ def run_calibrate_sim(
     config_path="",
     sim_step=30 * (900 + 100),
     gui=False,
+    record_mode="subscription",
+    hot_time=200 * 30,
+    backend="traci",
+    sinks=("csv",),
+    stats=None,
+    keep_rows=True,
+    server=None,
+    checkpoints=(),
+    on_checkpoint=None,
+    horizon=None,
 ):
-    env = Traffic_Env(record_area=recording_area, config_path=config_path)
+    """
+    Run one simulation and record the measurement edge after the warm-up.
+
+    Returns the TrajectoryRecorder holding the recorded rows; they are also
+    written to config_path through the given sinks ('csv', 'parquet'). With
+    keep_rows=False no rows are stored and only stats is fed, the recorder
+    returned is then None. A long-lived server (see worker_server) runs the
+    simulation without starting a new SUMO instance.
+
+    At every step in checkpoints on_checkpoint(step, env) is called before
+    the step is simulated; the run stops there if it returns False.
+
+    A HorizonTracker (see online_stats.AdaptiveHorizon) ends the run as soon
+    as the distributions in stats have converged; sim_step is then only the
+    upper limit and the steps used are stored in horizon.steps_used.
+    """
+    env = Traffic_Env(
+        record_area=recording_area,
+        config_path=config_path,
+        record_mode=record_mode,
+        backend=backend,
+        stats=stats,
+        server=server,
+    )
 
-    env.start(gui=gui, record=True)
+    checkpoints = set(checkpoints)
+    steps = 0
+    env.start(gui=gui, record=True, keep_rows=keep_rows)
     try:
-        hot_time = 200 * 30
         for i in range(sim_step):
+            if i in checkpoints and not on_checkpoint(i, env):
+                break
+            if horizon is not None and horizon.converged(i):
+                break
+            steps = i + 1
             if i > hot_time:
                 env.record(i)
             env.step()
     except Exception as e:
         handle_exception(e)
     finally:
-        traci.close()
+        env.close(sinks=sinks)
+        if stats is not None:
+            stats.finish()
+        if horizon is not None:
+            horizon.steps_used = steps
         sys.stdout.flush()
+    return env.recorder
 
 
 if __name__ == "__main__":
-    run_calibrate_sim(config_path="../output/data_raw/merge")
+    run_calibrate_sim(config_path=os.path.join(OUTPUT_DIR, "data_raw", "merge"))
@@ -0,0 +1,112 @@
+"""
+Columnar ingestion of the AD4CHE tracks.
+
+Each recording DJI_XXXX/XX_tracks.csv is parsed once into the columns the
+calibration uses, with fixed dtypes, and cached as Parquet below
+output/ingest_cache/. A cache file is named after the modification time and
+size of its source, so an edited or replaced CSV is parsed again. Recordings
+are read in parallel worker processes.
+
+Vehicle ids restart in every recording, so load_tracks() namespaces them as
+recording * RECORDING_ID_STRIDE + id; concatenated recordings then never merge
+unrelated vehicles in the groupby("id") of filter_and_classify.
+"""
+
+import glob
+import os
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from util import OUTPUT_DIR
+
+TRACK_DTYPES = {
+    "frame": np.int32,
+    "id": np.int32,
+    "width": np.float32,
+    "xVelocity": np.float32,
+    "yVelocity": np.float32,
+    "xAcceleration": np.float32,
+    "dhw": np.float32,
+}
+
+RECORDING_ID_STRIDE = 1_000_000
+
+INGEST_CACHE_DIR = os.path.join(OUTPUT_DIR, "ingest_cache")
+
+
+def tracks_path(base_dir, index):
+    return os.path.join(base_dir, f"DJI_{index:04d}", f"{index:02d}_tracks.csv")
+
+
+def read_tracks(path):
+    """Parse the calibration columns of one tracks CSV."""
+    return pd.read_csv(path, usecols=list(TRACK_DTYPES), dtype=TRACK_DTYPES)[
+        list(TRACK_DTYPES)
+    ]
+
+
+def cached_tracks(path, cache_dir=INGEST_CACHE_DIR):
+    """
+    read_tracks() through the Parquet cache.
+
+    Args:
+        path (str): Tracks CSV of one recording
+        cache_dir (str): Directory of the Parquet files, None to bypass it
+    """
+    if cache_dir is None:
+        return read_tracks(path)
+    stat = os.stat(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    recording = os.path.basename(os.path.dirname(path))
+    prefix = os.path.join(cache_dir, f"{recording}_{stem}")
+    cache_path = f"{prefix}-{stat.st_mtime_ns}-{stat.st_size}.parquet"
+    if os.path.isfile(cache_path):
+        return pd.read_parquet(cache_path)
+    df = read_tracks(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    scratch = f"{cache_path}.{os.getpid()}.tmp"
+    df.to_parquet(scratch, index=False)
+    os.replace(scratch, cache_path)
+    for stale in glob.glob(f"{glob.escape(prefix)}-*.parquet"):
+        if stale != cache_path:
+            os.remove(stale)
+    return df
+
+
+def load_recording(path, recording, cache_dir=INGEST_CACHE_DIR):
+    """Tracks of one recording with ids namespaced by its index."""
+    df = cached_tracks(path, cache_dir)
+    if len(df) and df["id"].max() >= RECORDING_ID_STRIDE:
+        raise ValueError(f"vehicle ids of {path} exceed {RECORDING_ID_STRIDE}")
+    df["id"] = recording * RECORDING_ID_STRIDE + df["id"].astype(np.int64)
+    return df
+
+
+def load_tracks(
+    base_dir, start_index=1, end_index=65, processes=None, cache_dir=INGEST_CACHE_DIR
+):
+    """
+    Concatenated tracks of the recordings start_index..end_index.
+
+    Missing recordings are skipped.
+
+    Args:
+        base_dir (str): AD4CHE directory holding the DJI_XXXX folders
+        processes (int): Worker processes, one per recording up to the CPU
+            count if None
+        cache_dir (str): Parquet cache directory, None to always parse the CSV
+    """
+    jobs = [
+        (tracks_path(base_dir, index), index, cache_dir)
+        for index in range(start_index, end_index + 1)
+        if os.path.isfile(tracks_path(base_dir, index))
+    ]
+    if not jobs:
+        return pd.DataFrame(columns=list(TRACK_DTYPES))
+    processes = min(processes or os.cpu_count() or 1, len(jobs))
+    if processes > 1:
+        with Pool(processes) as pool:
+            frames = pool.starmap(load_recording, jobs)
+    else:
+        frames = [load_recording(*job) for job in jobs]
+    return pd.concat(frames, ignore_index=True)
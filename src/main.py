@@ -24,17 +24,61 @@ from multi_object_optimization import (
     run_pso,
 )
 from task import pbounds
+from scheduler import TaskScheduler
+from multi_object_optimization import CampaignRunner
 import multiprocessing
-from pymoo.core.problem import StarmapParallelization
+import threading
 
 
-def main(base_dir="../data", output_dir="../output"):
+def calibrate_scenario(pool, scenario, n_core):
+    """
+    Start the BO and pymoo campaigns of a scenario on the shared pool.
+
+    Returns the threads that drive them; each algorithm has its own problem
+    and runner, so all of them run concurrently.
+    """
+
+    def run(algorithm, problem_class):
+        runner = CampaignRunner(pool, f"{algorithm.__name__}-{scenario}")
+        # remote agents cannot share the evaluation cache of this host
+        problem = problem_class(
+            pbounds, elementwise_runner=runner, env_name=scenario, cache=pool.local
+        )
+        try:
+            algorithm(problem)
+        finally:
+            runner.close()
+
+    threads = [
+        threading.Thread(
+            target=bayesian_optimize,
+            kwargs=dict(max_iteration=3000, env=scenario, cpu_count=n_core, pool=pool),
+        ),
+        threading.Thread(target=run, args=(run_pso, SinSUMOProblem)),
+        threading.Thread(target=run, args=(run_nsga3, MooSUMOProblem)),
+        threading.Thread(target=run, args=(run_age2, MooSUMOProblem)),
+    ]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def main(base_dir="../data", output_dir="../output", pool=None, n_core=None):
     """
     Main calibration pipeline for SUMO traffic simulation.
-    
+
+    All campaigns (BO, PSO, NSGA-III and AGE-MOEA2 of every scenario) run at
+    the same time on one long-lived worker pool, which hands every free
+    worker to the campaign with the smallest share (see scheduler), so no
+    core idles while a campaign waits for its last evaluations.
+
     Args:
         base_dir (str): Path to AD4CHE dataset directory
         output_dir (str): Path to output directory for results
+        pool (TaskScheduler): Started pool to run on, e.g. a
+            distributed.WorkBroker; a local pool of n_core workers if None
+        n_core (int): Worker count of the local pool and evaluations each BO
+            campaign keeps in flight; the CPU count minus 4 if None
     """
     # Step 1: Data preprocessing and distribution computation
     # Process AD4CHE dataset frames for different traffic scenarios
@@ -42,29 +86,27 @@ def main(base_dir="../data", output_dir="../output"):
     for start_idx, end_idx, scenario in distribution_tasks:
         compute_distribution(start_index=start_idx, end_index=end_idx, env=scenario)
     
-    # Step 2: Initialize parallel processing for optimization
+    # Step 2: Start the shared worker pool
     # Reserve 4 cores for system stability
-    n_core = int(multiprocessing.cpu_count() - 4)
-    pool = multiprocessing.Pool(n_core)
-    runner = StarmapParallelization(pool.starmap)
-    
-    # Step 3: Run optimization algorithms for each scenario
+    n_core = n_core or int(multiprocessing.cpu_count() - 4)
+    own_pool = pool is None
+    if own_pool:
+        pool = TaskScheduler(n_core)
+        pool.start()
+
+    # Step 3: Run the optimization campaigns of all scenarios concurrently
+    # Bayesian optimization, PSO, NSGA-III and AGE-MOEA2 per scenario
+    threads = []
     for scenario in ["merge", "right", "stop"]:
-        # Step 3.1: Bayesian optimization for parameter exploration
-        bayesian_optimize(max_iteration=3000, env=scenario, cpu_count=n_core)
-        
-        # Step 3.2: Multi-objective optimization
-        # Create problem instances for multi-objective and single-objective optimization
-        moo_problem = MooSUMOProblem(pbounds, elementwise_runner=runner, env_name=scenario)
-        sin_problem = SinSUMOProblem(pbounds, elementwise_runner=runner, env_name=scenario)
-        
-        # Run different optimization algorithms
-        run_pso(sin_problem)      # Particle Swarm Optimization
-        run_nsga3(moo_problem)    # Non-dominated Sorting Genetic Algorithm III
-        run_age2(moo_problem)     # Age-based Multi-objective Evolutionary Algorithm II
-    
-    # Clean up resources
-    pool.close()
+        threads += calibrate_scenario(pool, scenario, n_core)
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        print(f"Worker pool: {pool.stats()}")
+        # Clean up resources
+        if own_pool:
+            pool.shutdown()
 
 
 if __name__ == "__main__":
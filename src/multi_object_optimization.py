@@ -1,21 +1,46 @@
 from pymoo.core.problem import ElementwiseProblem
 import numpy as np
-from task import SUMO_task, pbounds
+from task import evaluate_params, pbounds, SIM_STEP
+from eval_cache import EvaluationCache
+from fidelity import mean_score
 import multiprocessing
-from pymoo.core.problem import StarmapParallelization
 from pymoo.optimize import minimize
+from pymoo.core.callback import Callback
 import multiprocessing
+import os
 import pickle
+import time
+from util import OUTPUT_DIR
+from result_store import ResultStore
+from scheduler import TaskScheduler
 
-from pymoo.algorithms.moo.age2 import AGEMOEA2
 from pymoo.algorithms.soo.nonconvex.pso import PSO
 from pymoo.algorithms.moo.nsga3 import NSGA3
 from pymoo.util.ref_dirs import get_reference_directions
 
 
 class MooSUMOProblem(ElementwiseProblem):
-    def __init__(self, param_bounds, env_name="merge", **kwargs):
+    def __init__(
+        self,
+        param_bounds,
+        env_name="merge",
+        backend="traci",
+        cache=True,
+        reuse_sumo=True,
+        streaming=False,
+        fidelity=None,
+        early_abort=None,
+        horizon=None,
+        **kwargs,
+    ):
         self.env_name = env_name
+        self.backend = backend
+        self.reuse_sumo = reuse_sumo
+        self.streaming = streaming
+        self.fidelity = fidelity
+        self.early_abort = early_abort
+        self.horizon = horizon
+        self.cache = EvaluationCache() if cache is True else cache or None
         self.param_bounds = param_bounds
 
         n_var = len(param_bounds)
@@ -25,12 +50,31 @@ class MooSUMOProblem(ElementwiseProblem):
 
     def _evaluate(self, x, out, *args, **kwargs):
         params = {key: x[i] for i, key in enumerate(self.param_bounds.keys())}
-
+        out["steps_run"] = None
+        out["censored"] = False
         try:
-            task = SUMO_task(params, env=self.env_name)
-            res = task.run_task(sim_step=750 * 30, save=False, gui=False)
+            res = evaluate_params(
+                params,
+                env=self.env_name,
+                sim_step=SIM_STEP,
+                cache=self.cache,
+                save=False,
+                gui=False,
+                backend=self.backend,
+                reuse_sumo=self.reuse_sumo,
+                streaming=self.streaming,
+                fidelity=self.fidelity,
+                early_abort=self.early_abort,
+                horizon=self.horizon,
+            )
             if not res:
                 out["F"] = [1] * self.n_obj
+                return
+            out["steps_run"] = res.steps_run
+            if getattr(res, "censored", False):
+                # scaled to the lower bound of the mean KL of the full run
+                out["F"] = np.asarray(res) * (res.lower_bound / mean_score(res))
+                out["censored"] = True
             else:
                 out["F"] = res
         except Exception as e:
@@ -38,8 +82,27 @@ class MooSUMOProblem(ElementwiseProblem):
 
 
 class SinSUMOProblem(ElementwiseProblem):
-    def __init__(self, param_bounds, env_name="merge", **kwargs):
+    def __init__(
+        self,
+        param_bounds,
+        env_name="merge",
+        backend="traci",
+        cache=True,
+        reuse_sumo=True,
+        streaming=False,
+        fidelity=None,
+        early_abort=None,
+        horizon=None,
+        **kwargs,
+    ):
         self.env_name = env_name
+        self.backend = backend
+        self.reuse_sumo = reuse_sumo
+        self.streaming = streaming
+        self.fidelity = fidelity
+        self.early_abort = early_abort
+        self.horizon = horizon
+        self.cache = EvaluationCache() if cache is True else cache or None
         self.param_bounds = param_bounds
         n_var = len(param_bounds)
         xl = [bounds[0] for bounds in param_bounds.values()]
@@ -48,19 +111,244 @@ class SinSUMOProblem(ElementwiseProblem):
 
     def _evaluate(self, x, out, *args, **kwargs):
         params = {key: x[i] for i, key in enumerate(self.param_bounds.keys())}
-
+        out["steps_run"] = None
+        out["censored"] = False
         try:
-            task = SUMO_task(params, env=self.env_name)
-            res = task.run_task(sim_step=750 * 30, save=False, gui=False)
+            res = evaluate_params(
+                params,
+                env=self.env_name,
+                sim_step=SIM_STEP,
+                cache=self.cache,
+                save=False,
+                gui=False,
+                backend=self.backend,
+                reuse_sumo=self.reuse_sumo,
+                streaming=self.streaming,
+                fidelity=self.fidelity,
+                early_abort=self.early_abort,
+                horizon=self.horizon,
+            )
             if not res:
                 out["F"] = [1]
+                return
+            out["steps_run"] = res.steps_run
+            if getattr(res, "censored", False):
+                out["F"] = [res.lower_bound]
+                out["censored"] = True
             else:
                 out["F"] = [np.sum(res) / len(res)]
         except Exception as e:
             out["F"] = [1]
 
 
+def evaluate_elementwise(task):
+    """
+    Scheduler task of CampaignRunner: one pymoo elementwise evaluation and
+    its wall time in seconds.
+    """
+    start = time.perf_counter()
+    out = task["f"](task["x"])
+    return out, time.perf_counter() - start
+
+
+class CampaignRunner:
+    """
+    pymoo elementwise_runner that evaluates on a shared TaskScheduler.
+
+    Every call submits the individuals of the population as separate tasks
+    of one campaign and collects them as they finish, so a slow simulation
+    only holds its own worker; while the call waits for stragglers the idle
+    workers serve the other campaigns of the pool. Individuals are submitted
+    longest expected first, the wall time of each being estimated from the
+    k_nearest evaluated points closest to it, so the long runs do not end up
+    at the tail of a generation. Evaluations that fail on every attempt get
+    the F the problems use for failed runs, without steps_run and not
+    censored.
+
+    Use one runner per concurrently running algorithm; runs one after the
+    other can share it and its duration model. On a pool of remote workers
+    (distributed.WorkBroker) the problem must not use the evaluation cache or
+    fidelity, whose SQLite stores the agents cannot share. generations holds the
+    utilization of every call, see generation_stats().
+
+    Args:
+        pool (TaskScheduler): Started worker pool
+        name (str): Campaign name, unique on the pool
+        weight (float): Share of the pool, see TaskScheduler.campaign
+        priority (int): Priority on the pool
+        timeout (float): Wall-clock seconds per evaluation, None for no limit
+        retries (int): Additional attempts of a failed evaluation
+        k_nearest (int): Evaluated points a wall-time estimate averages
+        max_history (int): Most recent evaluations kept for the estimates
+    """
+
+    def __init__(
+        self,
+        pool,
+        name,
+        weight=1.0,
+        priority=0,
+        timeout=1800,
+        retries=2,
+        k_nearest=5,
+        max_history=5000,
+    ):
+        self.pool = pool
+        self.name = name
+        self.weight = weight
+        self.priority = priority
+        self.timeout = timeout
+        self.retries = retries
+        self.k_nearest = k_nearest
+        self.max_history = max_history
+        self.campaign = None
+        self.history_x = np.empty((0, 0))
+        self.history_seconds = np.empty(0)
+        self.generations = []
+
+    def __getstate__(self):
+        # shipped to the workers inside the problem, without the pool and
+        # the duration model
+        state = self.__dict__.copy()
+        state.update(
+            pool=None,
+            campaign=None,
+            history_x=np.empty((0, 0)),
+            history_seconds=np.empty(0),
+            generations=[],
+        )
+        return state
+
+    def expected_seconds(self, X):
+        """Estimated wall time per row of X (unit cube), 0 without history."""
+        if len(self.history_seconds) < self.k_nearest:
+            return np.zeros(len(X))
+        distances = np.sum((X[:, None, :] - self.history_x[None]) ** 2, axis=2)
+        nearest = np.argpartition(distances, self.k_nearest - 1, axis=1)
+        return self.history_seconds[nearest[:, : self.k_nearest]].mean(axis=1)
+
+    def observe(self, X, seconds):
+        """Add evaluated rows of X (unit cube) and their wall times."""
+        if not len(seconds):
+            return
+        if not self.history_x.size:
+            self.history_x = np.empty((0, X.shape[1]))
+        self.history_x = np.vstack([self.history_x, X])[-self.max_history :]
+        self.history_seconds = np.concatenate([self.history_seconds, seconds])[
+            -self.max_history :
+        ]
+
+    def __call__(self, f, X):
+        problem = f.problem
+        if not self.pool.local and (
+            getattr(problem, "cache", None) is not None
+            or getattr(problem, "fidelity", None) is not None
+        ):
+            raise ValueError(
+                f"{self.name}: the evaluation cache and fidelity need the "
+                "SQLite stores of this host, pass cache=False to the problem"
+            )
+        if self.campaign is None:
+            self.campaign = self.pool.campaign(
+                self.name,
+                evaluate_elementwise,
+                weight=self.weight,
+                priority=self.priority,
+                timeout=self.timeout,
+                retries=self.retries,
+            )
+        start = time.time()
+        xl, xu = np.asarray(problem.xl), np.asarray(problem.xu)
+        unit = (np.asarray(X, dtype=float) - xl) / (xu - xl)
+        expected = self.expected_seconds(unit)
+        # stable, so the pymoo order is kept until there is a model
+        for i in np.argsort(-expected, kind="stable"):
+            self.campaign.submit({"index": int(i), "f": f, "x": X[i]})
+        results = [None] * len(X)
+        seconds = np.full(len(X), np.nan)
+        missing = len(X)
+        while missing:
+            for task, result in self.campaign.results(timeout=1):
+                if result is None:
+                    out = {
+                        "F": [1] * problem.n_obj,
+                        "steps_run": None,
+                        "censored": False,
+                    }
+                else:
+                    out, seconds[task["index"]] = result
+                results[task["index"]] = out
+                missing -= 1
+        evaluated = ~np.isnan(seconds)
+        self.observe(unit[evaluated], seconds[evaluated])
+        self.record_generation(time.time() - start, seconds[evaluated], expected)
+        return results
+
+    def record_generation(self, wall, seconds, expected):
+        """
+        Utilization of a call: busy worker time over the worker time the
+        population could have used, i.e. min(workers, population) slots for
+        the wall time of the call.
+        """
+        slots = max(min(self.pool.n_workers, len(expected)), 1)
+        busy = float(seconds.sum())
+        stats = {
+            "generation": len(self.generations) + 1,
+            "evaluations": len(expected),
+            "failed": len(expected) - len(seconds),
+            "wall": wall,
+            "busy": busy,
+            "utilization": busy / (wall * slots) if wall else 0.0,
+            "longest": float(seconds.max()) if len(seconds) else 0.0,
+            "ordered": bool(expected.any()),
+        }
+        self.generations.append(stats)
+        print(
+            f"{self.name} generation {stats['generation']}: "
+            f"{stats['evaluations']} evaluations in {wall:.1f}s, "
+            f"utilization {stats['utilization']:.0%}, "
+            f"longest {stats['longest']:.1f}s"
+        )
+
+    def generation_stats(self):
+        """Per-generation statistics and their mean utilization."""
+        utilization = [g["utilization"] for g in self.generations]
+        return {
+            "generations": self.generations,
+            "mean_utilization": float(np.mean(utilization)) if utilization else 0.0,
+        }
+
+    def close(self):
+        if self.campaign is not None:
+            self.campaign.close()
+            self.campaign = None
+
+
+class AbortThresholdCallback(Callback):
+    """
+    Set the early-abort threshold of the problem to the mean KL of the worst
+    survivor after every generation; candidates that cannot beat it would
+    not enter the population anyway. The problem is shipped to the workers
+    with every generation, so they see the new threshold.
+    """
+
+    def notify(self, algorithm):
+        F = algorithm.pop.get("F")
+        scores = F.mean(axis=1)
+        scores = scores[np.isfinite(scores)]
+        if len(scores):
+            algorithm.problem.early_abort.threshold = float(scores.max())
+
+
 def run_optimization(problem, algorithm, algorithm_name):
+    run_name = f"{problem.env_name}_{os.path.splitext(algorithm_name)[0]}"
+    if getattr(problem, "fidelity", None) is not None:
+        # rung scores of this run only, like its population in the store
+        problem.fidelity = problem.fidelity.for_study(run_name, reset=True)
+        problem.fidelity.prune()
+    callback = None
+    if getattr(problem, "early_abort", None) is not None:
+        callback = AbortThresholdCallback()
     res = minimize(
         problem,
         algorithm,
@@ -68,13 +356,47 @@ def run_optimization(problem, algorithm, algorithm_name):
         seed=1,
         save_history=True,
         verbose=True,
+        callback=callback,
+    )
+    result_file = os.path.join(
+        OUTPUT_DIR, "data_cache", f"{problem.env_name}_{algorithm_name}.pkl"
     )
-    result_file = f"../output/data_cache/{problem.env_name}_{algorithm_name}.pkl"
     with open(result_file, "wb") as f:
         pickle.dump(res, f)
+    runner = problem.elementwise_runner
+    if isinstance(runner, CampaignRunner):
+        stats = runner.generation_stats()
+        print(f"{algorithm_name}: mean utilization {stats['mean_utilization']:.0%}")
+    record_population(problem, res, os.path.splitext(algorithm_name)[0])
+
+
+def record_population(problem, res, algorithm_name, store=None):
+    """Add the final population of a run to the result store."""
+    store = store or ResultStore()
+    run_id = store.open_run(
+        f"{problem.env_name}_{algorithm_name}",
+        problem.env_name,
+        algorithm_name,
+        reset=True,
+    )
+    keys = list(problem.param_bounds)
+    pop = res.pop
+    store.add_many(
+        run_id,
+        problem.env_name,
+        [
+            (dict(zip(keys, x)), -np.mean(f), f, steps_run, censored)
+            for x, f, steps_run, censored in zip(
+                pop.get("X"), pop.get("F"), pop.get("steps_run"), pop.get("censored")
+            )
+        ],
+    )
 
 
 def run_age2(problem):
+    # needs numba, which the other algorithms do not
+    from pymoo.algorithms.moo.age2 import AGEMOEA2
+
     algorithm = AGEMOEA2(pop_size=100)
     run_optimization(problem, algorithm, "age2")
 
@@ -94,8 +416,9 @@ if __name__ == "__main__":
 
     n_core = int(multiprocessing.cpu_count())
     n_core = 101
-    pool = multiprocessing.Pool(n_core)
-    runner = StarmapParallelization(pool.starmap)
+    pool = TaskScheduler(n_core)
+    pool.start()
+    runner = CampaignRunner(pool, "moo")
 
     # moo_problem = MooSUMOProblem(pbounds, elementwise_runner=runner, env_name="merge")
     # sin_problem = SinSUMOProblem(pbounds, elementwise_runner=runner, env_name="merge")
@@ -113,4 +436,5 @@ if __name__ == "__main__":
     # run_nsga3(moo_problem)
     # run_age2(moo_problem)
 
-    pool.close()
+    runner.close()
+    pool.shutdown()
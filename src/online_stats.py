@@ -0,0 +1,378 @@
+"""
+Streaming distribution statistics for a running simulation.
+
+OnlineDistributions is fed the recorded rows step by step and keeps one
+fixed-grid histogram per (vehicleType, variable) aligned with the grid of the
+scenario reference in output/data_cache/<env>_cache.pkl. Besides the counts,
+every bin keeps the sum, sum of squares, minimum and maximum of its values, so
+the moments and extremes used by save_distributions stay exact and the KL
+vector is available as soon as the simulation ends. Memory is O(bins) plus the
+rows of the vehicles currently inside the record area.
+
+AdaptiveHorizon follows the same histograms to end a run once they have
+converged.
+"""
+
+import copy
+import numpy as np
+from reference import load_reference
+
+
+class BinnedAccumulator:
+    """
+    Fixed-grid histogram with per-bin sum, sum of squares, min and max.
+
+    Values outside [lo, hi) are kept in the first/last bin, so the moments
+    and extremes remain exact while only their position in the grid is
+    clamped.
+    """
+
+    def __init__(self, lo, hi, n_bins):
+        self.lo = lo
+        self.hi = hi
+        self.n_bins = n_bins
+        self.width = (hi - lo) / n_bins
+        self.count = np.zeros(n_bins)
+        self.total = np.zeros(n_bins)
+        self.total_sq = np.zeros(n_bins)
+        self.min = np.full(n_bins, np.inf)
+        self.max = np.full(n_bins, -np.inf)
+
+    def add(self, values):
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        idx = np.floor((values - self.lo) / self.width).astype(np.int64)
+        idx = np.clip(idx, 0, self.n_bins - 1)
+        self.count += np.bincount(idx, minlength=self.n_bins)
+        self.total += np.bincount(idx, weights=values, minlength=self.n_bins)
+        self.total_sq += np.bincount(idx, weights=values**2, minlength=self.n_bins)
+        np.minimum.at(self.min, idx, values)
+        np.maximum.at(self.max, idx, values)
+
+    def bin_means(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.total / self.count
+
+    def quantile(self, q, mask=None):
+        """Quantile with linear interpolation between the bin extremes."""
+        count = self.count if mask is None else np.where(mask, self.count, 0)
+        cum = np.cumsum(count)
+        n = cum[-1]
+        if n == 0:
+            return np.nan
+        position = q * (n - 1) + 1
+        b = int(np.searchsorted(cum, position))
+        before = cum[b - 1] if b else 0
+        fraction = (position - before) / count[b] if count[b] > 1 else 0.5
+        fraction = min(max(fraction, 0.0), 1.0)
+        return self.min[b] + fraction * (self.max[b] - self.min[b])
+
+    def iqr_bounds(self, low=0.05, high=0.95):
+        """Value range kept by process_data.iqr_filter."""
+        q1 = self.quantile(low)
+        q3 = self.quantile(high)
+        iqr = q3 - q1
+        return q1 - 1.5 * iqr, q3 + 1.5 * iqr
+
+    def mask_between(self, lower, upper):
+        """Non-empty bins whose mean value lies inside [lower, upper]."""
+        means = self.bin_means()
+        return (self.count > 0) & (means >= lower) & (means <= upper)
+
+    def summary(self, mask):
+        """Return n, mean, std (ddof=1), min, max, bin means and counts."""
+        count = self.count[mask]
+        n = count.sum()
+        mean = self.total[mask].sum() / n
+        var = (self.total_sq[mask].sum() - n * mean**2) / (n - 1)
+        std = np.sqrt(max(var, 0.0))
+        return (
+            n,
+            mean,
+            std,
+            self.min[mask].min(),
+            self.max[mask].max(),
+            self.bin_means()[mask],
+            count,
+        )
+
+
+def binned_gaussian_kde(centers, weights, std, n, kde_x):
+    """gaussian_kde with Scott's rule evaluated from weighted bin means."""
+    bandwidth = std * n ** (-1 / 5)
+    kde_y = np.zeros_like(kde_x)
+    for start in range(0, len(centers), 256):
+        c = centers[start : start + 256, None]
+        w = weights[start : start + 256, None]
+        kde_y += (w * np.exp(-0.5 * ((kde_x[None, :] - c) / bandwidth) ** 2)).sum(0)
+    return kde_y / (n * bandwidth * np.sqrt(2 * np.pi))
+
+
+class OnlineDistributions:
+    """
+    Streaming replacement for filter_and_classify + save_distributions.
+
+    The per-vehicle "all xVelocity >= 0" filter is applied without the full
+    trajectory: rows of a vehicle are held back while it is inside the record
+    area and committed to the histograms once it leaves (or the run ends),
+    unless one of its velocities was negative.
+
+    Args:
+        grids (dict): "<vtype>_<variable>" -> (lo, hi) reference range
+        variables (list): Recorded variables to accumulate
+        vehicle_types (list): Vehicle types to accumulate
+        length_threshold (float): Length above which a row counts as bus
+        grid_points (int): Points of the reference KDE grid
+        pad (float): Grid extension beyond the reference range, as a
+            fraction of its span on each side
+        floors (dict): Variable -> value at or below which rows are dropped
+            after the IQR filter, as save_distributions does for dhw
+    """
+
+    def __init__(
+        self,
+        grids,
+        variables=["xAcceleration", "dhw", "xVelocity"],
+        vehicle_types=["car", "bus"],
+        length_threshold=6,
+        grid_points=1000,
+        pad=2.0,
+        floors={"dhw": 0.2},
+    ):
+        self.variables = variables
+        self.vehicle_types = vehicle_types
+        self.length_threshold = length_threshold
+        self.floors = floors
+        self.accumulators = {}
+        # rows above the floor, kept apart so the quantiles of the IQR filter
+        # still see every value
+        self.floored = {}
+        for vtype in vehicle_types:
+            for variable in variables:
+                lo, hi = grids[f"{vtype}_{variable}"]
+                span = hi - lo
+                spacing = span / (grid_points - 1)
+                n_bins = int(round(grid_points * (1 + 2 * pad)))
+                start = lo - pad * span - spacing / 2
+                key = f"{vtype}_{variable}"
+                self.accumulators[key] = BinnedAccumulator(
+                    start, start + n_bins * spacing, n_bins
+                )
+                if variable in floors:
+                    self.floored[key] = BinnedAccumulator(
+                        start, start + n_bins * spacing, n_bins
+                    )
+        self.reference = None
+        self.pending = {}
+        self.rejected = set()
+        self.vehicles = {vtype: set() for vtype in vehicle_types}
+
+    @classmethod
+    def from_reference(cls, cache_path, **kwargs):
+        """Build the grids from a reference _cache.pkl and keep it for the KL."""
+        reference = load_reference(cache_path=cache_path)
+        stats = cls(reference.grids(), **kwargs)
+        stats.reference = reference
+        return stats
+
+    def update(self, step, v_ids, values):
+        """Feed one recorded step, same arguments as TrajectoryRecorder.append."""
+        present = set(v_ids)
+        for vid in list(self.pending):
+            if vid not in present:
+                self.commit(vid)
+        if not len(v_ids):
+            return
+        block = np.round(
+            np.column_stack(
+                [values["width"]] + [values[variable] for variable in self.variables]
+            ),
+            3,
+        )
+        negative = np.asarray(values["xVelocity"]) < 0
+        for i, vid in enumerate(v_ids):
+            if vid in self.rejected:
+                continue
+            if negative[i]:
+                self.rejected.add(vid)
+                self.pending.pop(vid, None)
+                continue
+            self.pending.setdefault(vid, []).append(block[i])
+
+    def commit(self, vid):
+        rows = np.asarray(self.pending.pop(vid))
+        is_bus = rows[:, 0] > self.length_threshold
+        for vtype, mask in (("car", ~is_bus), ("bus", is_bus)):
+            if vtype not in self.vehicles or not mask.any():
+                continue
+            self.vehicles[vtype].add(vid)
+            for j, variable in enumerate(self.variables):
+                key = f"{vtype}_{variable}"
+                values = rows[mask, j + 1]
+                self.accumulators[key].add(values)
+                if key in self.floored:
+                    self.floored[key].add(values[values > self.floors[variable]])
+
+    def finish(self):
+        """Commit the vehicles still inside the record area."""
+        for vid in list(self.pending):
+            self.commit(vid)
+
+    def to_cache(self, grid_points=1000):
+        """Return the distributions in the _cache.pkl layout of save_distributions."""
+        self.finish()
+        hist_kde_data = {}
+        stats_data = {
+            "vehicle_count": {vtype: len(ids) for vtype, ids in self.vehicles.items()}
+        }
+        for key, acc in self.accumulators.items():
+            lower, upper = acc.iqr_bounds()
+            acc = self.floored.get(key, acc)
+            mask = acc.mask_between(lower, upper)
+            if acc.count[mask].sum() < 2:
+                continue
+            n, mean, std, data_min, data_max, centers, weights = acc.summary(mask)
+            kde_x = np.linspace(data_min, data_max, grid_points)
+            kde_y = binned_gaussian_kde(centers, weights, std, n, kde_x)
+            hist_data, bins = np.histogram(
+                centers,
+                bins=80,
+                range=(data_min, data_max),
+                weights=weights,
+                density=True,
+            )
+            hist_kde_data[key] = (
+                hist_data,
+                bins[1] - bins[0],
+                (bins[:-1] + bins[1:]) / 2,
+                kde_x,
+                kde_y,
+            )
+            stats_data[key] = {
+                "min": data_min,
+                "max": data_max,
+                "mean": mean,
+                "std": std,
+            }
+        return {"hist_kde_data": hist_kde_data, "stats_data": stats_data}
+
+    def snapshot(self):
+        """
+        Copy to evaluate while the run goes on; to_cache() commits the
+        vehicles still inside the record area, which must only happen once.
+        """
+        reference, self.reference = self.reference, None
+        try:
+            snapshot = copy.deepcopy(self)
+        finally:
+            self.reference = reference
+        snapshot.reference = reference
+        return snapshot
+
+    def kl_divergence(self, variables=None):
+        """KL vector against the reference, ordered as cal_kl_divergence."""
+        return self.reference.kl_divergence(
+            self.to_cache(),
+            variables or self.variables,
+            self.vehicle_types,
+        )
+
+
+class AdaptiveHorizon:
+    """
+    Stop a run once its distributions no longer change.
+
+    Every interval steps the histograms of all accumulated distributions are
+    compared with those of the previous check by their KL divergence. The
+    run is converged once every distribution stayed within tolerance for
+    patience checks in a row; it never stops before min_steps, and the
+    sim_step of the run is the upper limit.
+
+    Args:
+        min_steps (int): Earliest step at which the run may stop
+        interval (int): Simulation steps between checks
+        tolerance (float): KL between successive checks below which a
+            distribution counts as stable
+        patience (int): Consecutive stable checks required
+        n_bins (int): The fine grid of each accumulator is merged into about
+            this many bins for the comparison
+
+    With the defaults a merge run at the midpoint of pbounds stops after
+    about 17250 of 22500 steps; the bus distributions, fed by few vehicles,
+    are the last to settle.
+    """
+
+    def __init__(
+        self, min_steps=12000, interval=750, tolerance=3e-3, patience=2, n_bins=100
+    ):
+        self.min_steps = min_steps
+        self.interval = interval
+        self.tolerance = tolerance
+        self.patience = patience
+        self.n_bins = n_bins
+
+    def fingerprint(self):
+        """Settings that decide where a run stops, see eval_cache.evaluation_mode."""
+        return {
+            "min_steps": self.min_steps,
+            "interval": self.interval,
+            "tolerance": self.tolerance,
+            "patience": self.patience,
+            "n_bins": self.n_bins,
+        }
+
+    def tracker(self, stats):
+        """Per-run state, following the accumulators of an OnlineDistributions."""
+        return HorizonTracker(self, stats)
+
+
+class HorizonTracker:
+    """
+    Convergence state of one run, see AdaptiveHorizon.
+
+    steps_used is set by run_calibrate_sim to the steps actually simulated,
+    history holds (step, {distribution: KL to the previous check}).
+    """
+
+    def __init__(self, horizon, stats):
+        self.horizon = horizon
+        self.stats = stats
+        self.previous = {}
+        self.stable_checks = 0
+        self.history = []
+        self.steps_used = None
+
+    def histograms(self):
+        result = {}
+        for key, acc in self.stats.accumulators.items():
+            group = max(1, -(-acc.n_bins // self.horizon.n_bins))
+            counts = np.zeros(-(-acc.n_bins // group) * group)
+            counts[: acc.n_bins] = acc.count
+            result[key] = counts.reshape(-1, group).sum(axis=1)
+        return result
+
+    def converged(self, step):
+        """Check the distributions at step if a check is due."""
+        if step == 0 or step % self.horizon.interval:
+            return False
+        current = self.histograms()
+        divergences = {}
+        for key, counts in current.items():
+            previous = self.previous.get(key)
+            if previous is None or not counts.sum() or not previous.sum():
+                divergences[key] = np.inf
+                continue
+            p = counts / counts.sum() + 1e-12
+            q = previous / previous.sum() + 1e-12
+            divergences[key] = float(np.sum(p * np.log(p / q)))
+        self.previous = current
+        self.history.append((step, divergences))
+        if all(d <= self.horizon.tolerance for d in divergences.values()):
+            self.stable_checks += 1
+        else:
+            self.stable_checks = 0
+        return (
+            step >= self.horizon.min_steps
+            and self.stable_checks >= self.horizon.patience
+        )
@@ -5,20 +5,78 @@ import numpy as np
 import pickle
 from scipy.stats import gaussian_kde
 from scipy.stats import entropy
+from scipy.special import rel_entr
+from scipy.signal import fftconvolve
+from ingest import load_tracks, INGEST_CACHE_DIR
 
+# Below this many samples the exact gaussian_kde is as fast as the binned one,
+# so kde="auto" keeps the exact densities there. On a 1000-point grid
+# benchmark.bench_kde measures fft_kde at 0.6x the speed of gaussian_kde for
+# 10 samples, break-even around 30 to 40 and 1.3x from 50 on.
+KDE_FFT_MIN_SAMPLES = 50
 
-def filter_and_classify(pd_f, length_threshold=6):
-    positive_velocity_groups = [group for _, group in pd_f.groupby("id") if all(group["xVelocity"] >= 0)]
-    df = pd.concat(positive_velocity_groups)
-    df["vehicleType"] = df["width"].map(lambda x: "bus" if x > length_threshold else "car")
+
+def filter_and_classify(pd_f, length_threshold=6, backend="pandas"):
+    """
+    Keep the vehicles whose xVelocity is never negative and add vehicleType.
+
+    Rows come out grouped by sorted id, in their original order within a
+    vehicle and with their original index, as the former per-group concat
+    produced them.
+
+    Args:
+        pd_f (pd.DataFrame): Trajectory rows with id, width and xVelocity
+        length_threshold (float): Length above which a vehicle is a bus
+        backend (str): 'pandas' or 'polars'
+    """
+    if backend == "polars":
+        return _filter_and_classify_polars(pd_f, length_threshold)
+    if backend != "pandas":
+        raise ValueError(f"unknown backend: {backend}")
+    # integer codes in sorted id order, -1 for missing ids
+    codes, uniques = pd.factorize(pd_f["id"], sort=True)
+    velocity = pd_f["xVelocity"].to_numpy()
+    negative = ~(velocity >= 0)
+    dropped = np.zeros(len(uniques) + 1, dtype=bool)
+    dropped[codes[negative]] = True
+    dropped[-1] = True
+    keep = np.flatnonzero(~dropped[codes])
+    order = keep[np.argsort(codes[keep], kind="stable")]
+    df = pd_f.iloc[order].copy()
+    df["vehicleType"] = np.where(df["width"] > length_threshold, "bus", "car")
+    return df
+
+
+def _filter_and_classify_polars(pd_f, length_threshold):
+    import polars as pl
+
+    index_name = pd_f.index.name
+    frame = pl.from_pandas(pd_f.reset_index(names="__index__"))
+    frame = (
+        frame.filter(pl.col("xVelocity").ge(0).fill_null(False).all().over("id"))
+        .filter(pl.col("id").is_not_null())
+        .sort("id", maintain_order=True)
+    )
+    df = frame.to_pandas().set_index("__index__")
+    df.index.name = index_name
+    df["vehicleType"] = np.where(df["width"] > length_threshold, "bus", "car")
     return df
 
 
-def iqr_filter(data, column) -> pd.DataFrame:
-    Q1 = data[column].quantile(0.05)
-    Q3 = data[column].quantile(0.95)
-    IQR = Q3 - Q1
-    return data[(data[column] >= (Q1 - 1.5 * IQR)) & (data[column] <= (Q3 + 1.5 * IQR))]
+def iqr_bounds(data, columns, low=0.05, high=0.95):
+    """Bounds kept by iqr_filter for several columns from one quantile pass."""
+    quantiles = data[columns].quantile([low, high])
+    bounds = {}
+    for column in columns:
+        q1, q3 = quantiles[column].iloc[0], quantiles[column].iloc[1]
+        iqr = q3 - q1
+        bounds[column] = (q1 - 1.5 * iqr, q3 + 1.5 * iqr)
+    return bounds
+
+
+def iqr_filter(data, column, bounds=None) -> pd.DataFrame:
+    lower, upper = bounds or iqr_bounds(data, [column])[column]
+    return data[(data[column] >= lower) & (data[column] <= upper)]
 
 def cal_kl_divergence(a_cache, b_cache, variables, vehicle_types):
     a_kde_data = a_cache["hist_kde_data"]
@@ -58,6 +116,140 @@ def cal_kl_divergence(a_cache, b_cache, variables, vehicle_types):
 
     return kl_list
 
+def stack_kde(caches, keys):
+    """
+    Stack the KDE curves of many caches for batch_kl_divergence.
+
+    Returns lo, hi (C x K) grid ranges, kde_y (C x K x M) and present (C x K),
+    False where a cache lacks a key. All curves must have the same length.
+    """
+    lengths = {
+        len(cache["hist_kde_data"][key][3])
+        for cache in caches
+        for key in keys
+        if key in cache["hist_kde_data"]
+    }
+    if len(lengths) > 1:
+        raise ValueError(f"KDE grids of different lengths: {sorted(lengths)}")
+    m = lengths.pop() if lengths else 1
+    lo = np.zeros((len(caches), len(keys)))
+    hi = np.ones((len(caches), len(keys)))
+    kde_y = np.ones((len(caches), len(keys), m))
+    present = np.zeros((len(caches), len(keys)), dtype=bool)
+    for c, cache in enumerate(caches):
+        for k, key in enumerate(keys):
+            if key in cache["hist_kde_data"]:
+                *_, x, y = cache["hist_kde_data"][key]
+                lo[c, k], hi[c, k] = x[0], x[-1]
+                kde_y[c, k] = y
+                present[c, k] = True
+    return lo, hi, kde_y, present
+
+
+def _interp_uniform(lo, hi, grid_lo, grid_hi, y, rows, points=1000):
+    """
+    np.interp of the curves y on linspace(grid_lo, grid_hi) at
+    linspace(lo, hi, points), batched over the leading axes of lo.
+
+    rows gives, per entry of lo, the row of y (flattened to rows x M) that
+    holds its curve, so a shared reference is not copied per candidate.
+    """
+    n = y.shape[-1]
+    scale = (n - 1) / (grid_hi - grid_lo)
+    first = (lo - grid_lo) * scale
+    last = (hi - grid_lo) * scale
+    position = first[..., None] + (last - first)[..., None] * np.linspace(0, 1, points)
+    np.clip(position, 0, n - 1, out=position)
+    left = np.minimum(position.astype(np.int64), n - 2)
+    position -= left
+    left += (rows * n)[..., None]
+    flat = y.reshape(-1)
+    y_left = flat[left]
+    y_right = flat[left + 1]
+    y_right -= y_left
+    y_right *= position
+    y_right += y_left
+    return y_right
+
+
+def batch_kl_divergence(
+    a_cache,
+    b_caches,
+    variables=["xAcceleration", "dhw", "xVelocity"],
+    vehicle_types=["car", "bus"],
+    chunk=16,
+):
+    """
+    KL divergence of a reference against many candidate caches at once.
+
+    Returns a (candidates x keys) matrix in the key order of
+    cal_kl_divergence. As there, an entry is inf if the KDE ranges do not
+    overlap; keys missing from the reference or a candidate, which
+    cal_kl_divergence skips, are NaN (see kl_row).
+
+    Args:
+        a_cache (dict): Reference distributions (_cache.pkl layout)
+        b_caches (list): Candidate distributions
+        chunk (int): Candidates processed per vectorized block
+    """
+    keys = [f"{vtype}_{variable}" for vtype in vehicle_types for variable in variables]
+    return batch_kl_stacked(stack_kde([a_cache], keys), b_caches, keys, chunk)
+
+
+def batch_kl_stacked(reference, b_caches, keys, chunk=16):
+    """
+    batch_kl_divergence with the reference side already stacked.
+
+    Args:
+        reference (tuple): stack_kde([a_cache], keys) of the reference, e.g.
+            precomputed once per worker by reference.ReferenceDistributions
+        b_caches (list): Candidate distributions
+        keys (list): "<vtype>_<variable>" keys of the columns
+        chunk (int): Candidates processed per vectorized block
+    """
+    a_lo, a_hi, a_y, a_present = reference
+    result = np.full((len(b_caches), len(keys)), np.nan)
+    for start in range(0, len(b_caches), chunk):
+        b_lo, b_hi, b_y, b_present = stack_kde(b_caches[start : start + chunk], keys)
+        lo = np.maximum(a_lo, b_lo)
+        hi = np.minimum(a_hi, b_hi)
+        overlap = lo < hi
+        a_rows = np.broadcast_to(np.arange(len(keys)), lo.shape)
+        b_rows = np.arange(lo.size).reshape(lo.shape)
+        a_common = _interp_uniform(lo, hi, a_lo, a_hi, a_y, a_rows)
+        b_common = _interp_uniform(lo, hi, b_lo, b_hi, b_y, b_rows)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            a_common /= a_common.sum(axis=-1, keepdims=True)
+            b_common /= b_common.sum(axis=-1, keepdims=True)
+            kl = rel_entr(a_common, b_common).sum(axis=-1)
+        kl = np.where(overlap, kl, np.inf)
+        block = result[start : start + chunk]
+        present = a_present & b_present
+        block[present] = kl[present]
+    return result
+
+
+def kl_row(row):
+    """One row of batch_kl_divergence as the list cal_kl_divergence returns."""
+    return [value for value in row if not np.isnan(value)]
+
+
+def batch_kl_from_files(
+    a_cache_path,
+    b_cache_paths,
+    variables=["xAcceleration", "dhw", "xVelocity"],
+    vehicle_types=["car", "bus"],
+):
+    """batch_kl_divergence for _cache.pkl files, e.g. all saved data_raw runs."""
+    with open(a_cache_path, "rb") as f:
+        a_cache = pickle.load(f)
+    b_caches = []
+    for path in b_cache_paths:
+        with open(path, "rb") as f:
+            b_caches.append(pickle.load(f))
+    return batch_kl_divergence(a_cache, b_caches, variables, vehicle_types)
+
+
 def get_all_kl_divergence(
     a_cache_path,
     b_cache_path,
@@ -76,14 +268,82 @@ def get_all_kl_divergence(
 
 
 
-def save_distributions(
+def fft_kde(data, kde_x, oversample=4):
+    """
+    gaussian_kde (Scott's rule) on an evenly spaced grid by binning + FFT.
+
+    The samples are linearly binned onto a grid oversample times finer than
+    kde_x and convolved with the sampled Gaussian kernel, O(N + M log M)
+    instead of O(N * M). kde_x must span the data, as the
+    linspace(min, max) grids of save_distributions do.
+
+    Tolerance: the largest deviation from gaussian_kde is below 1e-5 of the
+    peak density (bench_kde measures 2e-7 to 6e-6 for 20 to 500k samples, the
+    six distributions of a merge recording stay within 6e-6 and their KL
+    vector within 1e-6). The binning error grows as (step / bandwidth)^2,
+    so the bound needs the bandwidth to span a few fine grid steps, which
+    holds unless a few far outliers stretch the grid. Densities the FFT cannot
+    resolve (below ~1e-12 of the peak, in wide gaps between samples) are
+    replaced by the contribution of the nearest sample, so they never drop
+    to zero where gaussian_kde is positive.
+
+    Args:
+        data (array): Samples
+        kde_x (array): Evenly spaced evaluation grid covering the data
+        oversample (int): Fine grid steps per step of kde_x
+    """
+    data = np.asarray(data, dtype=float)
+    n = len(data)
+    bandwidth = data.std(ddof=1) * n ** (-1 / 5)
+    if not bandwidth > 0:
+        # gaussian_kde fails the same way on constant data
+        raise np.linalg.LinAlgError("singular data covariance matrix")
+    lo, hi = kde_x[0], kde_x[-1]
+    m = (len(kde_x) - 1) * oversample + 1
+    step = (hi - lo) / (m - 1)
+    position = (data - lo) / step
+    left = np.clip(np.floor(position).astype(np.int64), 0, m - 2)
+    right_weight = position - left
+    counts = np.bincount(left, weights=1 - right_weight, minlength=m)
+    counts += np.bincount(left + 1, weights=right_weight, minlength=m)
+    offsets = np.arange(-(m - 1), m) * step
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    norm = n * bandwidth * np.sqrt(2 * np.pi)
+    kde_y = fftconvolve(counts, kernel, mode="same")[::oversample] / norm
+    unresolved = kde_y < 1e-12 * kde_y.max()
+    if unresolved.any():
+        samples = np.sort(data)
+        x = kde_x[unresolved]
+        idx = np.clip(np.searchsorted(samples, x), 1, n - 1)
+        distance = np.minimum(np.abs(x - samples[idx - 1]), np.abs(samples[idx] - x))
+        kde_y[unresolved] = np.exp(-0.5 * (distance / bandwidth) ** 2) / norm
+    return kde_y
+
+
+def kde_on_grid(data, kde_x, kde="auto"):
+    """
+    Evaluate the Scott's rule KDE of data on kde_x.
+
+    Args:
+        kde (str): 'exact' (scipy gaussian_kde), 'fft' (fft_kde) or 'auto',
+            fft_kde from KDE_FFT_MIN_SAMPLES samples on
+    """
+    if kde == "auto":
+        kde = "fft" if len(data) >= KDE_FFT_MIN_SAMPLES else "exact"
+    if kde == "fft":
+        return fft_kde(data, kde_x)
+    if kde == "exact":
+        return gaussian_kde(data)(kde_x)
+    raise ValueError(f"unknown kde: {kde}")
+
+
+def compute_distributions(
     df,
-    output_dir="",
     variables=["xAcceleration", "dhw", "xVelocity"],
-    vehicle_types=  ["car", "bus"]
+    vehicle_types=["car", "bus"],
+    kde="auto",
 ):
-
-    cache_file_path = os.path.join(output_dir, "_cache.pkl")
+    """Return the distributions of df in the _cache.pkl layout, without writing it."""
     hist_kde_data = {}
     stats_data = {}
     vehicle_count = {
@@ -94,8 +354,9 @@ def save_distributions(
 
     for vtype in vehicle_types:
         vehicle_data = df[df["vehicleType"] == vtype]
+        bounds = iqr_bounds(vehicle_data, variables)
         for variable in variables:
-            filteredData = iqr_filter(vehicle_data, variable)
+            filteredData = iqr_filter(vehicle_data, variable, bounds[variable])
             if variable == "dhw":
                 filteredData = filteredData[
                     filteredData[variable] > 0.2
@@ -106,9 +367,8 @@ def save_distributions(
                 data = filteredData[variable].dropna()
 
                 if cache_key not in hist_kde_data:
-                    kde = gaussian_kde(data)
                     kde_x = np.linspace(data.min(), data.max(), 1000)
-                    kde_y = kde(kde_x)
+                    kde_y = kde_on_grid(data.to_numpy(), kde_x, kde)
                     hist_data, bins = np.histogram(data, bins=80, density=True)
                     bin_width = bins[1] - bins[0]
                     bin_centers = (bins[:-1] + bins[1:]) / 2
@@ -126,22 +386,31 @@ def save_distributions(
                         "std": data.std(),
                     }
 
+    return {"hist_kde_data": hist_kde_data, "stats_data": stats_data}
+
+
+def save_distributions(
+    df,
+    output_dir="",
+    variables=["xAcceleration", "dhw", "xVelocity"],
+    vehicle_types=  ["car", "bus"],
+    kde="auto",
+):
+
+    cache = compute_distributions(df, variables, vehicle_types, kde)
+    cache_file_path = os.path.join(output_dir, "_cache.pkl")
     with open(cache_file_path, "wb") as f:
-        pickle.dump({"hist_kde_data": hist_kde_data, "stats_data": stats_data}, f)
+        pickle.dump(cache, f)
+    return cache
 
 
 
 
-def merge_data(base_dir, start_index=1, end_index=65):
-    folders = [os.path.join(base_dir, f"DJI_{i:04d}") for i in range(start_index, end_index + 1)]
-    
-    def csv_path_exists(index, folder):
-        path = os.path.join(folder, f"{index:02d}_tracks.csv")
-        return path if os.path.isfile(path) else None
-    
-    csv_paths = filter(None, map(lambda t: csv_path_exists(t[0], t[1]), enumerate(folders, start=start_index)))
-    df_list = [pd.read_csv(path) for path in csv_paths]
-    return pd.concat(df_list) if df_list else pd.DataFrame()
+def merge_data(
+    base_dir, start_index=1, end_index=65, processes=None, cache_dir=INGEST_CACHE_DIR
+):
+    """Tracks of the recordings in the range, see ingest.load_tracks."""
+    return load_tracks(base_dir, start_index, end_index, processes, cache_dir)
 
 
 def compute_distribution(
@@ -150,15 +419,22 @@ def compute_distribution(
     start_index=1,
     end_index=65,
     env="merge",
+    processes=None,
 ):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    cache_dir = os.path.join(output_dir, "data_cache")
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
 
     df = merge_data(
-        base_dir, start_index=start_index, end_index=end_index
+        base_dir,
+        start_index=start_index,
+        end_index=end_index,
+        processes=processes,
+        cache_dir=os.path.join(output_dir, "ingest_cache"),
     )
     filtered_data = filter_and_classify(df)
-    save_distributions(filtered_data, output_dir, env=env)
+    with open(os.path.join(cache_dir, f"{env}_cache.pkl"), "wb") as f:
+        pickle.dump(compute_distributions(filtered_data), f)
 
 
 if __name__ == "__main__":
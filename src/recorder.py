@@ -0,0 +1,127 @@
+"""
+Columnar in-memory trajectory recorder.
+
+Rows recorded from the measurement edge are appended step by step into
+preallocated NumPy column buffers that grow by doubling. The evaluation reads
+the buffers directly as a DataFrame; CSV and Parquet files are only written
+when a run asks for them.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+
+RECORD_COLUMNS = [
+    "frame",
+    "id",
+    "width",
+    "xVelocity",
+    "yVelocity",
+    "xAcceleration",
+    "dhw",
+]
+
+VALUE_COLUMNS = RECORD_COLUMNS[2:]
+
+SINK_FILES = {
+    "csv": "record.csv",
+    "parquet": "record.parquet",
+}
+
+
+class TrajectoryRecorder:
+    """
+    Growable column store for the recorded trajectory rows.
+
+    Vehicle ids are stored as integer codes, the original SUMO ids are kept
+    in id_names and restored only when a file sink is written.
+
+    Args:
+        capacity (int): Number of rows preallocated per column
+        decimals (int): Values are rounded like the former CSV output
+    """
+
+    def __init__(self, capacity=1 << 16, decimals=3):
+        self.size = 0
+        self.decimals = decimals
+        self.id_codes = {}
+        self.id_names = []
+        self.columns = {"frame": np.empty(capacity, dtype=np.int32)}
+        self.columns["id"] = np.empty(capacity, dtype=np.int32)
+        for name in VALUE_COLUMNS:
+            self.columns[name] = np.empty(capacity, dtype=np.float64)
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, rows):
+        capacity = len(self.columns["frame"])
+        if self.size + rows <= capacity:
+            return
+        while capacity < self.size + rows:
+            capacity *= 2
+        for name, column in self.columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[: self.size] = column[: self.size]
+            self.columns[name] = grown
+
+    def encode(self, v_ids):
+        codes = []
+        for vid in v_ids:
+            code = self.id_codes.get(vid)
+            if code is None:
+                code = len(self.id_names)
+                self.id_codes[vid] = code
+                self.id_names.append(vid)
+            codes.append(code)
+        return codes
+
+    def append(self, step, v_ids, values):
+        """
+        Append one simulation step as a block.
+
+        Args:
+            step (int): Simulation step of all rows
+            v_ids (list): SUMO vehicle ids
+            values (dict): Column name -> list of values aligned with v_ids
+        """
+        rows = len(v_ids)
+        if not rows:
+            return
+        self.reserve(rows)
+        block = slice(self.size, self.size + rows)
+        self.columns["frame"][block] = step
+        self.columns["id"][block] = self.encode(v_ids)
+        for name in VALUE_COLUMNS:
+            self.columns[name][block] = np.round(values[name], self.decimals)
+        self.size += rows
+
+    def to_arrays(self):
+        return {name: column[: self.size] for name, column in self.columns.items()}
+
+    def to_frame(self, id_names=False):
+        """
+        Return the recorded rows as a DataFrame.
+
+        Args:
+            id_names (bool): Replace the integer id codes by the SUMO ids
+        """
+        df = pd.DataFrame(self.to_arrays(), columns=RECORD_COLUMNS)
+        if id_names:
+            df["id"] = np.asarray(self.id_names, dtype=object)[df["id"].to_numpy()]
+        return df
+
+    def write(self, output_dir, sinks=("csv",)):
+        """Write the recorded rows to the given file sinks ('csv', 'parquet')."""
+        if not sinks:
+            return
+        df = self.to_frame(id_names=True)
+        for sink in sinks:
+            if sink not in SINK_FILES:
+                raise ValueError(f"unknown record sink: {sink}")
+            path = os.path.join(output_dir, SINK_FILES[sink])
+            if sink == "csv":
+                df.to_csv(path, index=False)
+            else:
+                df.to_parquet(path, index=False)
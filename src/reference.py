@@ -0,0 +1,157 @@
+"""
+Worker-resident reference distributions.
+
+Every evaluation scores a candidate against the scenario reference in
+output/data_cache/<env>_cache.pkl. Instead of unpickling that file per run,
+load_reference() converts it once into plain .npy arrays (KDE curves and grid
+ranges, stacked in key order) below output/data_cache/reference/, memory-maps
+them read-only and keeps the result per process, so all workers of a machine
+share the same pages. The stacked reference side of the KL step is prepared
+once per key set, and candidates are passed in memory as the dict returned by
+process_data.compute_distributions.
+
+A converted copy is named after the modification time and size of its source
+pickle; replacing the pickle makes the next load_reference() build a new one.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import pickle
+import numpy as np
+from util import OUTPUT_DIR
+from process_data import batch_kl_stacked, kl_row, stack_kde
+
+REFERENCE_DIR = os.path.join(OUTPUT_DIR, "data_cache", "reference")
+
+_references = {}
+_references_lock = threading.Lock()
+
+
+def reference_cache_path(env):
+    return os.path.join(OUTPUT_DIR, "data_cache", f"{env}_cache.pkl")
+
+
+class ReferenceDistributions:
+    """
+    Read-only KDE curves of a reference, stacked as arrays.
+
+    Args:
+        keys (list): "<vtype>_<variable>" keys of the rows
+        ranges (np.ndarray): K x 2 first and last point of each KDE grid
+        kde_y (np.ndarray): K x M KDE curves, possibly memory-mapped
+    """
+
+    def __init__(self, keys, ranges, kde_y):
+        self.keys = list(keys)
+        self.index = {key: k for k, key in enumerate(self.keys)}
+        self.ranges = ranges
+        self.kde_y = kde_y
+        self._stacked = {}
+
+    @classmethod
+    def from_cache(cls, cache):
+        """Stack a reference in the _cache.pkl layout."""
+        keys = list(cache["hist_kde_data"])
+        lo, hi, kde_y, _ = stack_kde([cache], keys)
+        return cls(keys, np.stack([lo[0], hi[0]], axis=1), kde_y[0])
+
+    @classmethod
+    def build(cls, cache_path, directory):
+        """Convert the reference pickle into the .npy files of directory."""
+        with open(cache_path, "rb") as f:
+            reference = cls.from_cache(pickle.load(f))
+        parent = os.path.dirname(directory)
+        os.makedirs(parent, exist_ok=True)
+        scratch = tempfile.mkdtemp(dir=parent)
+        try:
+            np.save(os.path.join(scratch, "kde_y.npy"), reference.kde_y)
+            np.save(os.path.join(scratch, "ranges.npy"), reference.ranges)
+            with open(os.path.join(scratch, "keys.json"), "w") as f:
+                json.dump(reference.keys, f)
+            # another worker may have built the same directory meanwhile
+            try:
+                os.rename(scratch, directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    @classmethod
+    def open(cls, directory, mmap=True):
+        mode = "r" if mmap else None
+        with open(os.path.join(directory, "keys.json")) as f:
+            keys = json.load(f)
+        return cls(
+            keys,
+            np.load(os.path.join(directory, "ranges.npy"), mmap_mode=mode),
+            np.load(os.path.join(directory, "kde_y.npy"), mmap_mode=mode),
+        )
+
+    def grids(self):
+        """Key -> (lo, hi) range of the reference KDE grid."""
+        return {
+            key: (float(lo), float(hi)) for key, (lo, hi) in zip(self.keys, self.ranges)
+        }
+
+    def stacked(self, keys):
+        """stack_kde([reference], keys), prepared once per key set."""
+        keys = tuple(keys)
+        if keys not in self._stacked:
+            rows = [self.index.get(key, 0) for key in keys]
+            present = np.array([key in self.index for key in keys])
+            self._stacked[keys] = (
+                np.asarray(self.ranges[rows, 0])[None],
+                np.asarray(self.ranges[rows, 1])[None],
+                np.asarray(self.kde_y[rows])[None],
+                present[None],
+            )
+        return self._stacked[keys]
+
+    def batch_kl_divergence(
+        self,
+        caches,
+        variables=["xAcceleration", "dhw", "xVelocity"],
+        vehicle_types=["car", "bus"],
+    ):
+        """process_data.batch_kl_divergence with this reference as a_cache."""
+        keys = [f"{vtype}_{variable}" for vtype in vehicle_types for variable in variables]
+        return batch_kl_stacked(self.stacked(keys), caches, keys)
+
+    def kl_divergence(
+        self,
+        cache,
+        variables=["xAcceleration", "dhw", "xVelocity"],
+        vehicle_types=["car", "bus"],
+    ):
+        """KL vector of one candidate, as cal_kl_divergence returns it."""
+        return kl_row(self.batch_kl_divergence([cache], variables, vehicle_types)[0])
+
+
+def load_reference(env=None, cache_path=None):
+    """
+    Return the ReferenceDistributions of a scenario, loaded once per process.
+
+    Args:
+        env (str): Scenario whose output/data_cache/<env>_cache.pkl is used
+        cache_path (str): Reference pickle, instead of env
+    """
+    cache_path = os.path.abspath(cache_path or reference_cache_path(env))
+    stat = os.stat(cache_path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    with _references_lock:
+        loaded = _references.get(cache_path)
+        if loaded is not None and loaded[0] == stamp:
+            return loaded[1]
+        stem = os.path.splitext(os.path.basename(cache_path))[0]
+        directory = os.path.join(
+            REFERENCE_DIR, f"{stem}-{stat.st_mtime_ns}-{stat.st_size}"
+        )
+        if not os.path.isdir(directory):
+            ReferenceDistributions.build(cache_path, directory)
+        reference = ReferenceDistributions.open(directory)
+        _references[cache_path] = (stamp, reference)
+        return reference
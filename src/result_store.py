@@ -0,0 +1,396 @@
+"""
+Indexed store of optimization results.
+
+bayesian_optimize adds every registered result to an SQLite database through
+its logger hook (ResultLogger), and run_optimization adds the final pymoo
+populations, so all campaigns of all scenarios can be queried in one place.
+Best-so-far and top-K queries walk the (run, target), (env, target) and target
+indexes instead of parsing a whole JSON log, and tail() returns the rows after
+a cursor for live monitoring.
+
+Every result records the simulation steps its run took, shorter than the
+horizon for runs ended by an AdaptiveHorizon or stopped by fidelity or
+EarlyAbort. Results of runs stopped by EarlyAbort are marked censored: their target is
+only a bound of the score of the full run, and best() skips them.
+
+The JSON logs in log/ are still written, bayes_opt replays them on resume.
+Logs from before the store are imported by open_run() when a run of the same
+name is opened, or all at once by import_logs(). Both also catch up with a
+log that changed after the last result of its run, e.g. of a run without the
+store: entries are matched by position, and those past the results of the run
+are added.
+"""
+
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from bayes_opt.event import Events
+from eval_cache import SQLiteStore
+from util import OUTPUT_DIR, LOG_DIR
+
+RESULTS_PATH = os.path.join(OUTPUT_DIR, "results.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    env TEXT,
+    algorithm TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_updated ON runs (algorithm, updated);
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    env TEXT,
+    target REAL NOT NULL,
+    params TEXT NOT NULL,
+    objectives TEXT,
+    steps_run INTEGER,
+    censored INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_run_target ON results (run_id, target);
+CREATE INDEX IF NOT EXISTS results_run_id ON results (run_id, id);
+CREATE INDEX IF NOT EXISTS results_env_target ON results (env, target);
+CREATE INDEX IF NOT EXISTS results_target ON results (target);
+"""
+
+
+# columns added to the results table since its first version
+ADDED_COLUMNS = [
+    ("steps_run", "INTEGER"),
+    ("censored", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+
+def env_of(name):
+    """Scenario of a run named like the BO logs, e.g. right_2024-05-01_10:00."""
+    return name.split("_")[0]
+
+
+def read_log(path):
+    """(params, target) of the entries of a JSONLogger file."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                yield entry["params"], entry["target"]
+
+
+class ResultStore(SQLiteStore):
+    """
+    Append-only results of optimization runs, shared through one SQLite file.
+
+    A run is one BO log or one pymoo algorithm of a scenario; a result has
+    the target the optimizer maximized (negative mean KL), its parameters,
+    for pymoo the objective vector, the simulation steps of the run and
+    whether the run was censored.
+
+    Args:
+        path (str): SQLite database file
+        timeout (float): Seconds to wait for a lock held by another writer
+    """
+
+    schema = SCHEMA
+
+    def __init__(self, path=RESULTS_PATH, timeout=60):
+        super().__init__(path, timeout)
+
+    def migrate(self, conn):
+        columns = self.columns(conn, "results")
+        if not columns:
+            return
+        with conn:
+            for name, definition in ADDED_COLUMNS:
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE results ADD COLUMN {name} {definition}")
+
+    def run_id(self, name):
+        row = (
+            self.connect()
+            .execute("SELECT run_id FROM runs WHERE name=?", (name,))
+            .fetchone()
+        )
+        return row and row[0]
+
+    def open_run(self, name, env=None, algorithm="bo", log=None, reset=False):
+        """
+        Return the id of the run called name, created if it is new.
+
+        Args:
+            name (str): Run name, for BO the log name without .log
+            env (str): Scenario, from the name if None
+            algorithm (str): 'bo' or the pymoo algorithm
+            log (str): JSONLogger file of the run, e.g. of a run from before
+                the store; its entries the run lacks are imported
+            reset (bool): Drop the results of an existing run of that name
+        """
+        env = env or env_of(name)
+        conn = self.connect()
+        if reset:
+            with conn:
+                conn.execute(
+                    "DELETE FROM results WHERE run_id IN "
+                    "(SELECT run_id FROM runs WHERE name=?)",
+                    (name,),
+                )
+                conn.execute("DELETE FROM runs WHERE name=?", (name,))
+        now = time.time()
+        with conn:
+            created = conn.execute(
+                "INSERT OR IGNORE INTO runs (name, env, algorithm, created, updated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (name, env, algorithm, now, now),
+            ).rowcount
+        run_id, updated = conn.execute(
+            "SELECT run_id, updated FROM runs WHERE name=?", (name,)
+        ).fetchone()
+        if log is None or not os.path.isfile(log):
+            return run_id
+        mtime = os.path.getmtime(log)
+        # a run that received its last result after the log was written has
+        # all of its entries
+        if created or mtime > updated:
+            self.sync_log(run_id, env, log)
+        if created:
+            # dated like the log, so latest_run() orders it like the files
+            with conn:
+                conn.execute(
+                    "UPDATE runs SET created=?, updated=? WHERE run_id=?",
+                    (mtime, mtime, run_id),
+                )
+        return run_id
+
+    def sync_log(self, run_id, env, log):
+        """
+        Add the entries of a JSONLogger file past the results of run_id;
+        returns their count. Called by open_run() for a log newer than the
+        last result of its run.
+        """
+        mtime = os.path.getmtime(log)
+        conn = self.connect()
+        with conn:
+            # the write lock keeps two processes from adding the same entries
+            conn.execute("BEGIN IMMEDIATE")
+            (count,) = conn.execute(
+                "SELECT COUNT(*) FROM results WHERE run_id=?", (run_id,)
+            ).fetchone()
+            entries = [
+                (params, target, None, None, False)
+                for params, target in read_log(log)
+                if target is not None and np.isfinite(target)
+            ][count:]
+            self.insert(conn, run_id, env, entries)
+            # dated like the log, which is newer than the last result
+            conn.execute("UPDATE runs SET updated=? WHERE run_id=?", (mtime, run_id))
+        return len(entries)
+
+    def add(
+        self,
+        run_id,
+        env,
+        params,
+        target,
+        objectives=None,
+        steps_run=None,
+        censored=False,
+    ):
+        """Append one result; non-finite targets are skipped."""
+        self.add_many(
+            run_id, env, [(params, target, objectives, steps_run, censored)]
+        )
+
+    def add_many(self, run_id, env, rows):
+        """
+        Append (params, target, objectives, steps_run, censored) rows in one
+        transaction. A missing steps_run or censored may be None or NaN, as
+        pymoo stacks the None of failed individuals.
+        """
+        conn = self.connect()
+        with conn:
+            self.insert(conn, run_id, env, rows)
+
+    @staticmethod
+    def insert(conn, run_id, env, rows):
+        """add_many() within the transaction of conn."""
+        now = time.time()
+        values = []
+        for params, target, objectives, steps_run, censored in rows:
+            if target is None or not np.isfinite(target):
+                continue
+            if objectives is not None:
+                objectives = json.dumps([float(v) for v in objectives])
+            params = json.dumps({k: float(v) for k, v in params.items()})
+            steps_run = None if pd.isna(steps_run) else int(steps_run)
+            censored = not pd.isna(censored) and bool(censored)
+            values.append(
+                (
+                    run_id,
+                    env,
+                    float(target),
+                    params,
+                    objectives,
+                    steps_run,
+                    censored,
+                    now,
+                )
+            )
+        conn.executemany(
+            "INSERT INTO results "
+            "(run_id, env, target, params, objectives, steps_run, censored, "
+            "created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            values,
+        )
+        conn.execute("UPDATE runs SET updated=? WHERE run_id=?", (now, run_id))
+
+    def import_logs(self, folder=LOG_DIR):
+        """
+        Import the BO logs of folder that have no run yet or changed after the
+        last result of their run; returns their count.
+        """
+        conn = self.connect()
+        updated = dict(conn.execute("SELECT name, updated FROM runs"))
+        imported = 0
+        for file in sorted(os.listdir(folder)):
+            name, suffix = os.path.splitext(file)
+            if suffix != ".log":
+                continue
+            path = os.path.join(folder, file)
+            if name not in updated or os.path.getmtime(path) > updated[name]:
+                self.open_run(name, log=path)
+                imported += 1
+        return imported
+
+    def latest_run(self, algorithm="bo"):
+        """Name of the run of algorithm that received a result last."""
+        row = (
+            self.connect()
+            .execute(
+                "SELECT name FROM runs WHERE algorithm=? "
+                "ORDER BY updated DESC LIMIT 1",
+                (algorithm,),
+            )
+            .fetchone()
+        )
+        return row and row[0]
+
+    def select(self, where, args, order, limit=None):
+        query = (
+            "SELECT results.id, runs.name, results.target, results.params, "
+            "results.objectives, results.steps_run, results.censored "
+            "FROM results JOIN runs USING (run_id)"
+        )
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += f" ORDER BY {order}"
+        if limit is not None:
+            query += " LIMIT ?"
+            args = [*args, limit]
+        rows = self.connect().execute(query, args).fetchall()
+        return pd.DataFrame(
+            [
+                {
+                    **json.loads(params),
+                    "target": target,
+                    "objectives": objectives and json.loads(objectives),
+                    "steps_run": steps_run,
+                    "censored": bool(censored),
+                    "run": name,
+                    "id": id,
+                }
+                for id, name, target, params, objectives, steps_run, censored in rows
+            ]
+        )
+
+    def filters(self, run=None, env=None, algorithm=None, censored=None):
+        where, args = [], []
+        if run is not None:
+            where.append("results.run_id=(SELECT run_id FROM runs WHERE name=?)")
+            args.append(run)
+        if env is not None:
+            where.append("results.env=?")
+            args.append(env)
+        if algorithm is not None:
+            where.append("runs.algorithm=?")
+            args.append(algorithm)
+        if censored is not None:
+            where.append("results.censored=?")
+            args.append(int(censored))
+        return where, args
+
+    def top_k(self, k=10, run=None, env=None, algorithm=None, censored=None):
+        """
+        The k results with the highest target, optionally of one run,
+        scenario or algorithm and only (un)censored ones, as a DataFrame with
+        a column per parameter and target, objectives, steps_run, censored,
+        run and id columns.
+        """
+        where, args = self.filters(run, env, algorithm, censored)
+        return self.select(where, args, "results.target DESC", k)
+
+    def best(self, run=None, env=None, algorithm=None):
+        """(params, target) of the best uncensored result, None if there is none."""
+        df = self.top_k(1, run, env, algorithm, censored=False)
+        if df.empty:
+            return None
+        row = df.iloc[0]
+        params = row.drop(
+            ["target", "objectives", "steps_run", "censored", "run", "id"]
+        ).to_dict()
+        return params, float(row["target"])
+
+    def tail(self, after=0, run=None, env=None, algorithm=None, limit=None):
+        """
+        Results added after the result with id after, oldest first. Pass the
+        largest id returned as after of the next call to follow a live run.
+        """
+        where, args = self.filters(run, env, algorithm)
+        return self.select(
+            [*where, "results.id>?"], [*args, int(after)], "results.id", limit
+        )
+
+    def results(self, run):
+        """All results of a run in the order they were added, like json2pd."""
+        return self.tail(run=run)
+
+
+class ResultLogger:
+    """
+    bayes_opt subscriber that adds every registered result to a run.
+
+    Columns bayes_opt does not know about, steps_run and censored, are set with
+    annotate() before the result is registered.
+
+    Args:
+        store (ResultStore): Store to write to
+        run_id (int): Run from ResultStore.open_run
+        env (str): Scenario of the run
+    """
+
+    def __init__(self, store, run_id, env):
+        self.store = store
+        self.run_id = run_id
+        self.env = env
+        self.columns = {}
+
+    def annotate(self, **columns):
+        """Columns of the next registered result, see ResultStore.add."""
+        self.columns = columns
+
+    def update(self, event, instance):
+        if event != Events.OPTIMIZATION_STEP:
+            return
+        # the last registered point, without building instance.res
+        space = instance.space
+        self.store.add(
+            self.run_id,
+            self.env,
+            space.array_to_params(space.params[-1]),
+            space.target[-1],
+            **self.columns,
+        )
+        self.columns = {}
@@ -0,0 +1,381 @@
+"""
+Failure-tolerant, shared task scheduler for the optimizer workers.
+
+TaskScheduler runs a fixed number of long-lived worker processes for any
+number of calibration campaigns at once, e.g. the BO and pymoo runs of all
+scenarios. A campaign is a stream of tasks with its own function, priority
+and weight. Tasks wait in the backlog of their campaign in the parent and are
+handed to idle workers one at a time through the inbox of their slot, so the
+scheduler always knows what each slot is doing, even if a worker dies before
+it could report anything. Results come back through a pipe per slot, so a
+worker killed in the middle of a report only breaks its own pipe:
+
+- a task whose evaluation fails (None or an exception) is retried up to the
+  retries of its campaign, then reported as failed;
+- a task that runs longer than the timeout of its campaign is treated the
+  same way, and its worker is killed together with its SUMO children and
+  replaced;
+- a worker that dies for any other reason is replaced as well.
+
+Each worker puts itself into its own process group on start, which is how
+the SUMO processes it started are found and killed with it. The slot count
+therefore never shrinks, and every submitted task ends in exactly one outcome
+delivered to its campaign.
+
+An idle slot goes to the campaign with the highest priority that has queued
+tasks; among equal priorities to the one with the fewest running tasks per
+unit of weight, so busy campaigns share the workers in proportion to their
+weights and a campaign waiting for its last stragglers leaves its slots to
+the others.
+"""
+
+import collections
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import signal
+import threading
+import time
+from util import handle_exception
+
+
+def worker_main(slot, inbox, outbox):
+    """
+    Body of a worker process: evaluate tasks until a None sentinel and send
+    (task id, attempt, result) through the write end of the slot's pipe.
+    """
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+    while True:
+        message = inbox.get()
+        if message is None:
+            break
+        function, kwargs, task = message
+        result = None
+        try:
+            result = function(task, **kwargs)
+        except Exception as e:
+            handle_exception(e)
+        outbox.send((task["id"], task["attempt"], result))
+    outbox.close()
+
+
+class Campaign:
+    """
+    Tasks of one optimizer run on a TaskScheduler, see TaskScheduler.campaign.
+
+    Outcomes are collected with results(); result is None for a task that
+    failed on every attempt.
+    """
+
+    def __init__(
+        self, scheduler, name, function, kwargs, weight, priority, timeout, retries
+    ):
+        self.scheduler = scheduler
+        self.name = name
+        self.function = function
+        self.kwargs = kwargs or {}
+        self.weight = weight
+        self.priority = priority
+        self.timeout = timeout
+        self.retries = retries
+        self.backlog = collections.deque()
+        self.outcomes = queue.Queue()
+        self.running = 0
+        self.outstanding = 0
+        self.busy = 0.0
+        self.counts = {"submitted": 0, "finished": 0, "failed": 0, "retried": 0}
+
+    def submit(self, task):
+        """Queue a task dict; safe to call from any thread."""
+        self.scheduler.submit(self, task)
+
+    def results(self, timeout=1):
+        """(task, result) outcomes that arrived, waiting up to timeout seconds."""
+        outcomes = []
+        try:
+            outcomes.append(self.outcomes.get(timeout=timeout))
+            while True:
+                outcomes.append(self.outcomes.get_nowait())
+        except queue.Empty:
+            pass
+        return outcomes
+
+    def close(self):
+        """Drop the queued tasks and stop receiving outcomes."""
+        self.scheduler.close_campaign(self)
+
+    def stats(self):
+        return dict(
+            self.counts,
+            in_flight=self.outstanding,
+            running=self.running,
+            busy_seconds=self.busy,
+        )
+
+
+class TaskScheduler:
+    """
+    Long-lived worker processes shared by weighted, prioritized campaigns.
+
+    Args:
+        n_workers (int): Number of worker processes kept alive
+    """
+
+    # workers run on this host and may share its SQLite stores
+    local = True
+
+    def __init__(self, n_workers):
+        self.n_workers = n_workers
+        self.workers = {}
+        self.inboxes = {}
+        self.outboxes = {}
+        self.running = {}
+        self.campaigns = {}
+        self.tasks = {}
+        self.ids = itertools.count()
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.server = None
+        self.started = None
+        self.busy = 0.0
+        self.counts = {"timeouts": 0, "respawned": 0}
+
+    def start(self):
+        """Spawn the workers and the thread that collects their results."""
+        self.started = time.time()
+        for slot in range(self.n_workers):
+            self.spawn(slot)
+        self.server = threading.Thread(target=self.serve, daemon=True)
+        self.server.start()
+
+    def serve(self):
+        while not self.stopped.is_set():
+            self.poll(timeout=0.5)
+
+    def spawn(self, slot):
+        # a killed worker may leave its inbox and pipe in a broken state
+        self.inboxes[slot] = multiprocessing.Queue()
+        if slot in self.outboxes:
+            self.outboxes[slot].close()
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=worker_main, args=(slot, self.inboxes[slot], writer)
+        )
+        process.start()
+        # the worker holds the only write end, its pipe reports EOF once it dies
+        writer.close()
+        self.outboxes[slot] = reader
+        self.workers[slot] = process
+
+    @staticmethod
+    def kill(process):
+        """Kill a worker and every process of its group, e.g. SUMO."""
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (AttributeError, ProcessLookupError, PermissionError):
+            process.kill()
+        process.join()
+
+    def campaign(
+        self,
+        name,
+        function,
+        kwargs=None,
+        weight=1.0,
+        priority=0,
+        timeout=None,
+        retries=2,
+    ):
+        """
+        Open a campaign whose tasks are evaluated as function(task, **kwargs).
+
+        Args:
+            name (str): Unique name, used in the statistics
+            function (callable): Picklable function run in the workers; a
+                None result counts as a failure
+            kwargs (dict): Keyword arguments passed to every call of function
+            weight (float): Share of the workers among campaigns of the same
+                priority
+            priority (int): Campaigns with a higher priority are served first
+            timeout (float): Wall-clock seconds after which a task is killed,
+                None for no limit
+            retries (int): Additional attempts of a failed or timed-out task
+        """
+        with self.lock:
+            if name in self.campaigns:
+                raise ValueError(f"campaign already open: {name}")
+            campaign = Campaign(
+                self, name, function, kwargs, weight, priority, timeout, retries
+            )
+            self.campaigns[name] = campaign
+            return campaign
+
+    def close_campaign(self, campaign):
+        with self.lock:
+            for task in campaign.backlog:
+                self.tasks.pop(task["id"], None)
+                campaign.outstanding -= 1
+            campaign.backlog.clear()
+            self.campaigns.pop(campaign.name, None)
+
+    def submit(self, campaign, task):
+        with self.lock:
+            task = dict(task, id=next(self.ids), attempt=0, campaign=campaign.name)
+            self.tasks[task["id"]] = task
+            campaign.counts["submitted"] += 1
+            campaign.outstanding += 1
+            campaign.backlog.append(task)
+            self.dispatch()
+
+    def next_campaign(self):
+        waiting = [c for c in self.campaigns.values() if c.backlog]
+        if not waiting:
+            return None
+        return min(waiting, key=lambda c: (-c.priority, c.running / c.weight))
+
+    def dispatch(self):
+        """Hand queued tasks to idle slots; needs lock."""
+        for slot in self.workers:
+            if slot in self.running:
+                continue
+            campaign = self.next_campaign()
+            if campaign is None:
+                return
+            task = campaign.backlog.popleft()
+            campaign.running += 1
+            self.running[slot] = (task["id"], task["attempt"], time.time())
+            self.inboxes[slot].put((campaign.function, campaign.kwargs, task))
+
+    def release(self, slot):
+        """Free a slot and account its busy time; needs lock."""
+        task_id, _, started = self.running.pop(slot)
+        seconds = time.time() - started
+        self.busy += seconds
+        task = self.tasks.get(task_id)
+        campaign = task and self.campaigns.get(task["campaign"])
+        if campaign is not None:
+            campaign.running -= 1
+            campaign.busy += seconds
+
+    def retry_or_fail(self, task):
+        """Requeue a failed attempt or deliver the failure; needs lock."""
+        campaign = self.campaigns.get(task["campaign"])
+        if campaign is None:
+            self.tasks.pop(task["id"], None)
+            return
+        if task["attempt"] < campaign.retries:
+            task = dict(task, attempt=task["attempt"] + 1)
+            self.tasks[task["id"]] = task
+            campaign.counts["retried"] += 1
+            campaign.backlog.append(task)
+            return
+        self.finish(campaign, task, None)
+
+    def finish(self, campaign, task, result):
+        del self.tasks[task["id"]]
+        campaign.outstanding -= 1
+        campaign.counts["finished" if result is not None else "failed"] += 1
+        campaign.outcomes.put((task, result))
+
+    def poll(self, timeout=1):
+        """
+        Wait up to timeout seconds for worker results, deliver them to their
+        campaigns, recover timed-out and dead workers and refill idle slots.
+        """
+        slots = {reader: slot for slot, reader in self.outboxes.items()}
+        messages = []
+        for reader in multiprocessing.connection.wait(list(slots), timeout):
+            try:
+                while reader.poll():
+                    messages.append((slots[reader], *reader.recv()))
+            except (EOFError, OSError):
+                # the worker died; recover() replaces it and its pipe
+                del self.outboxes[slots[reader]]
+                reader.close()
+        with self.lock:
+            for slot, task_id, attempt, result in messages:
+                self.deliver(slot, task_id, attempt, result)
+            self.recover()
+            self.dispatch()
+
+    def deliver(self, slot, task_id, attempt, result):
+        """Handle the result of an attempt a slot ran; needs lock."""
+        if self.running.get(slot, (None, None))[:2] == (task_id, attempt):
+            self.release(slot)
+        task = self.tasks.get(task_id)
+        # a result of an attempt that was already given up on
+        if task is None or task["attempt"] != attempt:
+            return
+        campaign = self.campaigns.get(task["campaign"])
+        if campaign is None:
+            del self.tasks[task_id]
+        elif result is None:
+            self.retry_or_fail(task)
+        else:
+            self.finish(campaign, task, result)
+
+    def abandon(self, slot):
+        """Free a slot whose attempt will not report and retry it; needs lock."""
+        task_id, attempt, _ = self.running[slot]
+        self.release(slot)
+        task = self.tasks.get(task_id)
+        if task and task["attempt"] == attempt:
+            self.retry_or_fail(task)
+
+    def recover(self):
+        """Replace dead and timed-out workers, retrying their task; needs lock."""
+        now = time.time()
+        for slot, process in list(self.workers.items()):
+            entry = self.running.get(slot)
+            task = entry and self.tasks.get(entry[0])
+            campaign = task and self.campaigns.get(task["campaign"])
+            timeout = campaign.timeout if campaign else None
+            timed_out = (
+                entry is not None and timeout is not None and now - entry[2] > timeout
+            )
+            if process.is_alive() and not timed_out:
+                continue
+            if timed_out:
+                self.counts["timeouts"] += 1
+                print(f"Task {entry[0]} of {campaign.name} timed out after {timeout}s.")
+            self.kill(process)
+            if entry is not None:
+                self.abandon(slot)
+            self.counts["respawned"] += 1
+            self.spawn(slot)
+
+    def stats(self):
+        """Worker utilization since start() and the counters of all campaigns."""
+        with self.lock:
+            now = time.time()
+            capacity = self.capacity()
+            busy = self.busy + sum(now - entry[2] for entry in self.running.values())
+            return dict(
+                self.counts,
+                utilization=busy / capacity if capacity else 0.0,
+                campaigns={
+                    name: campaign.stats() for name, campaign in self.campaigns.items()
+                },
+            )
+
+    def capacity(self):
+        """Worker seconds available since start(); needs lock."""
+        if not self.started:
+            return 0.0
+        return (time.time() - self.started) * self.n_workers
+
+    def shutdown(self, timeout=10):
+        """Stop idle workers with sentinels, kill the rest and their groups."""
+        self.stopped.set()
+        if self.server is not None:
+            self.server.join()
+        for inbox in self.inboxes.values():
+            inbox.put(None)
+        for process in self.workers.values():
+            process.join(timeout=timeout)
+            self.kill(process)
+        for reader in self.outboxes.values():
+            reader.close()
@@ -0,0 +1,178 @@
+"""
+Surrogate models of PendingAwareSuggester.
+
+GlobalGP is the exact GP of bayes_opt fitted on all results; its fit grows as
+O(n^3), which is fine for a few hundred evaluations. TrustRegionGP follows
+TuRBO-1 (Eriksson et al., 2019) for long runs: a GP is fitted only on the
+max_local results nearest to the best point, and candidates are searched in a
+box around it whose size grows after repeated improvements and shrinks after
+repeated failures. A collapsed box restarts at a random point. The cost per
+suggestion is bounded by max_local, however many results the run collected.
+
+Both take the pending points as constant-liar fantasies, see
+batch_acquisition.
+"""
+
+import warnings
+import numpy as np
+from sklearn.base import clone
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import Matern
+from bayes_opt.util import acq_max
+
+
+class GlobalGP:
+    """Exact GP and acquisition search of the BayesianOptimization instance."""
+
+    name = "exact"
+
+    def __init__(self, optimizer):
+        self.optimizer = optimizer
+
+    def observe(self, x, target):
+        pass
+
+    def region(self, space):
+        return None
+
+    def propose(
+        self, space, params, target, fantasies, lie, util, random_state, region
+    ):
+        gp = clone(self.optimizer._gp)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            gp.fit(
+                np.vstack([params, fantasies]),
+                np.concatenate([target, np.full(len(fantasies), lie)]),
+            )
+        return acq_max(
+            ac=util.utility,
+            gp=gp,
+            y_max=target.max(),
+            bounds=space.bounds,
+            random_state=random_state,
+            y_max_params=params[target.argmax()],
+        )
+
+
+class TrustRegionGP:
+    """
+    TuRBO-style trust region with a local GP of bounded size.
+
+    Args:
+        length_init (float): Initial edge of the region in the unit cube
+        length_min (float): Edge below which the region restarts
+        length_max (float): Largest edge
+        success_tolerance (int): Improvements in a row that double the edge
+        failure_tolerance (int): Results in a row without improvement that
+            halve the edge, max(4, dimensions) if None
+        max_local (int): Results and fantasies the local GP is fitted on
+        n_candidates (int): Random candidates scored by the acquisition
+        perturb (int): Expected number of coordinates perturbed per candidate
+    """
+
+    name = "turbo"
+
+    def __init__(
+        self,
+        length_init=0.8,
+        length_min=0.5**7,
+        length_max=1.6,
+        success_tolerance=3,
+        failure_tolerance=None,
+        max_local=256,
+        n_candidates=5000,
+        perturb=20,
+    ):
+        self.length_init = length_init
+        self.length_min = length_min
+        self.length_max = length_max
+        self.success_tolerance = success_tolerance
+        self.failure_tolerance = failure_tolerance
+        self.max_local = max_local
+        self.n_candidates = n_candidates
+        self.perturb = perturb
+        self.length = length_init
+        self.successes = 0
+        self.failures = 0
+        self.restarts = 0
+        self.best = None
+        self.center = None
+
+    def observe(self, x, target):
+        """Update the region with a finished result (x in space units)."""
+        failure_tolerance = self.failure_tolerance or max(4, len(x))
+        if self.best is None or target > self.best + 1e-3 * abs(self.best):
+            if self.best is not None:
+                self.successes += 1
+                self.failures = 0
+            self.best = target
+            self.center = np.asarray(x, dtype=float)
+        else:
+            self.successes = 0
+            self.failures += 1
+        if self.successes >= self.success_tolerance:
+            self.length = min(2 * self.length, self.length_max)
+            self.successes = 0
+        elif self.failures >= failure_tolerance:
+            self.length /= 2
+            self.failures = 0
+        if self.length < self.length_min:
+            self.length = self.length_init
+            self.successes = 0
+            self.failures = 0
+            self.restarts += 1
+            self.best = None
+            self.center = None
+
+    def region(self, space):
+        """
+        Center (space units) and edge of the region; called with the lock of
+        the suggester held, as observe() may restart the region meanwhile.
+        """
+        if self.center is None:
+            self.center = space.random_sample()
+        return self.center.copy(), self.length
+
+    def propose(
+        self, space, params, target, fantasies, lie, util, random_state, region
+    ):
+        lower, upper = space.bounds[:, 0], space.bounds[:, 1]
+        span = upper - lower
+        center, length = region
+        center = (center - lower) / span
+        x = (np.vstack([params, fantasies]) - lower) / span
+        y = np.concatenate([target, np.full(len(fantasies), lie)])
+        local = np.argsort(np.sum((x - center) ** 2, axis=1))[: self.max_local]
+        d = len(center)
+        gp = GaussianProcessRegressor(
+            kernel=Matern(
+                length_scale=np.full(d, 0.5), length_scale_bounds=(5e-3, 4.0), nu=2.5
+            ),
+            alpha=1e-6,
+            normalize_y=True,
+            n_restarts_optimizer=0,
+            random_state=random_state,
+        )
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            gp.fit(x[local], y[local])
+        scale = gp.kernel_.length_scale
+        weights = scale / scale.mean()
+        weights /= np.prod(weights) ** (1 / d)
+        box_lower = np.clip(center - weights * length / 2, 0, 1)
+        box_upper = np.clip(center + weights * length / 2, 0, 1)
+        n = self.n_candidates
+        perturbed = box_lower + (box_upper - box_lower) * random_state.uniform(
+            size=(n, d)
+        )
+        mask = random_state.uniform(size=(n, d)) <= min(self.perturb / d, 1)
+        mask[np.arange(n), random_state.randint(d, size=n)] = True
+        candidates = np.where(mask, perturbed, center)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            scores = util.utility(candidates, gp, target.max())
+        return lower + candidates[np.argmax(scores)] * span
+
+    def stats(self):
+        return {"length": self.length, "restarts": self.restarts}
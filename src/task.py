@@ -12,15 +12,32 @@ Key Components:
 """
 
 import uuid
+import time
 import os
+import re
+import hashlib
+import tempfile
 from collections import namedtuple
 import shutil
-from util import handle_exception, copy_files, get_latest_file, json2pd
+import numpy as np
+from util import (
+    handle_exception,
+    copy_files,
+    ENV_DIR,
+    OUTPUT_DIR,
+    LOG_DIR,
+)
 import subprocess
-from highway_env import run_calibrate_sim
+from highway_env import run_calibrate_sim, worker_server
+from online_stats import OnlineDistributions
+from workspace import Workspace
+from eval_cache import EvaluationResult, CensoredResult, evaluation_mode
+from reference import load_reference, reference_cache_path
+from result_store import ResultStore
 import pandas as pd
 from process_data import (
     filter_and_classify,
+    compute_distributions,
     save_distributions,
     get_all_kl_divergence,
 )
@@ -69,19 +86,231 @@ pbounds = {
 }
 
 
+# Trips and routes produced by autoGenDemand.sh. They depend only on the
+# scenario network and the script arguments (fixed seeds), never on the
+# calibrated parameters, so they are built once per scenario and shared.
+DEMAND_FILES = [
+    "car.trips.xml",
+    "bus.trips.xml",
+    "output.trips1.xml",
+    "output.trips2.xml",
+]
+DEMAND_INPUTS = ["highway.net.xml", "autoGenDemand.sh"]
+
+
+def demand_key(env_dir):
+    digest = hashlib.sha1()
+    for name in DEMAND_INPUTS:
+        with open(os.path.join(env_dir, name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def build_demand(
+    env, env_root=ENV_DIR, cache_root=os.path.join(OUTPUT_DIR, "demand_cache")
+):
+    """
+    Return the demand cache directory of a scenario, building it if needed.
+
+    The directory is keyed by a hash of the network file and the demand
+    script. It is generated in a scratch directory and renamed into place,
+    so concurrent workers never see a partial cache.
+    """
+    env_dir = os.path.join(env_root, env)
+    cache_dir = os.path.abspath(
+        os.path.join(cache_root, f"{env}_{demand_key(env_dir)}")
+    )
+    if os.path.isdir(cache_dir):
+        return cache_dir
+
+    os.makedirs(cache_root, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix=f".{env}_", dir=cache_root)
+    os.chmod(build_dir, 0o755)
+    try:
+        copy_files(DEMAND_INPUTS, env_dir, build_dir)
+        subprocess.run(
+            ["bash", "autoGenDemand.sh"],
+            cwd=build_dir,
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        for name in os.listdir(build_dir):
+            if name not in DEMAND_FILES:
+                os.remove(os.path.join(build_dir, name))
+        os.rename(build_dir, cache_dir)
+    except OSError:
+        # another worker finished the same cache first
+        if not os.path.isdir(cache_dir):
+            raise
+    finally:
+        if os.path.isdir(build_dir):
+            shutil.rmtree(build_dir)
+    return cache_dir
+
+
+def link_demand(cache_dir, work_dir):
+    for name in DEMAND_FILES:
+        destination = os.path.join(work_dir, name)
+        try:
+            os.symlink(os.path.join(cache_dir, name), destination)
+        except OSError:
+            shutil.copy2(os.path.join(cache_dir, name), destination)
+
+
+# Number of vTypes per distribution, as passed to createVehTypeDistribution.py
+# --size before. Smaller distributions also shorten SUMO's startup parse.
+VTYPE_SIZES = {"car": 10000, "bus": 1000}
+
+VTYPE_HEADER = (
+    '<?xml version="1.0" ?>\n'
+    '<additional xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+    'xsi:noNamespaceSchemaLocation="http://sumo.dlr.de/xsd/additional_file.xsd">\n'
+)
+
+# Samplers of the distributions understood by createVehTypeDistribution.py,
+# each returning n values for the given parameters.
+DISTRIBUTIONS = {
+    "normal": lambda rng, n, mu, sd: rng.normal(mu, sd, n),
+    "lognormal": lambda rng, n, mu, sd: rng.lognormal(mu, sd, n),
+    "uniform": lambda rng, n, a, b: rng.uniform(a, b, n),
+    "gamma": lambda rng, n, alpha, beta: rng.gamma(alpha, 1.0 / beta, n),
+}
+
+
+def parse_vtype_config(profile):
+    """
+    Parse a createVehTypeDistribution.py config ("name; value[; [lo,hi]]").
+
+    Returns a list of (name, distribution, params, limits, value). Numeric
+    attributes default to the script's (0, None) limits.
+    """
+    attributes = []
+    for line in profile.splitlines():
+        row = [field.strip() for field in line.split(";")]
+        if len(row) < 2 or not row[0]:
+            continue
+        name, value = row[0], row[1]
+        limits = (0, None)
+        if len(row) >= 3 and row[2]:
+            limits = tuple(float(x) for x in row[2].strip("[]").split(","))
+        match = re.fullmatch(r"(\w+)\((.*)\)", value)
+        if match and match.group(1) in DISTRIBUTIONS:
+            params = [float(x) for x in match.group(2).split(",")]
+            attributes.append((name, match.group(1), params, limits, None))
+        else:
+            attributes.append((name, None, None, limits, value))
+    return attributes
+
+
+def sample_bounded(rng, n, distribution, params, limits, resampling=100):
+    """Resample values outside the limits, then clip like the SUMO tool."""
+    sampler = DISTRIBUTIONS[distribution]
+    values = sampler(rng, n, *params)
+    lower, upper = limits
+    for _ in range(resampling - 1):
+        outside = (values < lower) if lower is not None else np.zeros(n, bool)
+        if upper is not None:
+            outside |= values > upper
+        if not outside.any():
+            break
+        values[outside] = sampler(rng, int(outside.sum()), *params)
+    return np.clip(values, lower, upper)
+
+
+def format_attribute(value, limits, decimal_places):
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    lower, upper = limits
+    if lower is not None and number < lower:
+        number = lower
+    elif upper is not None and number > upper:
+        number = upper
+    return f"{number:.{decimal_places}f}"
+
+
+def vtype_distribution_xml(name, profile, size, rng, decimal_places=3):
+    """Serialize one vTypeDistribution with all samples drawn in one batch."""
+    columns = []
+    for attr, distribution, params, limits, value in parse_vtype_config(profile):
+        if distribution is None:
+            text = format_attribute(value, limits, decimal_places)
+            columns.append([f' {attr}="{text}"'] * size)
+        else:
+            samples = sample_bounded(rng, size, distribution, params, limits)
+            columns.append([f' {attr}="{x:.{decimal_places}f}"' for x in samples])
+    rows = [
+        f'\t\t<vType id="{name}{i}"' + "".join(parts) + "/>"
+        for i, parts in enumerate(zip(*columns))
+    ]
+    return (
+        f'\t<vTypeDistribution id="{name}">\n'
+        + "\n".join(rows)
+        + "\n\t</vTypeDistribution>\n"
+    )
+
+
+def write_vtype_distributions(profiles, output_path, sizes=VTYPE_SIZES, seed=42):
+    """
+    In-process replacement for createVehTypeDistribution.py.
+
+    Args:
+        profiles (dict): Distribution name -> config text
+        output_path (str): Path of vTypeDistributions.add.xml
+        sizes (dict): Distribution name -> number of vTypes
+        seed (int): Seed of the sampler
+    """
+    rng = np.random.default_rng(seed)
+    body = "".join(
+        vtype_distribution_xml(name, profile, sizes[name], rng)
+        for name, profile in profiles.items()
+    )
+    with open(output_path, "w") as f:
+        f.write(VTYPE_HEADER + body + "</additional>")
+
+
+# Horizon of an optimizer evaluation: 200 * 30 warm-up steps and 550 * 30
+# recorded steps. With an AdaptiveHorizon it is the upper limit.
+HOT_TIME = 200 * 30
+SIM_STEP = 750 * 30
+
+
 class SUMO_task:
     """
     SUMO simulation task with automatic workspace management and evaluation.
     
+    All paths are absolute, so tasks do not touch the working directory of
+    the process and several of them may run on threads of one process with
+    the traci backend.
+
     Args:
         param (dict): Simulation parameters
         env (str): Traffic scenario ('merge', 'stop', 'right')
+        workspace_root (str): Parent of the task directory, see workspace
+        seed (int): Seed of the vType sampler
     """
     
-    def __init__(self, param, env="merge"):
+    def __init__(
+        self,
+        param,
+        env="merge",
+        vtype_sizes=VTYPE_SIZES,
+        workspace_root=None,
+        seed=42,
+    ):
         ParamType = namedtuple("ParamType", param.keys())
         self.work_dir = None
+        self.seed = seed
+        self.param = param
+        self.steps_run = 0
+        self.partial = False
+        self.workspace = None
+        self.workspace_root = workspace_root
         self.env = env
+        self.vtype_sizes = vtype_sizes
         self.config = ParamType(**param)
         try:
             self.init_work_space(env)
@@ -92,8 +321,8 @@ class SUMO_task:
     def init_work_space(self, env):
         task_id = uuid.uuid4()
         self.task_id = task_id
-        self.work_dir = f"../tmp/{task_id}"
-        os.mkdir(self.work_dir)
+        self.workspace = Workspace(str(task_id), root=self.workspace_root)
+        self.work_dir = self.workspace.path
 
         files_to_copy = [
             # "background.png",
@@ -101,12 +330,14 @@ class SUMO_task:
             "background.xml",
             "highway.net.xml",
             "highway.sumocfg",
-            "autoGenTraffic.sh",
         ]
-        copy_files(files_to_copy, f"../env/{env}", self.work_dir)
-        self.create_vehicle_config(self.work_dir, "car")
-        self.create_vehicle_config(self.work_dir, "bus")
-        self.createVtypes()
+        copy_files(files_to_copy, os.path.join(ENV_DIR, env), self.work_dir)
+        link_demand(build_demand(env), self.work_dir)
+        profiles = {
+            "car": self.create_vehicle_config(self.work_dir, "car"),
+            "bus": self.create_vehicle_config(self.work_dir, "bus"),
+        }
+        self.createVtypes(profiles)
         return task_id
 
     def create_vehicle_config(self, work_dir, vehicle_type):
@@ -133,74 +364,252 @@ lcLookaheadLeft; {getattr(self.config, vehicle_type + '_lcLookaheadLeft')}
         config_file_path = os.path.join(work_dir, f"{vehicle_type}.config.txt")
         with open(config_file_path, "w") as config_file:
             config_file.write(profile_template)
-            config_file.flush()
-            os.fsync(config_file.fileno())
-
-    def createVtypes(self):
-        os.chdir(self.work_dir)
-        script_path = os.path.join(os.getcwd(), "autoGenTraffic.sh")
-        if not os.access(script_path, os.X_OK):
-            os.chmod(script_path, 0o755)
+        return profile_template
+
+    def createVtypes(self, profiles):
         try:
-            result = subprocess.run(
-                [script_path],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
+            write_vtype_distributions(
+                profiles,
+                os.path.join(self.work_dir, "vTypeDistributions.add.xml"),
+                sizes=self.vtype_sizes,
+                seed=self.seed,
             )
-            if result.stderr:
-                print("Script Error Output:")
-                print(result.stderr)
-        except subprocess.CalledProcessError as e:
+        except ValueError as e:
             handle_exception(e)
             self.close()
 
-    def run_task(self, sim_step, save=False, gui=False):
+    def run_task(
+        self,
+        sim_step,
+        save=False,
+        gui=False,
+        backend="traci",
+        record_sinks=("csv",),
+        streaming=False,
+        reuse_sumo=False,
+        fidelity=None,
+        early_abort=None,
+        horizon=None,
+        hot_time=HOT_TIME,
+    ):
+        """
+        Simulate the workspace and score it against the scenario reference.
+
+        The recorded rows are evaluated in memory; record_sinks ('csv',
+        'parquet') are only written when save is set. With streaming=True the
+        distributions are accumulated online during the run (see
+        online_stats) and rows are only kept for save runs. With
+        reuse_sumo=True the run is loaded into the SUMO instance of the
+        calling worker (see highway_env.worker_server) instead of a new one.
+
+        A SuccessiveHalving passed as fidelity scores the run at its rungs and
+        stops it at the first rung that does not promote it; the KL vector of
+        that rung is returned and steps_run tells how far the run went. Save
+        runs always simulate the full horizon.
+
+        An EarlyAbort stops the run at a checkpoint where the candidate is
+        already clearly worse than its threshold; the provisional KL vector
+        is then returned as a CensoredResult.
+
+        An AdaptiveHorizon ends the run once the distributions converged,
+        sim_step is then the upper limit. steps_run reports the steps used;
+        partial is set if the run was stopped by fidelity or early_abort and
+        its result is not a final score.
+        """
         try:
-            run_calibrate_sim(config_path=".", sim_step=sim_step, gui=gui)
-            res = self.eval()
+            stats = None
+            if streaming or horizon is not None:
+                stats = OnlineDistributions.from_reference(self.reference_path())
+            tracker = horizon.tracker(stats) if horizon is not None else None
+            self.steps_run = sim_step
+            self.partial = False
+            rung_steps = []
+            abort_steps = []
+            if not save:
+                if fidelity is not None:
+                    rung_steps = fidelity.rung_steps(sim_step, hot_time)
+                if early_abort is not None:
+                    abort_steps = early_abort.checkpoints(sim_step, hot_time)
+            stopped = {}
+
+            def on_checkpoint(step, env):
+                if streaming:
+                    provisional = stats.snapshot().kl_divergence()
+                else:
+                    provisional = self.eval(env.recorder.to_frame())
+                if step in rung_steps and not fidelity.promote(
+                    self.env, sim_step, self.seed, step, self.param, provisional
+                ):
+                    stopped["result"] = provisional
+                elif step in abort_steps and early_abort.should_abort(provisional):
+                    stopped["result"] = CensoredResult(
+                        provisional, step, early_abort.lower_bound(provisional)
+                    )
+                else:
+                    return True
+                self.steps_run = step
+                self.partial = True
+                return False
+            recorder = run_calibrate_sim(
+                config_path=self.work_dir,
+                sim_step=sim_step,
+                gui=gui,
+                backend=backend,
+                sinks=record_sinks if save else (),
+                stats=stats,
+                keep_rows=save or not streaming,
+                server=worker_server(backend) if reuse_sumo and not gui else None,
+                hot_time=hot_time,
+                checkpoints=rung_steps + abort_steps,
+                on_checkpoint=on_checkpoint,
+                horizon=tracker,
+            )
+            if tracker is not None and not self.partial:
+                self.steps_run = tracker.steps_used
+            if "result" in stopped:
+                res = stopped["result"]
+            elif streaming:
+                res = stats.kl_divergence()
+            else:
+                res = self.eval(recorder.to_frame(), save=save)
             if save:
                 shutil.copytree(
-                    ".", f"../../output/data_raw/{self.env}", dirs_exist_ok=True
+                    self.work_dir,
+                    os.path.join(OUTPUT_DIR, "data_raw", self.env),
+                    dirs_exist_ok=True,
                 )
             return res
         except Exception as e:
             handle_exception(e)
         finally:
             self.close()
-            os.chdir("../../src")
 
-    def eval(self):
-        compare_data_name = self.env
-        pd_f = pd.read_csv("./record.csv")
+    def reference_path(self):
+        return reference_cache_path(self.env)
+
+    def eval(self, pd_f=None, save=False):
+        """
+        KL vector of the recorded rows against the worker-resident reference
+        (see reference.load_reference); _cache.pkl is only written if save.
+        """
+        if pd_f is None:
+            pd_f = pd.read_csv(os.path.join(self.work_dir, "record.csv"))
         data = filter_and_classify(pd_f)
-        save_distributions(
-            data,
+        if save:
+            cache = save_distributions(data, output_dir=self.work_dir)
+        else:
+            cache = compute_distributions(data)
+        return load_reference(self.env).kl_divergence(
+            cache, variables=["xAcceleration", "dhw", "xVelocity"]
         )
-        res = get_all_kl_divergence(
-            f"../../output/data_cache/{compare_data_name}_cache.pkl",
-            "_cache.pkl",
-            variables=["xAcceleration", "dhw", "xVelocity"],
-        )
-        return res
 
     def close(self):
-        if os.path.exists(f"../{self.task_id}"):
-            shutil.rmtree(f"../{self.task_id}")
+        if self.workspace is not None:
+            self.workspace.cleanup()
         return 0
 
+    def __enter__(self):
+        return self
 
-def get_best_param(log_path=""):
-    if not log_path:
-        log_path = get_latest_file(folder="../log", suffix=".log")
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
 
-    df = json2pd("../log/" + log_path + ".log")
-    max_target_row = df.loc[df["target"].idxmax()]
-    params_dic = {
-        key: value for key, value in max_target_row.items() if key != "target"
+
+def evaluate_params(
+    params,
+    env="merge",
+    sim_step=SIM_STEP,
+    seed=42,
+    cache=None,
+    vtype_sizes=VTYPE_SIZES,
+    **run_kwargs,
+):
+    """
+    Return the KL vector of params as an EvaluationResult that tells how many
+    steps the run simulated, from the evaluation cache if possible.
+
+    Cache entries are keyed by the evaluation mode of the run (streaming,
+    hot_time, horizon, vtype_sizes). Runs stopped by fidelity or early_abort
+    are stored under a mode that also describes those, so they only answer
+    requests that would have stopped the same way, and a censored result
+    only while the current threshold would still abort it. Save runs always
+    simulate, since they are made for their output files, and refresh the
+    cache entry afterwards.
+
+    Args:
+        params (dict): Simulation parameters
+        env (str): Traffic scenario
+        sim_step (int): Simulated steps, the upper limit with a horizon
+        seed (int): Seed of the vType sampler
+        cache (EvaluationCache): Store checked before launching SUMO
+        vtype_sizes (dict): Passed to SUMO_task
+        **run_kwargs: Passed to SUMO_task.run_task
+    """
+    settings = {
+        "streaming": run_kwargs.get("streaming", False),
+        "hot_time": run_kwargs.get("hot_time", HOT_TIME),
+        "horizon": run_kwargs.get("horizon"),
+        "vtype_sizes": vtype_sizes,
     }
-    return params_dic, -max_target_row["target"]
+    fidelity = run_kwargs.get("fidelity")
+    early_abort = run_kwargs.get("early_abort")
+    mode = evaluation_mode(**settings)
+    stop_mode = evaluation_mode(**settings, fidelity=fidelity, early_abort=early_abort)
+    if cache is not None and not run_kwargs.get("save"):
+        res = cache.get(env, sim_step, seed, params, modes=[mode, stop_mode])
+        if getattr(res, "censored", False):
+            threshold = early_abort and early_abort.current_threshold()
+            if threshold is None or not res.lower_bound > threshold:
+                res = None
+        if res is not None:
+            return res
+    start = time.perf_counter()
+    task = SUMO_task(params, env=env, seed=seed, vtype_sizes=vtype_sizes)
+    res = task.run_task(sim_step=sim_step, **run_kwargs)
+    if res is None:
+        return None
+    if not isinstance(res, EvaluationResult):
+        res = EvaluationResult(res, task.steps_run, task.partial)
+    if cache is not None:
+        cache.put(
+            env,
+            sim_step,
+            seed,
+            params,
+            res,
+            time.perf_counter() - start,
+            mode=stop_mode if res.partial else mode,
+        )
+    return res
+
+
+def get_best_param(log_path="", store=None):
+    """
+    Best parameters of a BO run and their mean KL, from the result store.
+
+    Raises ValueError if there is no such run or it has no uncensored result.
+
+    Args:
+        log_path (str): Log name in LOG_DIR without .log, the run that
+            received a result last if empty
+        store (ResultStore): Store to query, the default one if None
+    """
+    store = store or ResultStore()
+    if not log_path:
+        store.import_logs(LOG_DIR)
+        log_path = store.latest_run()
+        if log_path is None:
+            raise ValueError(f"no BO runs in the result store or in {LOG_DIR}")
+    else:
+        log = os.path.join(LOG_DIR, log_path + ".log")
+        if store.run_id(log_path) is None and not os.path.isfile(log):
+            raise ValueError(f"no BO run {log_path} in the result store or {LOG_DIR}")
+        store.open_run(log_path, log=log)
+    best = store.best(run=log_path)
+    if best is None:
+        raise ValueError(f"BO run {log_path} has no uncensored results")
+    params_dic, target = best
+    return params_dic, -target
 
 
 def eval_data(env):
@@ -211,15 +620,16 @@ def eval_data(env):
 
 
 def manual_eval_tuning(env="merge"):
-    pd_f = pd.read_csv(f"../output/data_raw/{env}/record.csv")
+    raw_dir = os.path.join(OUTPUT_DIR, "data_raw", env)
+    pd_f = pd.read_csv(os.path.join(raw_dir, "record.csv"))
     data = filter_and_classify(pd_f)
     save_distributions(
         data,
-        output_dir=f"../output/data_raw/{env}",
+        output_dir=raw_dir,
     )
     res = get_all_kl_divergence(
-        f"../output/data_cache/{env}_cache.pkl",
-        f"../output/data_raw/{env}/_cache.pkl",
+        os.path.join(OUTPUT_DIR, "data_cache", f"{env}_cache.pkl"),
+        os.path.join(raw_dir, "_cache.pkl"),
         variables=["xAcceleration", "dhw", "xVelocity"],
     )
     print(res)
@@ -230,7 +640,10 @@ from multiprocessing import Pool
 
 
 def helper(env):
-    run_calibrate_sim(config_path=f"../output/data_raw/{env}_origin", sim_step=800 * 30)
+    run_calibrate_sim(
+        config_path=os.path.join(OUTPUT_DIR, "data_raw", f"{env}_origin"),
+        sim_step=800 * 30,
+    )
     manual_eval_tuning(env + "_origin")
 
 
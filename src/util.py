@@ -6,6 +6,12 @@ import json
 import pandas as pd
 import numpy
 
+# Repository layout, resolved from this file so that nothing depends on the
+# working directory of the caller.
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENV_DIR = os.path.join(ROOT_DIR, "env")
+OUTPUT_DIR = os.path.join(ROOT_DIR, "output")
+LOG_DIR = os.path.join(ROOT_DIR, "log")
 
 def round_dic_data(dic_data, decimal_precision=4):
     return {k: round(v, decimal_precision) for k, v in dic_data.items()}
@@ -31,7 +37,7 @@ def copy_files(files, source_dir, destination_dir):
             print(f"warning {source_file} not exist")
 
 
-def get_latest_file(folder="../log", suffix=".log"):
+def get_latest_file(folder=LOG_DIR, suffix=".log"):
     log_files = [f for f in os.listdir(folder) if f.endswith(suffix)]
     if not log_files:
         print(f"No files with suffix '{suffix}' found in {folder}")
@@ -0,0 +1,60 @@
+"""
+Scratch directories for simulation tasks.
+
+Every SUMO_task runs in its own directory below a workspace root, addressed by
+absolute path so that neither the task nor SUMO depends on the working
+directory of the process. The root defaults to tmp/ of the repository and can
+be moved to a memory-backed filesystem with the SUMO_WORKSPACE_ROOT
+environment variable (e.g. /dev/shm on Linux) to keep the short-lived files
+of a run off the disk.
+"""
+
+import os
+import shutil
+import weakref
+from util import ROOT_DIR
+
+WORKSPACE_ROOT_ENV = "SUMO_WORKSPACE_ROOT"
+
+
+def default_workspace_root():
+    return os.environ.get(WORKSPACE_ROOT_ENV) or os.path.join(ROOT_DIR, "tmp")
+
+
+class Workspace:
+    """
+    Private directory of one task, removed on cleanup().
+
+    The directory is also removed when the Workspace is garbage collected or
+    the interpreter exits, so an exception or crash inside the task does not
+    leave it behind.
+
+    Args:
+        name (str): Directory name, unique below root
+        root (str): Parent directory, default_workspace_root() if None
+    """
+
+    def __init__(self, name, root=None):
+        root = os.path.abspath(root or default_workspace_root())
+        os.makedirs(root, exist_ok=True)
+        self.path = os.path.join(root, name)
+        os.mkdir(self.path)
+        self._finalizer = weakref.finalize(
+            self, shutil.rmtree, self.path, ignore_errors=True
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cleanup()
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    @property
+    def alive(self):
+        return self._finalizer.alive
+
+    def cleanup(self):
+        self._finalizer()
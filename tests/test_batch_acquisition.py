@@ -0,0 +1,36 @@
+import threading
+from bayes_opt import BayesianOptimization, UtilityFunction
+from batch_acquisition import PendingAwareSuggester, load_pending
+
+PBOUNDS = {"tau": (0, 3), "sigma": (0, 1)}
+
+
+def make_suggester(checkpoint, initial=()):
+    optimizer = BayesianOptimization(f=None, pbounds=PBOUNDS, verbose=0)
+    return PendingAwareSuggester(
+        optimizer,
+        UtilityFunction(kind="ucb"),
+        threading.Lock(),
+        set(),
+        n_initial=4,
+        checkpoint=checkpoint,
+        initial=initial,
+    )
+
+
+def test_pending_points_are_evaluated_first_on_resume(tmp_path):
+    checkpoint = str(tmp_path / "merge_a_pending.json")
+    assert load_pending(checkpoint) == []
+    suggester = make_suggester(checkpoint)
+    first, second, third = (suggester.suggest() for _ in range(3))
+    assert load_pending(checkpoint) == [first, second, third]
+    with suggester.lock:
+        suggester.complete(second, -0.5)
+    pending = load_pending(checkpoint)
+    assert pending == [first, third]
+    # the interrupted run is resumed with its pending points
+    resumed = make_suggester(checkpoint, initial=pending)
+    assert resumed.suggest() == first
+    assert resumed.suggest() == third
+    assert resumed.suggest() not in (first, third)
+    assert load_pending(checkpoint)[:2] == [first, third]
@@ -0,0 +1,119 @@
+import json
+import pytest
+from bayes_opt import BayesianOptimization
+import bayesian_optimize
+from util import params_to_tuple
+from eval_cache import EvaluationResult, CensoredResult
+
+
+def test_execute_task(monkeypatch):
+    results = iter(
+        [
+            EvaluationResult([0.2, 0.4], 17250),
+            CensoredResult([0.8, 1.2], 9000, 0.7),
+            None,
+        ]
+    )
+    monkeypatch.setattr(
+        bayesian_optimize, "task_function", lambda **kwargs: next(results)
+    )
+    task = {"params": {"tau": 1.0}}
+    outcome = bayesian_optimize.execute_task(task, "merge")
+    assert outcome["target"] == pytest.approx(-0.3) and not outcome["censored"]
+    assert outcome["steps_run"] == 17250
+    # a censored run reports the bound of its mean KL, not the provisional one
+    outcome = bayesian_optimize.execute_task(task, "merge")
+    assert outcome["target"] == -0.7 and outcome["censored"]
+    assert outcome["steps_run"] == 9000
+    assert bayesian_optimize.execute_task(task, "merge") is None
+
+
+PBOUNDS = {"tau": (0, 3), "sigma": (0, 1)}
+
+
+def write_log(path, entries):
+    """A JSONLogger file with (params, target) entries."""
+    with open(path, "w") as f:
+        for params, target in entries:
+            f.write(json.dumps({"target": target, "params": params}) + "\n")
+    return path
+
+
+def read_log(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_replay_logs(tmp_path):
+    log = write_log(
+        tmp_path / "merge_a.log",
+        [
+            ({"tau": 1.00001, "sigma": 0.5}, -0.4),
+            # the same point once rounded
+            ({"tau": 1.0, "sigma": 0.5}, -0.3),
+            ({"tau": 2.0, "sigma": 0.5}, -0.2),
+            ({"tau": 5.0, "sigma": 0.5}, -0.1),
+            ({"tau": 2.5}, -0.1),
+            ({"tau": 0.5, "sigma": 0.1}, float("nan")),
+            ({"tau": 0.5, "sigma": 0.2}, -0.5),
+        ],
+    )
+    optimizer = BayesianOptimization(f=None, pbounds=PBOUNDS, verbose=0)
+    # issued before, e.g. by another log
+    issued = {params_to_tuple({"tau": 2.0, "sigma": 0.5})}
+    assert bayesian_optimize.replay_logs(optimizer, [str(log)], issued) == [
+        -0.4,
+        -0.5,
+    ]
+    assert len(optimizer.space) == 2
+    assert params_to_tuple({"tau": 0.5, "sigma": 0.2}) in issued
+    assert bayesian_optimize.replay_logs(optimizer, [str(log)], issued) == []
+
+
+def fake_execute(task, env, **options):
+    return {
+        "target": -task["params"]["tau"],
+        "steps_run": 100,
+        "censored": False,
+    }
+
+
+def test_resume(tmp_path, monkeypatch):
+    monkeypatch.setattr(bayesian_optimize, "execute_task", fake_execute)
+    log = write_log(
+        tmp_path / "merge_a.log",
+        [({"tau": 1.0, "sigma": 0.5}, -1.0), ({"tau": 2.0, "sigma": 0.5}, -2.0)],
+    )
+    # the point that was in flight when the run stopped
+    (tmp_path / "merge_a_pending.json").write_text(
+        json.dumps([{"tau": 0.25, "sigma": 0.75}])
+    )
+    bayesian_optimize.bayesian_optimize(
+        max_iteration=4,
+        pbounds=PBOUNDS,
+        resume=str(log),
+        cpu_count=1,
+        prefetch=0,
+        cache=False,
+        store=False,
+    )
+    entries = read_log(log)
+    # the two replayed results count towards max_iteration
+    assert len(entries) == 4
+    assert entries[2]["params"] == {"tau": 0.25, "sigma": 0.75}
+    assert entries[2]["target"] == -0.25
+    assert json.loads((tmp_path / "merge_a_pending.json").read_text()) == []
+
+
+def test_feeder_failure_is_raised(tmp_path, monkeypatch):
+    monkeypatch.setattr(bayesian_optimize, "LOG_DIR", str(tmp_path))
+    monkeypatch.setattr(bayesian_optimize, "execute_task", fake_execute)
+
+    def fail(self):
+        raise RuntimeError("no new parameters found")
+
+    monkeypatch.setattr(bayesian_optimize.PendingAwareSuggester, "suggest", fail)
+    with pytest.raises(RuntimeError, match="no new parameters"):
+        bayesian_optimize.bayesian_optimize(
+            max_iteration=2, pbounds=PBOUNDS, cpu_count=1, cache=False, store=False
+        )
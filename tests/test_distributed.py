@@ -0,0 +1,60 @@
+import multiprocessing
+import time
+import pytest
+from distributed import WorkBroker, connect, run_agent
+from fidelity import SuccessiveHalving
+from bayesian_optimize import bayesian_optimize
+
+# the manager server leaves its thread with sys.exit() on shutdown
+pytestmark = pytest.mark.filterwarnings(
+    "ignore::pytest.PytestUnhandledThreadExceptionWarning"
+)
+
+
+def square(task):
+    return task["x"] ** 2
+
+
+@pytest.fixture
+def broker():
+    broker = WorkBroker(("localhost", 0), heartbeat_timeout=5)
+    broker.start()
+    yield broker
+    broker.shutdown()
+
+
+def test_listens_on_localhost_with_a_random_key(broker):
+    assert broker.address[0] == "127.0.0.1"
+    assert len(broker.authkey) == 32
+    assert WorkBroker().authkey != broker.authkey
+    with pytest.raises(multiprocessing.AuthenticationError):
+        connect(broker.address, b"wrong key")
+
+
+def test_agent_evaluates_tasks(broker):
+    agent = multiprocessing.Process(
+        target=run_agent, args=(broker.address, broker.authkey, 2, 0.2)
+    )
+    agent.start()
+    try:
+        campaign = broker.campaign("square", square)
+        for x in range(5):
+            campaign.submit({"x": x})
+        outcomes = {}
+        deadline = time.time() + 30
+        while len(outcomes) < 5 and time.time() < deadline:
+            for task, result in campaign.results(timeout=0.2):
+                outcomes[task["x"]] = result
+        assert outcomes == {x: x**2 for x in range(5)}
+    finally:
+        broker.shutdown()
+        agent.join(timeout=10)
+        if agent.is_alive():
+            agent.kill()
+
+
+def test_remote_pool_refuses_local_stores(tmp_path):
+    broker = WorkBroker()
+    fidelity = SuccessiveHalving(path=str(tmp_path / "rungs.sqlite"))
+    with pytest.raises(ValueError):
+        bayesian_optimize(pool=broker, fidelity=fidelity, store=False)
@@ -0,0 +1,106 @@
+import sqlite3
+from eval_cache import (
+    EvaluationCache,
+    EvaluationResult,
+    CensoredResult,
+    evaluation_mode,
+)
+from fidelity import EarlyAbort
+from online_stats import AdaptiveHorizon
+
+PARAMS = {"tau": 1.23456, "accel": 2.5}
+
+
+def make_cache(tmp_path, **kwargs):
+    return EvaluationCache(str(tmp_path / "cache.sqlite"), **kwargs)
+
+
+def test_roundtrip_and_rounding(tmp_path):
+    cache = make_cache(tmp_path)
+    assert cache.get("merge", 100, 42, PARAMS) is None
+    cache.put("merge", 100, 42, PARAMS, [0.1, 0.2], elapsed=3.0)
+    # keys use the rounding of round_dic_data
+    assert cache.get("merge", 100, 42, {"accel": 2.5, "tau": 1.23457}) == [0.1, 0.2]
+    assert cache.get("merge", 100, 43, PARAMS) is None
+    assert cache.get("merge", 200, 42, PARAMS) is None
+    assert cache.get("right", 100, 42, PARAMS) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 4, 1)
+    assert stats["saved_seconds"] == 3.0
+
+
+def test_mode_is_part_of_the_key(tmp_path):
+    cache = make_cache(tmp_path)
+    batch = evaluation_mode(streaming=False, hot_time=6000, horizon=None)
+    streaming = evaluation_mode(streaming=True, hot_time=6000, horizon=None)
+    adaptive = evaluation_mode(hot_time=6000, horizon=AdaptiveHorizon())
+    assert len({batch, streaming, adaptive}) == 3
+    assert evaluation_mode(hot_time=6000, horizon=AdaptiveHorizon()) == adaptive
+    assert adaptive != evaluation_mode(hot_time=6000, horizon=AdaptiveHorizon(5))
+    cache.put("merge", 100, 42, PARAMS, [0.1], 1.0, mode=batch)
+    cache.put("merge", 100, 42, PARAMS, [0.3], 1.0, mode=streaming)
+    assert cache.get("merge", 100, 42, PARAMS, modes=[adaptive]) is None
+    assert cache.get("merge", 100, 42, PARAMS, modes=[streaming]) == [0.3]
+    # the first acceptable mode that is stored wins
+    assert cache.get("merge", 100, 42, PARAMS, modes=[adaptive, batch]) == [0.1]
+    assert cache.get("merge", 100, 42, PARAMS, modes=[batch, streaming]) == [0.1]
+
+
+def test_censored_result_is_restored(tmp_path):
+    cache = make_cache(tmp_path)
+    mode = evaluation_mode(early_abort=EarlyAbort())
+    cache.put(
+        "merge", 100, 42, PARAMS, CensoredResult([0.4, 0.6], 80, 0.35), 1.0, mode
+    )
+    res = cache.get("merge", 100, 42, PARAMS, modes=[mode])
+    assert isinstance(res, CensoredResult)
+    assert res == [0.4, 0.6]
+    assert (res.step, res.lower_bound) == (80, 0.35)
+    assert (res.steps_run, res.partial) == (80, True)
+    cache.put("merge", 100, 42, PARAMS, [0.4, 0.6], 1.0, mode)
+    res = cache.get("merge", 100, 42, PARAMS, modes=[mode])
+    assert not isinstance(res, CensoredResult)
+
+
+def test_steps_run_is_restored(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put("merge", 100, 42, PARAMS, EvaluationResult([0.1], 70), 1.0)
+    cache.put("merge", 100, 43, PARAMS, EvaluationResult([0.2], 50, True), 1.0)
+    cache.put("merge", 100, 44, PARAMS, [0.3], 1.0)
+    res = cache.get("merge", 100, 42, PARAMS)
+    assert (res, res.steps_run, res.partial) == ([0.1], 70, False)
+    res = cache.get("merge", 100, 43, PARAMS)
+    assert (res, res.steps_run, res.partial) == ([0.2], 50, True)
+    assert cache.get("merge", 100, 44, PARAMS).steps_run is None
+
+
+def test_lru_eviction(tmp_path):
+    cache = make_cache(tmp_path, max_entries=3)
+    for i in range(3):
+        cache.put("merge", 100, i, PARAMS, [i], 1.0)
+    # seed 0 becomes the most recently used
+    assert cache.get("merge", 100, 0, PARAMS) == [0]
+    cache.put("merge", 100, 3, PARAMS, [3], 1.0)
+    assert cache.stats()["entries"] == 3
+    assert cache.get("merge", 100, 1, PARAMS) is None
+    for seed in (0, 2, 3):
+        assert cache.get("merge", 100, seed, PARAMS) == [seed]
+
+
+def test_old_table_is_replaced(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE evaluations (env TEXT, sim_step INTEGER, seed INTEGER, "
+        "params TEXT, result TEXT, elapsed REAL, created REAL, last_used REAL, "
+        "hits INTEGER, PRIMARY KEY (env, sim_step, seed, params))"
+    )
+    conn.execute(
+        "INSERT INTO evaluations VALUES ('merge', 100, 42, '{}', '[1]', 1, 0, 0, 0)"
+    )
+    conn.commit()
+    conn.close()
+    cache = EvaluationCache(path)
+    assert cache.get("merge", 100, 42, {}) is None
+    cache.put("merge", 100, 42, {}, [2], 1.0)
+    assert cache.get("merge", 100, 42, {}) == [2]
@@ -0,0 +1,69 @@
+import pytest
+from fidelity import SuccessiveHalving, EarlyAbort
+
+PARAMS = {"tau": 1.0}
+
+
+def make_schedule(tmp_path, **kwargs):
+    return SuccessiveHalving(path=str(tmp_path / "rungs.sqlite"), **kwargs)
+
+
+def promote(schedule, score, rung_step=100):
+    return schedule.promote("merge", 400, 42, rung_step, PARAMS, [score, score])
+
+
+def test_rung_steps(tmp_path):
+    schedule = make_schedule(tmp_path, fractions=(0.25, 0.5))
+    assert schedule.rung_steps(sim_step=1000, hot_time=200) == [400, 600]
+    with pytest.raises(ValueError):
+        make_schedule(tmp_path, fractions=(0.5, 0.25))
+    with pytest.raises(ValueError):
+        make_schedule(tmp_path, eta=1)
+
+
+def test_promotion(tmp_path):
+    schedule = make_schedule(tmp_path, eta=3, min_observations=4)
+    # everything is promoted until the rung has min_observations scores
+    assert all(promote(schedule, score) for score in (5.0, 4.0, 3.0))
+    # then only scores within the best third of the rung
+    assert promote(schedule, 1.0)
+    assert not promote(schedule, 4.5)
+    assert promote(schedule, 0.5)
+    assert not promote(schedule, float("nan"))
+    # rungs are scored separately
+    assert promote(schedule, 4.5, rung_step=200)
+    assert schedule.stats() == {100: 7, 200: 1}
+
+
+def test_studies_are_separate(tmp_path):
+    schedule = make_schedule(tmp_path, min_observations=2)
+    first = schedule.for_study("merge_a")
+    for score in (1.0, 2.0, 3.0):
+        promote(first, score)
+    assert not promote(first, 5.0)
+    second = schedule.for_study("merge_b")
+    assert second.study == "merge_b" and first.study == "merge_a"
+    assert promote(second, 5.0)
+    assert second.stats() == {100: 1}
+    # a reset study starts from scratch, a continued one keeps its scores
+    assert schedule.for_study("merge_a").stats() == {100: 4}
+    assert schedule.for_study("merge_a", reset=True).stats() == {}
+
+
+def test_prune(tmp_path):
+    schedule = make_schedule(tmp_path)
+    for study in ("a", "b", "c"):
+        promote(schedule.for_study(study), 1.0)
+    current = schedule.for_study("a")
+    assert current.prune(keep=1) == 1
+    assert schedule.for_study("b").stats() == {}
+    assert schedule.for_study("c").stats() == {100: 1}
+    assert current.stats() == {100: 1}
+
+
+def test_early_abort():
+    abort = EarlyAbort(threshold=1.0, interval=100, min_fraction=0.5, margin=0.5)
+    assert abort.checkpoints(sim_step=1000, hot_time=200) == [600, 700, 800, 900]
+    assert not abort.should_abort([1.8, 2.2])
+    assert abort.should_abort([2.2, 2.2])
+    assert not EarlyAbort().should_abort([100.0])
@@ -0,0 +1,115 @@
+import time
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from pymoo.core.problem import ElementwiseProblem
+from pymoo.algorithms.soo.nonconvex.pso import PSO
+from pymoo.optimize import minimize
+from result_store import ResultStore
+from multi_object_optimization import record_population, CampaignRunner
+from scheduler import TaskScheduler
+
+
+class FailingProblem(ElementwiseProblem):
+    """Fails like the SUMO problems for x < 0.5: F of 1 and no steps_run."""
+
+    env_name = "merge"
+    param_bounds = {"tau": (0, 1)}
+
+    def __init__(self):
+        super().__init__(n_var=1, n_obj=1, xl=[0], xu=[1])
+
+    def _evaluate(self, x, out, *args, **kwargs):
+        failed = x[0] < 0.5
+        out["F"] = [1] if failed else [x[0]]
+        out["steps_run"] = None if failed else 22500
+        out["censored"] = False
+
+
+def test_record_population_with_failed_individuals(tmp_path):
+    problem = FailingProblem()
+    res = minimize(problem, PSO(pop_size=8), termination=("n_gen", 1), seed=1)
+    steps_run = res.pop.get("steps_run")
+    # pymoo stacks the None of failed individuals as NaN
+    assert np.isnan(steps_run.astype(float)).any()
+    store = ResultStore(str(tmp_path / "results.sqlite"))
+    record_population(problem, res, "pso", store)
+    df = store.results("merge_pso")
+    assert len(df) == 8
+    failed = df["tau"] < 0.5
+    assert df.loc[failed, "steps_run"].isna().all()
+    assert (df.loc[~failed, "steps_run"] == 22500).all()
+    assert not df["censored"].any()
+
+
+def test_expected_seconds():
+    runner = CampaignRunner(None, "pso", k_nearest=2, max_history=3)
+    X = np.array([[0.0, 0.0], [0.1, 0.0], [1.0, 1.0]])
+    runner.observe(X[:1], np.array([1.0]))
+    # no estimates until there are k_nearest points
+    assert runner.expected_seconds(X).tolist() == [0.0, 0.0, 0.0]
+    runner.observe(X[1:], np.array([3.0, 10.0]))
+    expected = runner.expected_seconds(np.array([[0.05, 0.0], [0.9, 1.0]]))
+    assert expected.tolist() == [2.0, 6.5]
+    runner.observe(np.array([[0.9, 0.9]]), np.array([20.0]))
+    # only the most recent max_history points are kept
+    assert runner.history_seconds.tolist() == [3.0, 10.0, 20.0]
+
+
+def test_record_generation():
+    runner = CampaignRunner(SimpleNamespace(n_workers=2), "pso")
+    runner.record_generation(10.0, np.array([4.0, 6.0, 5.0]), np.zeros(4))
+    runner.record_generation(5.0, np.array([5.0, 5.0]), np.array([1.0, 2.0]))
+    first, second = runner.generations
+    assert (first["evaluations"], first["failed"]) == (4, 1)
+    assert first["utilization"] == 0.75 and not first["ordered"]
+    assert second["utilization"] == 1.0 and second["ordered"]
+    assert runner.generation_stats()["mean_utilization"] == 0.875
+
+
+class SleepingEvaluation:
+    """An elementwise evaluation that takes x seconds and fails for x > 0.95."""
+
+    problem = SimpleNamespace(xl=[0], xu=[1], n_obj=2)
+
+    def __call__(self, x):
+        if x[0] > 0.95:
+            raise RuntimeError("simulation failed")
+        time.sleep(x[0])
+        return {"F": [x[0], x[0]], "steps_run": 100, "censored": False}
+
+
+@pytest.fixture
+def pool():
+    pool = TaskScheduler(2)
+    pool.start()
+    yield pool
+    pool.shutdown(timeout=1)
+
+
+def test_campaign_runner(pool):
+    runner = CampaignRunner(pool, "pso", retries=0, k_nearest=2)
+    f = SleepingEvaluation()
+    results = runner(f, np.array([[0.0], [0.2], [0.5], [0.7], [0.9], [0.97]]))
+    evaluated = [0.0, 0.2, 0.5, 0.7, 0.9]
+    assert [out["F"] for out in results[:5]] == [[x, x] for x in evaluated]
+    assert results[5] == {"F": [1, 1], "steps_run": None, "censored": False}
+    # only the evaluated points enter the duration model
+    assert runner.history_x.ravel().tolist() == evaluated
+    submitted = []
+    submit = runner.campaign.submit
+
+    def record(task):
+        submitted.append(task["index"])
+        submit(task)
+
+    runner.campaign.submit = record
+    X = np.array([[0.1], [0.8], [0.4], [0.6]])
+    results = runner(f, X)
+    # longest expected first
+    assert submitted == [1, 3, 2, 0]
+    assert [out["F"][0] for out in results] == X.ravel().tolist()
+    first, second = runner.generations
+    assert first["failed"] == 1 and not first["ordered"]
+    assert second["failed"] == 0 and second["ordered"]
+    runner.close()
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import gaussian_kde
+from process_data import (
+    filter_and_classify,
+    fft_kde,
+    kde_on_grid,
+    batch_kl_divergence,
+    cal_kl_divergence,
+    kl_row,
+    KDE_FFT_MIN_SAMPLES,
+)
+
+
+def trajectories(n_rows=400, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "id": rng.integers(0, 40, n_rows).astype(float),
+            "width": rng.choice([4.5, 12.0], n_rows),
+            "xVelocity": rng.normal(10, 4, n_rows),
+        },
+        index=pd.Index(rng.permutation(n_rows) + 1000, name="frame"),
+    )
+    df.loc[df.index[::37], "xVelocity"] = -1.0
+    df.loc[df.index[5], "xVelocity"] = np.nan
+    df.loc[df.index[7], "id"] = np.nan
+    return df
+
+
+def reference(df, length_threshold=6):
+    """The per-vehicle groupby and concat filter_and_classify replaced."""
+    kept = [
+        group
+        for _, group in df.groupby("id", sort=True)
+        if (group["xVelocity"] >= 0).all()
+    ]
+    out = pd.concat(kept)
+    out["vehicleType"] = np.where(out["width"] > length_threshold, "bus", "car")
+    return out
+
+
+def test_pandas_matches_reference():
+    df = trajectories()
+    pd.testing.assert_frame_equal(filter_and_classify(df), reference(df))
+
+
+def test_polars_matches_pandas():
+    pytest.importorskip("polars")
+    for seed in range(3):
+        df = trajectories(seed=seed)
+        result = filter_and_classify(df, backend="polars")
+        pd.testing.assert_frame_equal(result, filter_and_classify(df))
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        filter_and_classify(trajectories(), backend="arrow")
+
+
+@pytest.mark.parametrize("n", [20, 200, 5000, 50000])
+def test_fft_kde_matches_gaussian_kde(n):
+    rng = np.random.default_rng(n)
+    data = np.concatenate(
+        [rng.normal(0, 0.3, n - n // 4), rng.gamma(2.0, 0.5, n // 4) - 2]
+    )
+    kde_x = np.linspace(data.min(), data.max(), 1000)
+    exact = gaussian_kde(data)(kde_x)
+    binned = fft_kde(data, kde_x)
+    assert np.abs(binned - exact).max() < 1e-5 * exact.max()
+
+
+def test_fft_kde_stays_positive_in_gaps():
+    data = np.concatenate([np.linspace(0, 1, 100), [500.0]])
+    kde_x = np.linspace(0, 500, 1000)
+    exact = gaussian_kde(data)(kde_x)
+    binned = fft_kde(data, kde_x)
+    # the FFT cannot resolve the density between 1 and 500
+    assert (exact > 0).all() and (binned > 0).all()
+
+
+def test_fft_kde_rejects_constant_data():
+    with pytest.raises(np.linalg.LinAlgError):
+        fft_kde(np.ones(100), np.linspace(0, 2, 10))
+
+
+def test_kde_on_grid_auto():
+    data = np.random.default_rng(0).normal(size=KDE_FFT_MIN_SAMPLES)
+    kde_x = np.linspace(data.min(), data.max(), 100)
+    np.testing.assert_array_equal(kde_on_grid(data, kde_x), fft_kde(data, kde_x))
+    small = data[: KDE_FFT_MIN_SAMPLES - 1]
+    np.testing.assert_array_equal(
+        kde_on_grid(small, kde_x), gaussian_kde(small)(kde_x)
+    )
+    with pytest.raises(ValueError):
+        kde_on_grid(data, kde_x, kde="histogram")
+
+
+VARIABLES = ["xAcceleration", "dhw", "xVelocity"]
+VEHICLE_TYPES = ["car", "bus"]
+KEYS = [f"{vtype}_{variable}" for vtype in VEHICLE_TYPES for variable in VARIABLES]
+
+
+def make_distributions(rng, keys=KEYS, shift=0.0):
+    """Distributions in the _cache.pkl layout with random grids and curves."""
+    hist_kde_data = {}
+    for key in keys:
+        lo = rng.uniform(-2, 0) + shift
+        x = np.linspace(lo, lo + rng.uniform(2, 4), 1000)
+        center, width = rng.uniform(x[200], x[800]), rng.uniform(0.2, 1)
+        y = np.exp(-0.5 * ((x - center) / width) ** 2) + 1e-6
+        hist_kde_data[key] = (None, None, None, x, y)
+    return {"hist_kde_data": hist_kde_data}
+
+
+def test_batch_matches_loop():
+    rng = np.random.default_rng(0)
+    reference = make_distributions(rng)
+    candidates = [make_distributions(rng) for _ in range(7)]
+    # a candidate without bus distributions and one that does not overlap
+    candidates.append(make_distributions(rng, KEYS[:3]))
+    candidates.append(make_distributions(rng, shift=100.0))
+    batch = batch_kl_divergence(
+        reference, candidates, VARIABLES, VEHICLE_TYPES, chunk=3
+    )
+    assert batch.shape == (len(candidates), len(KEYS))
+    for row, candidate in zip(batch, candidates):
+        expected = cal_kl_divergence(reference, candidate, VARIABLES, VEHICLE_TYPES)
+        np.testing.assert_allclose(kl_row(row), expected, rtol=1e-9, atol=1e-12)
+    assert np.isnan(batch[7, 3:]).all()
+    assert np.isinf(batch[8]).all()
+
+
+def test_missing_reference_key():
+    rng = np.random.default_rng(1)
+    reference = make_distributions(rng, KEYS[1:])
+    candidate = make_distributions(rng)
+    (row,) = batch_kl_divergence(reference, [candidate])
+    assert np.isnan(row[0]) and np.isfinite(row[1:]).all()
+    expected = cal_kl_divergence(reference, candidate, VARIABLES, VEHICLE_TYPES)
+    assert kl_row(row) == pytest.approx(expected, rel=1e-9)
+
+
+def test_grids_of_different_lengths():
+    rng = np.random.default_rng(2)
+    short = make_distributions(rng)
+    *rest, x, y = short["hist_kde_data"]["car_dhw"]
+    short["hist_kde_data"]["car_dhw"] = (*rest, x[::2], y[::2])
+    with pytest.raises(ValueError):
+        batch_kl_divergence(make_distributions(rng), [make_distributions(rng), short])
@@ -0,0 +1,176 @@
+import json
+import os
+import sqlite3
+import time
+import pytest
+from bayes_opt import BayesianOptimization
+from bayes_opt.event import Events
+import task
+from task import get_best_param
+from result_store import ResultStore, ResultLogger
+
+
+def make_store(tmp_path):
+    return ResultStore(str(tmp_path / "results.sqlite"))
+
+
+def test_censored_results(tmp_path):
+    store = make_store(tmp_path)
+    run_id = store.open_run("merge_run")
+    store.add(run_id, "merge", {"tau": 1.0}, -0.5, steps_run=900)
+    store.add(run_id, "merge", {"tau": 2.0}, -0.2, steps_run=400, censored=True)
+    df = store.results("merge_run")
+    assert df["censored"].tolist() == [False, True]
+    assert df["steps_run"].tolist() == [900, 400]
+    assert store.top_k(1, run="merge_run", censored=True)["tau"].tolist() == [2.0]
+    # a censored target only bounds the score of the full run
+    assert store.best(run="merge_run") == ({"tau": 1.0}, -0.5)
+
+
+def test_result_logger_annotations(tmp_path):
+    store = make_store(tmp_path)
+    run_id = store.open_run("merge_run")
+    optimizer = BayesianOptimization(f=None, pbounds={"tau": (0, 3)}, verbose=0)
+    logger = ResultLogger(store, run_id, "merge")
+    optimizer.subscribe(Events.OPTIMIZATION_STEP, logger)
+    logger.annotate(steps_run=300, censored=True)
+    optimizer.register(params={"tau": 1.0}, target=-0.3)
+    optimizer.register(params={"tau": 2.0}, target=-0.4)
+    df = store.results("merge_run")
+    assert df["tau"].tolist() == [1.0, 2.0]
+    assert df["censored"].tolist() == [True, False]
+    assert df["steps_run"].tolist()[0] == 300 and df["steps_run"].isna().tolist()[1]
+
+
+def test_old_results_table_is_migrated(tmp_path):
+    path = str(tmp_path / "results.sqlite")
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        "CREATE TABLE runs (run_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, "
+        "env TEXT, algorithm TEXT NOT NULL, created REAL NOT NULL, "
+        "updated REAL NOT NULL);"
+        "CREATE TABLE results (id INTEGER PRIMARY KEY, run_id INTEGER NOT NULL, "
+        "env TEXT, target REAL NOT NULL, params TEXT NOT NULL, objectives TEXT, "
+        "created REAL NOT NULL);"
+        "INSERT INTO runs VALUES (1, 'merge_old', 'merge', 'bo', 0, 0);"
+        "INSERT INTO results VALUES (1, 1, 'merge', -0.1, '{\"tau\": 1.0}', NULL, 0);"
+    )
+    conn.commit()
+    conn.close()
+    store = ResultStore(path)
+    assert store.best(run="merge_old") == ({"tau": 1.0}, -0.1)
+    store.add(1, "merge", {"tau": 2.0}, -0.05, steps_run=600, censored=True)
+    df = store.results("merge_old")
+    assert df["censored"].tolist() == [False, True]
+    assert df["steps_run"].tolist()[1] == 600
+
+
+def write_log(folder, name, entries, mtime=None):
+    """A JSONLogger file with (params, target) entries."""
+    path = folder / f"{name}.log"
+    with open(path, "w") as f:
+        for params, target in entries:
+            f.write(json.dumps({"target": target, "params": params}) + "\n")
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_import_logs(tmp_path):
+    write_log(tmp_path, "merge_2024-01-01_10:00", [({"tau": 1.0}, -0.4)], 1000)
+    write_log(
+        tmp_path,
+        "right_2024-01-02_10:00",
+        [({"tau": 2.0}, -0.3), ({"tau": 3.0}, float("nan")), ({"tau": 4.0}, -0.1)],
+        2000,
+    )
+    (tmp_path / "right_2024-01-02_10:00_pending.json").write_text("[]")
+    store = make_store(tmp_path)
+    assert store.import_logs(tmp_path) == 2
+    assert store.import_logs(tmp_path) == 0
+    # dated like the logs, non-finite targets skipped
+    assert store.latest_run() == "right_2024-01-02_10:00"
+    df = store.results("right_2024-01-02_10:00")
+    assert df["tau"].tolist() == [2.0, 4.0]
+    assert store.best(env="merge") == ({"tau": 1.0}, -0.4)
+    assert store.best() == ({"tau": 4.0}, -0.1)
+    assert store.best(run="stop_unknown") is None
+
+
+def test_open_run_imports_its_log_once(tmp_path):
+    log = write_log(tmp_path, "merge_a", [({"tau": 1.0}, -0.4)])
+    store = make_store(tmp_path)
+    run_id = store.open_run("merge_a", log=str(log))
+    assert store.open_run("merge_a", log=str(log)) == run_id
+    store.add(run_id, "merge", {"tau": 2.0}, -0.2)
+    assert store.results("merge_a")["tau"].tolist() == [1.0, 2.0]
+    store.open_run("merge_a", reset=True)
+    assert store.results("merge_a").empty
+
+
+def test_top_k_and_tail(tmp_path):
+    store = make_store(tmp_path)
+    bo = store.open_run("merge_bo")
+    pso = store.open_run("merge_pso", algorithm="pso")
+    for i, target in enumerate([-0.5, -0.1, -0.3]):
+        store.add(bo, "merge", {"tau": float(i)}, target)
+    store.add(pso, "merge", {"tau": 9.0}, -0.2, objectives=[0.1, 0.3])
+    assert store.top_k(2)["target"].tolist() == [-0.1, -0.2]
+    assert store.top_k(5, algorithm="pso")["objectives"].tolist() == [[0.1, 0.3]]
+    first = store.tail(limit=2)
+    assert first["tau"].tolist() == [0.0, 1.0]
+    rest = store.tail(after=first["id"].max())
+    assert rest["tau"].tolist() == [2.0, 9.0]
+
+
+def test_get_best_param(tmp_path, monkeypatch):
+    monkeypatch.setattr(task, "LOG_DIR", str(tmp_path))
+    store = make_store(tmp_path)
+    with pytest.raises(ValueError, match="no BO runs"):
+        get_best_param(store=store)
+    write_log(tmp_path, "merge_a", [({"tau": 1.0}, -0.4), ({"tau": 2.0}, -0.2)])
+    assert get_best_param(store=store) == ({"tau": 2.0}, 0.2)
+    assert get_best_param("merge_a", store=store) == ({"tau": 2.0}, 0.2)
+    with pytest.raises(ValueError, match="no BO run merge_b"):
+        get_best_param("merge_b", store=store)
+    # a failed lookup does not leave an empty run behind
+    assert store.run_id("merge_b") is None
+    run_id = store.open_run("merge_c")
+    store.add(run_id, "merge", {"tau": 3.0}, -0.1, censored=True)
+    with pytest.raises(ValueError, match="no uncensored results"):
+        get_best_param("merge_c", store=store)
+
+
+def test_logs_that_grew_are_caught_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(task, "LOG_DIR", str(tmp_path))
+    store = make_store(tmp_path)
+    entries = [({"tau": 1.0}, -0.4)]
+    write_log(tmp_path, "merge_a", entries, 1000)
+    assert get_best_param("merge_a", store=store) == ({"tau": 1.0}, 0.4)
+    # the run went on without the store
+    entries += [({"tau": 2.0}, -0.2), ({"tau": 3.0}, float("nan"))]
+    write_log(tmp_path, "merge_a", entries, 2000)
+    assert get_best_param("merge_a", store=store) == ({"tau": 2.0}, 0.2)
+    entries.append(({"tau": 4.0}, -0.1))
+    write_log(tmp_path, "merge_a", entries, 3000)
+    assert store.import_logs(tmp_path) == 1
+    assert get_best_param(store=store) == ({"tau": 4.0}, 0.1)
+    assert store.results("merge_a")["tau"].tolist() == [1.0, 2.0, 4.0]
+
+
+def test_results_added_live_are_not_imported_again(tmp_path):
+    store = make_store(tmp_path)
+    entries = [({"tau": 1.0}, -0.4)]
+    log = write_log(tmp_path, "merge_a", entries, 1000)
+    run_id = store.open_run("merge_a", log=str(log))
+    # a resumed run writes its log first, then the store
+    entries.append(({"tau": 2.0}, -0.2))
+    write_log(tmp_path, "merge_a", entries)
+    store.add(run_id, "merge", {"tau": 2.0}, -0.2, steps_run=900)
+    assert store.import_logs(tmp_path) == 0
+    # a log newer than the run that holds nothing new
+    os.utime(log, (time.time() + 60, time.time() + 60))
+    assert store.open_run("merge_a", log=str(log)) == run_id
+    df = store.results("merge_a")
+    assert df["tau"].tolist() == [1.0, 2.0]
+    assert df["steps_run"].tolist()[1] == 900
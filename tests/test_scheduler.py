@@ -0,0 +1,150 @@
+import os
+import time
+import pytest
+from scheduler import TaskScheduler
+
+
+def square(task):
+    return task["x"] ** 2
+
+
+def flaky(task, failures=1):
+    """Fail the first attempts, by a None result or an exception."""
+    if task["attempt"] < failures:
+        if task["x"] % 2:
+            raise RuntimeError("simulation failed")
+        return None
+    return task["x"]
+
+
+def slow_first_attempt(task, seconds=30):
+    if task["attempt"] == 0:
+        time.sleep(seconds)
+    return task["x"]
+
+
+def started(task):
+    return time.time()
+
+
+def die_first_attempt(task):
+    if task["attempt"] == 0:
+        os._exit(1)
+    return task["x"]
+
+
+@pytest.fixture
+def pool():
+    pool = TaskScheduler(2)
+    pool.start()
+    yield pool
+    pool.shutdown(timeout=1)
+
+
+def collect(campaign, n, timeout=30):
+    outcomes = {}
+    deadline = time.time() + timeout
+    while len(outcomes) < n and time.time() < deadline:
+        for task, result in campaign.results(timeout=0.2):
+            assert task["x"] not in outcomes
+            outcomes[task["x"]] = result
+    return outcomes
+
+
+def test_results(pool):
+    campaign = pool.campaign("square", square)
+    for x in range(10):
+        campaign.submit({"x": x})
+    assert collect(campaign, 10) == {x: x**2 for x in range(10)}
+    assert campaign.stats()["finished"] == 10
+    assert campaign.stats()["in_flight"] == 0
+
+
+def test_failures_are_retried(pool):
+    campaign = pool.campaign("flaky", flaky, retries=1)
+    for x in range(4):
+        campaign.submit({"x": x})
+    assert collect(campaign, 4) == {x: x for x in range(4)}
+    assert campaign.stats()["retried"] == 4
+
+
+def test_failure_after_last_retry(pool):
+    campaign = pool.campaign("failing", flaky, kwargs={"failures": 3}, retries=1)
+    campaign.submit({"x": 2})
+    campaign.submit({"x": 3})
+    assert collect(campaign, 2) == {2: None, 3: None}
+    stats = campaign.stats()
+    assert (stats["failed"], stats["retried"]) == (2, 2)
+
+
+def test_timeout_kills_and_retries(pool):
+    campaign = pool.campaign("slow", slow_first_attempt, timeout=1, retries=1)
+    campaign.submit({"x": 7})
+    start = time.time()
+    assert collect(campaign, 1) == {7: 7}
+    assert time.time() - start < 10
+    stats = pool.stats()
+    assert stats["timeouts"] == 1 and stats["respawned"] == 1
+    assert all(process.is_alive() for process in pool.workers.values())
+
+
+def test_dead_worker_is_replaced(pool):
+    campaign = pool.campaign("crash", die_first_attempt, retries=1)
+    for x in range(3):
+        campaign.submit({"x": x})
+    assert collect(campaign, 3) == {0: 0, 1: 1, 2: 2}
+    assert pool.stats()["respawned"] == 3
+    # the replacements report through fresh pipes
+    again = pool.campaign("square", square)
+    again.submit({"x": 4})
+    assert collect(again, 1) == {4: 16}
+
+
+def test_priority():
+    # one worker, so tasks start in the order they are handed out
+    pool = TaskScheduler(1)
+    pool.start()
+    try:
+        blocker = pool.campaign("blocker", slow_first_attempt, kwargs={"seconds": 1})
+        blocker.submit({"x": 0})
+        # queued while the worker is busy
+        low = pool.campaign("low", started)
+        high = pool.campaign("high", started, priority=1)
+        for x in range(3):
+            low.submit({"x": x})
+            high.submit({"x": x})
+        high_starts = collect(high, 3).values()
+        low_starts = collect(low, 3).values()
+        assert max(high_starts) < min(low_starts)
+    finally:
+        pool.shutdown(timeout=1)
+
+
+def test_duplicate_campaign(pool):
+    pool.campaign("bo", square)
+    with pytest.raises(ValueError):
+        pool.campaign("bo", square)
+
+
+def test_weights_share_the_workers():
+    pool = TaskScheduler(4)
+    pool.start()
+    try:
+        blocker = pool.campaign("blocker", slow_first_attempt, kwargs={"seconds": 1})
+        for x in range(4):
+            blocker.submit({"x": x})
+        # queued while all workers are busy
+        light = pool.campaign("light", slow_first_attempt, kwargs={"seconds": 3})
+        heavy = pool.campaign(
+            "heavy", slow_first_attempt, kwargs={"seconds": 3}, weight=3
+        )
+        for x in range(6):
+            light.submit({"x": x})
+            heavy.submit({"x": x})
+        assert len(collect(blocker, 4)) == 4
+        deadline = time.time() + 5
+        while light.running + heavy.running < 4 and time.time() < deadline:
+            time.sleep(0.05)
+        assert (light.running, heavy.running) == (1, 3)
+    finally:
+        pool.shutdown(timeout=1)
@@ -0,0 +1,65 @@
+import xml.etree.ElementTree as ET
+import numpy as np
+from task import parse_vtype_config, write_vtype_distributions
+
+PROFILE = """tau; normal(1.5,2);[0.2,6]
+accel; 2.6
+maxSpeed; normal(20,5);[6,30]
+carFollowModel; EIDM
+vClass; passenger
+"""
+
+
+def write(tmp_path, sizes, seed=42):
+    path = tmp_path / "vTypeDistributions.add.xml"
+    write_vtype_distributions({"car": PROFILE, "bus": PROFILE}, path, sizes, seed)
+    return path
+
+
+def test_parse_vtype_config():
+    attributes = {a[0]: a[1:] for a in parse_vtype_config(PROFILE)}
+    assert attributes["tau"] == ("normal", [1.5, 2.0], (0.2, 6.0), None)
+    assert attributes["accel"] == (None, None, (0, None), "2.6")
+    assert attributes["vClass"] == (None, None, (0, None), "passenger")
+
+
+def test_output_format(tmp_path):
+    path = write(tmp_path, {"car": 50, "bus": 7})
+    text = path.read_text()
+    assert text.startswith('<?xml version="1.0" ?>\n<additional ')
+    root = ET.parse(path).getroot()
+    assert root.tag == "additional"
+    distributions = root.findall("vTypeDistribution")
+    assert [d.get("id") for d in distributions] == ["car", "bus"]
+    for distribution, size in zip(distributions, (50, 7)):
+        vtypes = distribution.findall("vType")
+        name = distribution.get("id")
+        assert [v.get("id") for v in vtypes] == [f"{name}{i}" for i in range(size)]
+        for vtype in vtypes:
+            assert vtype.get("accel") == "2.600"
+            assert vtype.get("carFollowModel") == "EIDM"
+            assert vtype.get("vClass") == "passenger"
+            # sampled values are written with 3 decimals within their limits
+            for attr, (lo, hi) in {"tau": (0.2, 6), "maxSpeed": (6, 30)}.items():
+                value = vtype.get(attr)
+                assert len(value.split(".")[1]) == 3
+                assert lo <= float(value) <= hi
+
+
+def test_seeded(tmp_path):
+    outputs = []
+    for name, seed in [("a", 42), ("b", 42), ("c", 1)]:
+        (tmp_path / name).mkdir()
+        outputs.append(write(tmp_path / name, {"car": 20, "bus": 5}, seed).read_text())
+    assert outputs[0] == outputs[1]
+    assert outputs[0] != outputs[2]
+
+
+def test_sample_distribution(tmp_path):
+    path = write(tmp_path, {"car": 5000, "bus": 1})
+    taus = np.array(
+        [float(v.get("tau")) for v in ET.parse(path).getroot().iter("vType")][:5000]
+    )
+    # normal(1.5, 2) resampled into [0.2, 6] has its mass well above the mean
+    assert taus.min() >= 0.2 and taus.max() <= 6
+    assert 2.2 < taus.mean() < 2.4